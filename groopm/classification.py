@@ -57,6 +57,226 @@ np.seterr(all='raise')
 ###############################################################################
 ###############################################################################
 
+class TaxonomicConnectivity:
+    """Compact taxonomic connectivity between mappings.
+    
+    Mappings are connected when the distance between their classifications,
+    as defined by `ClassificationEngine.getDistance`, is less than `d`, and
+    every mapping is connected to itself. This is the case when the tagged
+    ranks of one classification, up to the first untagged rank, are a prefix
+    of the other classification, and none of the shared ranks are empty tags.
+    
+    Mappings are grouped by the node of a taxonomic prefix tree for their
+    tagged ranks above any empty tag, and by whether they are `open`, i.e. 
+    their tags are not cut short by an empty tag. Mapping `j` is connected to
+    mapping `i` if `j` is open and its node is the node of `i` or an ancestor,
+    or vice versa. Nodes are found by sorting mappings in prefix order, so
+    that the mappings below each node are contiguous. Memory use is linear in
+    the number of mappings.
+    
+    Parameters
+    ----------
+    table : ndarray
+        n-by-7 array of taxon indices (see `_Classification`).
+    d : int
+        Distance below which mappings are connected.
+    """
+    
+    def __init__(self, table, d=1):
+        table = np.asarray(table)
+        # only ranks within distance `d` need to be coherent
+        k = max(0, min(table.shape[1], 8 - d))
+        table = table[:, :k]
+        m = table.shape[0]
+        ranks = np.arange(k)
+        
+        # tags end at the first untagged rank, and mappings are only coherent
+        # with other mappings above their first empty tag
+        is_untagged = table == 0
+        tagged_depths = _first_true(is_untagged, k)
+        is_empty = np.logical_and(table == 1, ranks[None, :] < tagged_depths[:, None])
+        self._depths = np.where(is_empty.any(axis=1), _first_true(is_empty, 0), tagged_depths)
+        self._isOpen = self._depths == tagged_depths
+        prefixes = np.where(ranks[None, :] < self._depths[:, None], table, 0)
+        
+        # order mappings by prefix, with shorter prefixes and then open
+        # mappings first
+        self._order = np.lexsort([~self._isOpen] + [prefixes[:, j] for j in range(k-1, -1, -1)])
+        self._positions = np.empty(m, dtype=np.intp)
+        self._positions[self._order] = np.arange(m)
+        
+        # `_blocks[t][p]` is the id of the prefix tree node at depth `t` above
+        # the mapping in position `p`, and `_numBlocks[t]` is the number of
+        # nodes at depth `t`.
+        sorted_prefixes = prefixes[self._order]
+        is_new = np.zeros(m, dtype=bool)
+        is_new[:1] = True
+        self._blocks = np.empty((k+1, m), dtype=np.intp)
+        self._numBlocks = np.empty(k+1, dtype=np.intp)
+        for t in range(k+1):
+            if t > 0:
+                is_new[1:] = np.logical_or(is_new[1:], sorted_prefixes[1:, t-1] != sorted_prefixes[:-1, t-1])
+            self._blocks[t] = np.cumsum(is_new) - 1
+            self._numBlocks[t] = np.count_nonzero(is_new)
+        
+        # group mappings by prefix tree node and whether they are open, with
+        # groups numbered in prefix order so that the groups at or below a
+        # node have consecutive ids
+        self._nodeOffsets = np.concatenate(([0], np.cumsum(self._numBlocks)))
+        nodes = self._blocks[self._depths, self._positions] + self._nodeOffsets[self._depths]
+        (_, first, groups) = np.unique(nodes * 2 + ~self._isOpen, return_index=True, return_inverse=True)
+        order = np.argsort(self._positions[first])
+        first = first[order]
+        ranks = np.empty(len(order), dtype=np.intp)
+        ranks[order] = np.arange(len(order))
+        self._groups = ranks[groups]
+        self._groupPositions = self._positions[first]
+        self._groupDepths = self._depths[first]
+        self._groupIsOpen = self._isOpen[first]
+        
+        # `_openGroups[u]` is the open group at node `u` or -1, and
+        # `_groupEnds[g]` is one past the last group at or below the node of
+        # group `g`
+        self._openGroups = np.full(self._nodeOffsets[-1], -1, dtype=np.intp)
+        open_groups = np.flatnonzero(self._groupIsOpen)
+        self._openGroups[nodes[first[open_groups]]] = open_groups
+        node_ends = np.empty(len(first), dtype=np.intp)
+        for t in range(k+1):
+            at_depth = self._groupDepths == t
+            blocks = self._blocks[t]
+            node_ends[at_depth] = np.searchsorted(blocks, blocks[self._groupPositions[at_depth]], side="right")
+        self._groupEnds = np.searchsorted(self._groupPositions, node_ends)
+        
+    def groups(self):
+        """Group index of each mapping
+        
+        Mappings in a group share the same connected mappings, except that
+        mappings in groups that are not open are only connected to
+        themselves within their own group.
+        """
+        return self._groups
+        
+    def groupIsOpen(self, groups):
+        """Whether the mappings in each group are connected to each other"""
+        return self._groupIsOpen[groups]
+        
+    def connected(self, indices):
+        """Connectivity matrix for a set of mappings
+        
+        Returns a boolean array `C` where `C[i, j]` is True if mappings
+        `indices[i]` and `indices[j]` are connected.
+        """
+        indices = np.asarray(indices, dtype=np.intp)
+        p = self._positions[indices]
+        depths = self._depths[indices]
+        is_open = self._isOpen[indices]
+        C = self._connectedPositions(p, depths, is_open, p, depths, is_open)
+        C[np.diag_indices_from(C)] = True
+        return C
+        
+    def connectedGroups(self, groups, otherGroups):
+        """Connectivity matrix between groups
+        
+        Returns a boolean array `C` where `C[i, j]` is True if the mappings
+        in group `groups[i]` are connected to mappings in group
+        `otherGroups[j]`.
+        """
+        return self._connectedPositions(self._groupPositions[groups],
+                                        self._groupDepths[groups],
+                                        self._groupIsOpen[groups],
+                                        self._groupPositions[otherGroups],
+                                        self._groupDepths[otherGroups],
+                                        self._groupIsOpen[otherGroups])
+        
+    def connectedGroupsAbove(self, groups):
+        """Connected groups at nodes above each group
+        
+        Returns an array `A` where row `i` holds the open groups at nodes
+        above the node of group `groups[i]`, and at its own node if the group
+        is not open, padded with -1. Together with `connectedGroupRanges`
+        these are all the groups connected to each group, without overlap.
+        """
+        groups = np.asarray(groups, dtype=np.intp)
+        p = self._groupPositions[groups]
+        depths = self._groupDepths[groups]
+        ranks = np.arange(len(self._numBlocks))
+        nodes = self._blocks[:, p].T + self._nodeOffsets[None, :-1]
+        is_above = np.logical_or(ranks[None, :] < depths[:, None],
+                                 np.logical_and(ranks[None, :] == depths[:, None],
+                                                ~self._groupIsOpen[groups][:, None]))
+        return np.where(is_above, self._openGroups[nodes], -1)
+        
+    def connectedGroupRanges(self, groups):
+        """Connected groups at or below the node of each group
+        
+        Returns a tuple `(starts, ends)`, where the mappings in an open group
+        `groups[i]` are connected to the groups with ids from `starts[i]` up
+        to but not including `ends[i]`. Ranges are empty for groups that are
+        not open.
+        """
+        groups = np.asarray(groups, dtype=np.intp)
+        return (groups, np.where(self._groupIsOpen[groups], self._groupEnds[groups], groups))
+        
+    def _connectedPositions(self, p, depths, is_open, q, other_depths, other_is_open):
+        # is_below[i, j] is True if position `q[j]` is at or below the node of `p[i]`
+        is_below = self._blocks[depths[:, None], q[None, :]] == self._blocks[depths, p][:, None]
+        is_above = self._blocks[other_depths[None, :], p[:, None]] == self._blocks[other_depths, q][None, :]
+        return np.logical_or(np.logical_and(is_below, is_open[:, None]),
+                             np.logical_and(is_above, other_is_open[None, :]))
+        
+    def iterNeighbourCounts(self, values, chunkSize=4096):
+        """Counts of values for connected mappings
+        
+        Parameters
+        ----------
+        values : ndarray
+            1-D array of non-negative integer labels for each mapping.
+        chunkSize : int
+            Number of mappings per yielded chunk.
+            
+        Returns
+        -------
+        An iterator of `(indices, counts)` tuples, where `counts[i, v]` is the
+        number of mappings connected to mapping `indices[i]` that have value
+        `v`.
+        """
+        values = np.asarray(values)
+        m = len(values)
+        num_values = values.max()+1 if m > 0 else 0
+        sorted_values = values[self._order]
+        sorted_depths = self._depths[self._order]
+        sorted_open = self._isOpen[self._order]
+        
+        # value counts for all mappings below each node, and for open
+        # mappings at each node
+        all_counts = []
+        open_counts = []
+        for t in range(len(self._numBlocks)):
+            num_blocks = self._numBlocks[t]
+            keys = self._blocks[t] * num_values + sorted_values
+            all_counts.append(np.bincount(keys, minlength=num_blocks*num_values).reshape(num_blocks, num_values))
+            is_open_here = np.logical_and(sorted_open, sorted_depths == t)
+            open_counts.append(np.bincount(keys[is_open_here], minlength=num_blocks*num_values).reshape(num_blocks, num_values))
+            
+        for start in range(0, m, chunkSize):
+            indices = np.arange(start, min(m, start+chunkSize))
+            p = self._positions[indices]
+            depths = self._depths[indices]
+            is_open = self._isOpen[indices]
+            counts = np.zeros((len(indices), num_values), dtype=int)
+            for t in range(len(self._numBlocks)):
+                blocks = self._blocks[t, p]
+                above = depths > t
+                counts[above] += open_counts[t][blocks[above]]
+                here = np.logical_and(depths == t, is_open)
+                counts[here] += all_counts[t][blocks[here]]
+                here = np.logical_and(depths == t, ~is_open)
+                counts[here] += open_counts[t][blocks[here]]
+            # mappings that are not open are connected to themselves
+            counts[np.flatnonzero(~is_open), values[indices[~is_open]]] += 1
+            yield (indices, counts)
+            
+        
 class BinClassifier:
     """Wraps a connectivity matrix and determines consensus classifications by
     finding `cliques` (fully-connected subgraphs) in the matrix.
@@ -65,21 +285,17 @@ class BinClassifier:
     def __init__(self, mapping):
         self._classification = mapping.classification
         self._d = 1
-        #Y = np.logical_or(mapping.makeDistances(), self._classification.makeDistances() >= self._d)
-        #self._mC = np.logical_not(sp_distance.squareform(Y)).astype(float)
-        #self._mC = mapping.makeConnectivity(d=self._d)
         
-        # Connectivity matrix: M[i,j] = 1 where mapping i and j are 
-        # taxonomically 'similar enough', otherwise 0.
-        # In this case we want 
-        self._mdists = np.logical_not(sp_distance.squareform(self._classification.makeDistances() >= self._d)).astype(float)
+        # Connectivity: mappings i and j are connected when taxonomically
+        # 'similar enough'.
+        self._connectivity = TaxonomicConnectivity(self._classification._table, d=self._d)
         
     def maxClique(self, indices):
         """Compute a maximal set of indices such that `C[j,k] == True`
         for all pairs `j`,`k` from set"""
         if len(indices) == 0:
             return np.array([], dtype=np.intp)
-        return greedy_clique_by_elimination(self._mdists[np.ix_(indices, indices)])
+        return greedy_clique_by_elimination(self._connectivity.connected(indices))
     
     def _specificTag(self, indices):
         ret = []
@@ -114,6 +330,13 @@ class BinClassifier:
         return "{:s}({:d}/{:d})".format(tag, len(q), len(indices))
         
         
+def _first_true(mask, default):
+    """Column of the first True value in each row of `mask`, or `default`"""
+    if mask.shape[1] == 0:
+        return np.full(mask.shape[0], default, dtype=np.intp)
+    return np.where(mask.any(axis=1), mask.argmax(axis=1), default)
+    
+    
 def greedy_clique_by_elimination(C):
     """Find clique from connectivity matrix by repeatedly removing least connected
     nodes. Efficient and should generally be accurate enough for our purposes.
@@ -50,7 +50,9 @@ __email__ = "t.lamberton@uq.edu.au"
 import numpy as np
 import numpy.linalg as np_linalg
 import scipy.cluster.hierarchy as sp_hierarchy
+import scipy.spatial as sp_spatial
 import scipy.spatial.distance as sp_distance
+import scipy.sparse as sp_sparse
 import scipy.stats as sp_stats
 import operator
 import os
@@ -58,12 +60,15 @@ import os.path
 import tables
 import sys
 import tempfile
+import time
+import hashlib
 
 # local imports
 import distance
 import hierarchy
 import stream
 from profileManager import ProfileManager
+from classification import TaxonomicConnectivity
 from groopmExceptions import SavedDistancesInvalidNumberException, CacheUnavailableException
 
 ###############################################################################
@@ -81,6 +86,9 @@ class CoreCreator:
     def loadProfile(self, timer, minLength):
         return self._pm.loadData(timer,
                                  minLength=minLength,
+                                 loadContigNames=False,
+                                 loadContigGCs=False,
+                                 loadStoitNames=False,
                                  loadMarkers=True,
                                  loadBins=False)
         
@@ -91,35 +99,50 @@ class CoreCreator:
             minPts,
             savedDistsPrefix="",
             keepDists=False,
-            force=False):
-        # check that the user is OK with nuking stuff...
-        if not force and not self._pm.promptOnOverwrite():
-            return
+            maxCacheSize=None,
+            force=False,
+            threads=1,
+            knn=None,
+            singlePrecision=False):
+        with self._pm.session(timer, mode='a'):
+            # check that the user is OK with nuking stuff...
+            if not force and not self._pm.promptOnOverwrite():
+                return
             
-        profile = self.loadProfile(timer,
-                                   minLength=minLength
-                                   )
-        
-        if savedDistsPrefix=="":
-            savedDistsPrefix = self._dbFileName+".dists"
-        cacher = FileCacher(savedDistsPrefix)
-        
-        ce = ClassificationClusterEngine(profile,
-                                         minPts=minPts,
-                                         minSize=minSize,
-                                         cacher=cacher,
-                                        )
-        ce.makeBins(timer,
-                    out_bins=profile.binIds,
-                    out_reach_order=profile.reachOrder,
-                    out_reach_dists=profile.reachDists
-                    )
+            profile = self.loadProfile(timer,
+                                       minLength=minLength
+                                       )
+        
+            if savedDistsPrefix=="":
+                savedDistsPrefix = self._dbFileName+".dists"
+            cacher = FileCacher(savedDistsPrefix, maxSize=maxCacheSize)
+        
+            if knn:
+                ce = KNNClassificationClusterEngine(profile,
+                                                    k=knn,
+                                                    minPts=minPts,
+                                                    minSize=minSize,
+                                                    threads=threads,
+                                                   )
+            else:
+                ce = ClassificationClusterEngine(profile,
+                                                 minPts=minPts,
+                                                 minSize=minSize,
+                                                 cacher=cacher,
+                                                 threads=threads,
+                                                 singlePrecision=singlePrecision,
+                                                )
+            ce.makeBins(timer,
+                        out_bins=profile.binIds,
+                        out_reach_order=profile.reachOrder,
+                        out_reach_dists=profile.reachDists
+                        )
 
-        # Now save all the stuff to disk!
-        print "Saving bins"
-        self._pm.setReachabilityOrder(profile)
-        self._pm.setBinAssignments(profile, nuke=True)
-        print "    %s" % timer.getTimeStamp()
+            # Now save all the stuff to disk!
+            print "Saving bins"
+            self._pm.setReachabilityOrder(profile)
+            self._pm.setBinAssignments(profile, nuke=True)
+            print "    %s" % timer.getTimeStamp()
         
         # Remove created files
         if not keepDists:
@@ -136,6 +159,7 @@ class HierarchicalClusterEngine:
     Subclass should provide `distances` and `fcluster` methods to the
     interface outlined below.
     """
+    _threads = 1 # threads used when computing the reachability ordering
     
     def makeBins(self, timer, out_bins, out_reach_order, out_reach_dists):
         """Run binning algorithm"""
@@ -145,7 +169,7 @@ class HierarchicalClusterEngine:
         print "    %s" % timer.getTimeStamp()
         
         print "Computing cluster hierarchy"
-        (o, d) = distance.reachability_order(pdists, core_dists)
+        (o, d) = self.reachabilityOrder(pdists, core_dists)
         print "    %s" % timer.getTimeStamp()
         
         print "Finding cores"
@@ -169,6 +193,26 @@ class HierarchicalClusterEngine:
         """
         pass #subclass to override
         
+    def reachabilityOrder(self, Y, core_dists):
+        """Traverse observations to produce a reachability summary.
+        
+        Parameters
+        ----------
+        Y : ndarray
+            Distances for pairs of observations, as returned by `distances`.
+        core_dists : ndarray
+            1-D array. `core_dists[i]` is the core distance of the `i`th
+            observation.
+            
+        Returns
+        -------
+        o : ndarray
+            1-D array of indices of original observations in traversal order.
+        d : ndarray
+            1-D array. `d[i]` is the `i`th traversal distance.
+        """
+        return distance.reachability_order(Y, core_dists, threads=self._threads)
+        
     def fcluster(self, o, d):
         """Find flat clusters from reachability summary.
         
@@ -191,13 +235,15 @@ class HierarchicalClusterEngine:
 class ClassificationClusterEngine(HierarchicalClusterEngine):
     """Cluster using hierarchical clusturing with feature distance ranks and marker taxonomy"""
     
-    def __init__(self, profile, minPts=None, minSize=None, cacher=None):
+    def __init__(self, profile, minPts=None, minSize=None, cacher=None, threads=1, singlePrecision=False):
         if (minSize is None) and (minPts is None):
             raise ValueError("Specify at least one of 'minWt' or 'minPts' parameter values")
         self._profile = profile
         self._minPts = minPts
         self._minSize = minSize
         self._cacher = cacher # None to disable streaming / caching
+        self._threads = threads
+        self._singlePrecision = singlePrecision # store streamed distances as float32
     
     def distances(self, silent=False, fun=lambda a: a):
         if(not silent):
@@ -207,17 +253,11 @@ class ClassificationClusterEngine(HierarchicalClusterEngine):
         if self._cacher is None:
             de = ProfileDistanceEngine()
         else:
-            de = StreamingProfileDistanceEngine(cacher=self._cacher, size=int(2**31-1))
+            de = StreamingProfileDistanceEngine(cacher=self._cacher, size=int(2**31-1), threads=self._threads, singlePrecision=self._singlePrecision)
             de_ = ProfileDistanceEngine()
         
-        # add psuedo-counts
-        #covProfiles = self._profile.covProfiles + 100. / self._profile.contigLengths[:, None]
-        #covProfiles = distance.logratio(covProfiles, axis=1, mode="centered")
-        #kmerSigs = self._profile.kmerSigs + 1. / (self._profile.contigLengths[:, None] - 3)
-        kmerSigs = self._profile.kmerSigs * (self._profile.contigLengths[:, None] - 3) + 1
-        kmerSigs = distance.logratio(kmerSigs, axis=1, mode="centered")
         stat = de.makeRankStat(self._profile.covProfiles,
-                               kmerSigs,
+                               self._getKmerSigs(),
                                self._profile.contigLengths,
                                silent=silent,
                                fun=fun,
@@ -226,6 +266,19 @@ class ClassificationClusterEngine(HierarchicalClusterEngine):
         if not silent:
             print "Reticulating splines"
             
+        core_dists = distance.core_distance(stat, weights=self._profile.contigLengths, minWt=self._getMinWt(), minPts=self._minPts, threads=self._threads)
+        
+        return (stat, core_dists)
+        
+    def _getKmerSigs(self):
+        # add psuedo-counts
+        #covProfiles = self._profile.covProfiles + 100. / self._profile.contigLengths[:, None]
+        #covProfiles = distance.logratio(covProfiles, axis=1, mode="centered")
+        #kmerSigs = self._profile.kmerSigs + 1. / (self._profile.contigLengths[:, None] - 3)
+        kmerSigs = self._profile.kmerSigs * (self._profile.contigLengths[:, None] - 3) + 1
+        return distance.logratio(kmerSigs, axis=1, mode="centered")
+        
+    def _getMinWt(self):
         # Convert the minimum size in bp of a bin to the minimum weighted density
         # used to compute the density distance. For a contig of size L, the sum of
         # nearest neighbour weights will be W=L*{sum of nearest neighbour lengths}. The
@@ -235,19 +288,55 @@ class ClassificationClusterEngine(HierarchicalClusterEngine):
         if self._minSize:
             v = np.full(len(self._profile.contigLengths), self._profile.contigLengths.min())
             #v = contigLengths
-            minWt = np.maximum(self._minSize - v, 0) * v
-        else:
-            minWt = None
-        core_dists = distance.core_distance(stat, weight_fun=lambda i,j: self._profile.contigLengths[i]*self._profile.contigLengths[j], minWt=minWt, minPts=self._minPts)
-        
-        return (stat, core_dists)
+            return np.maximum(self._minSize - v, 0) * v
+        return None
     
     def fcluster(self, o, d):
         Z = hierarchy.linkage_from_reachability(o, d)
         fce = MarkerCheckFCE(self._profile, minPts=self._minPts, minSize=self._minSize)
         bins = fce.makeClusters(Z)
         return bins
+        
+        
+class KNNClassificationClusterEngine(ClassificationClusterEngine):
+    """Cluster using approximate feature distance ranks between nearest
+    neighbours and marker taxonomy. Distances for all pairs of contigs are never
+    computed or stored.
+    """
     
+    def __init__(self, profile, k, minPts=None, minSize=None, threads=1):
+        ClassificationClusterEngine.__init__(self,
+                                             profile,
+                                             minPts=minPts,
+                                             minSize=minSize,
+                                             cacher=None,
+                                             threads=threads)
+        self._k = k
+        
+    def distances(self, silent=False, fun=lambda a: a):
+        """Returns a sparse symmetric matrix of distances between neighbouring
+        contigs, and core distances computed from the neighbour distances."""
+        if(not silent):
+            print "Computing contig distances for %d nearest neighbours" % self._k
+            
+        de = KNNProfileDistanceEngine(self._k, threads=self._threads)
+        stat = de.makeRankStat(self._profile.covProfiles,
+                               self._getKmerSigs(),
+                               self._profile.contigLengths,
+                               silent=silent,
+                               fun=fun,
+                               )
+        
+        if not silent:
+            print "Reticulating splines"
+            
+        core_dists = distance.sparse_core_distance(stat, weights=self._profile.contigLengths, minWt=self._getMinWt(), minPts=self._minPts, threads=self._threads)
+        
+        return (stat, core_dists)
+        
+    def reachabilityOrder(self, G, core_dists):
+        return distance.sparse_reachability_order(G, core_dists)
+        
         
 ###############################################################################
 ###############################################################################
@@ -280,12 +369,118 @@ class ProfileDistanceEngine:
         return dists
         
 
+class KNNProfileDistanceEngine:
+    """Class for computing approximate profile feature distance ranks between
+    nearest neighbours. Ranks are estimated from a random sample of pairwise
+    distances, so that distances are only computed for O(n) pairs.
+    """
+    
+    def __init__(self, k, sampleSize=1000000, threads=1, batchSize=32768, seed=0):
+        self._k = k
+        self._sampleSize = sampleSize
+        self._threads = threads
+        self._batchSize = batchSize
+        self._seed = seed
+        
+    def _neighbours(self, X):
+        """Find pairs `(i, j)` where `j` is among the `k` nearest neighbours of `i`"""
+        n = len(X)
+        k = min(self._k + 1, n)
+        (_, nbrs) = sp_spatial.cKDTree(X).query(X, k=k, n_jobs=self._threads)
+        i = np.repeat(np.arange(n), k)
+        j = np.asarray(nbrs).reshape(n*k)
+        keep = i != j
+        return (i[keep], j[keep])
+        
+    def _samplePairs(self, n):
+        """Uniformly sample pairs of distinct observations"""
+        size = min(self._sampleSize, n * (n - 1) // 2)
+        prng = np.random.RandomState(self._seed)
+        i = prng.randint(n, size=size)
+        j = prng.randint(n - 1, size=size)
+        j[j >= i] += 1
+        return (i, j)
+        
+    def _pairDistances(self, X, i, j):
+        dists = np.empty(len(i), dtype=np.double)
+        for k in range(0, len(i), self._batchSize):
+            diff = X[i[k:k+self._batchSize]] - X[j[k:k+self._batchSize]]
+            dists[k:k+self._batchSize] = np_linalg.norm(diff, axis=1)
+        return dists
+        
+    def _approxRanks(self, X, i, j, sample_i, sample_j, contigLengths):
+        """Estimate the weighted fractional ranks of distances for pairs `(i, j)`
+        among distances for all pairs, using the sampled pairs as a reference.
+        """
+        sample_dists = self._pairDistances(X, sample_i, sample_j)
+        sample_weights = contigLengths[sample_i] * contigLengths[sample_j]
+        perm = sample_dists.argsort()
+        sample_dists = sample_dists[perm]
+        cumweights = np.concatenate(([0.], sample_weights[perm].cumsum()))
+        
+        # total weight for all pairs
+        total = (contigLengths.sum()**2 - (contigLengths**2).sum()) * 0.5
+        dists = self._pairDistances(X, i, j)
+        lower = cumweights[np.searchsorted(sample_dists, dists, side="left")]
+        upper = cumweights[np.searchsorted(sample_dists, dists, side="right")]
+        return (lower + upper) * 0.5 * (total / cumweights[-1]) + 0.5
+        
+    def makeNeighbours(self, covProfiles, kmerSigs):
+        """Find pairs `(i, j)`, `i < j`, of contigs where either contig is among
+        the `k` nearest neighbours of the other in coverage or kmer space.
+        """
+        n = len(covProfiles)
+        (cov_i, cov_j) = self._neighbours(covProfiles)
+        (kmer_i, kmer_j) = self._neighbours(kmerSigs)
+        i = np.concatenate((cov_i, kmer_i))
+        j = np.concatenate((cov_j, kmer_j))
+        keys = np.unique(np.minimum(i, j).astype(np.int64) * n + np.maximum(i, j))
+        return (keys // n, keys % n)
+    
+    def makeRanks(self, covProfiles, kmerSigs, contigLengths, silent=False):
+        """Compute approximate rank distances separately for coverage profiles
+        and kmer signatures for pairs of neighbouring contigs.
+        
+        Returns
+        -------
+        i, j : ndarray
+            1-D arrays of indices of neighbouring contig pairs.
+        cov_ranks, kmer_ranks : ndarray
+            1-D arrays of coverage and kmer rank distances for each pair.
+        """
+        n = len(contigLengths)
+        contigLengths = np.asarray(contigLengths, dtype=np.double)
+        if n < 2:
+            empty = np.array([], dtype=np.intp)
+            return (empty, empty, np.array([]), np.array([]))
+        (i, j) = self.makeNeighbours(covProfiles, kmerSigs)
+        if not silent:
+            print "Estimating distance ranks for %d neighbouring pairs" % len(i)
+        (sample_i, sample_j) = self._samplePairs(n)
+        cov_ranks = self._approxRanks(covProfiles, i, j, sample_i, sample_j, contigLengths)
+        kmer_ranks = self._approxRanks(kmerSigs, i, j, sample_i, sample_j, contigLengths)
+        return (i, j, cov_ranks, kmer_ranks)
+        
+    def makeRankStat(self, covProfiles, kmerSigs, contigLengths, silent=False, fun=lambda a: a):
+        """Compute norms in {coverage rank space x kmer rank space} for pairs of
+        neighbouring contigs, as a sparse symmetric matrix.
+        """
+        n = len(contigLengths)
+        (i, j, cov_ranks, kmer_ranks) = self.makeRanks(covProfiles, kmerSigs, contigLengths, silent=silent)
+        dists = fun(cov_ranks) + fun(kmer_ranks)
+        return sp_sparse.csr_matrix((np.concatenate((dists, dists)),
+                                     (np.concatenate((i, j)), np.concatenate((j, i)))),
+                                    shape=(n, n))
+        
+        
 class StreamingProfileDistanceEngine:
     """Class for computing profile feature distances. Does caching to disk to keep memory usage down."""
 
-    def __init__(self, cacher, size):
+    def __init__(self, cacher, size, threads=1, singlePrecision=False):
         self._cacher = cacher
         self._size = size
+        self._threads = threads
+        self._dtype = np.float32 if singlePrecision else np.double
         self._store = TempFileStore()
             
     def _getWeightFun(self, contigLengths):
@@ -298,14 +493,25 @@ class StreamingProfileDistanceEngine:
             return weights
         return weight_fun
             
+    def _getCacheKeys(self, covProfiles, kmerSigs, contigLengths):
+        """Cache keys for coverage and kmer ranks, from a hash of the feature
+        values, contig lengths used as weights, and distance parameters."""
+        params = dict(metric="euclidean", weights="length_product", dtype=np.dtype(self._dtype).str)
+        return (cache_key("cov", covProfiles, contigLengths, **params),
+                cache_key("kmer", kmerSigs, contigLengths, **params))
+            
     def _calculateRanks(self, covProfiles, kmerSigs, contigLengths, silent=False):
         """Compute pairwise rank distances separately for coverage profiles and
         kmer signatures, and give rank distances as a fraction of the largest rank.
+        
+        Returns the cache keys of the stored ranks.
         """
+        (cov_key, kmer_key) = self._getCacheKeys(covProfiles, kmerSigs, contigLengths)
         n = len(contigLengths)
+        itype = stream.index_dtype(n * (n - 1) // 2)
         weight_fun = None
         try:
-            cov_ranks = self._cacher.get("cov")
+            cov_ranks = self._cacher.get(cov_key)
             assert_num_obs(n, cov_ranks)
         except CacheUnavailableException:
             weight_fun = self._getWeightFun(contigLengths)
@@ -314,13 +520,13 @@ class StreamingProfileDistanceEngine:
             
             cov_filename = self._store.getWorkingFile()
             covind_filename = self._store.getWorkingFile()
-            stream.pdist_chunk(covProfiles, cov_filename, chunk_size=2*self._size, metric="euclidean")
-            cov_ranks = stream.argrank_chunk(cov_filename, covind_filename, weight_fun=weight_fun, chunk_size=self._size)
+            stream.pdist_chunk(covProfiles, cov_filename, chunk_size=2*self._size, threads=self._threads, dtype=self._dtype, metric="euclidean")
+            cov_ranks = stream.argrank_chunk(cov_filename, covind_filename, weight_fun=weight_fun, chunk_size=self._size, dtype=self._dtype, threads=self._threads, itype=itype)
             self._store.cleanupWorkingFiles()
-            self._cacher.store("cov", cov_ranks)
+            self._cacher.store(cov_key, cov_ranks, keep=[kmer_key])
         del cov_ranks
         try:
-            kmer_ranks = self._cacher.get("kmer")
+            kmer_ranks = self._cacher.get(kmer_key)
             assert_num_obs(n, kmer_ranks)
         except CacheUnavailableException:
             if weight_fun is None:
@@ -329,26 +535,27 @@ class StreamingProfileDistanceEngine:
                 print "Calculating tetramer distance ranks"
             kmer_filename = self._store.getWorkingFile()
             kmerind_filename = self._store.getWorkingFile()
-            stream.pdist_chunk(kmerSigs, kmer_filename, chunk_size=2*self._size, metric="euclidean")
-            kmer_ranks = stream.argrank_chunk(kmer_filename, kmerind_filename, weight_fun=weight_fun, chunk_size=self._size)
+            stream.pdist_chunk(kmerSigs, kmer_filename, chunk_size=2*self._size, threads=self._threads, dtype=self._dtype, metric="euclidean")
+            kmer_ranks = stream.argrank_chunk(kmer_filename, kmerind_filename, weight_fun=weight_fun, chunk_size=self._size, dtype=self._dtype, threads=self._threads, itype=itype)
             self._store.cleanupWorkingFiles()
-            self._cacher.store("kmer", kmer_ranks)
+            self._cacher.store(kmer_key, kmer_ranks, keep=[cov_key])
         del kmer_ranks
+        return (cov_key, kmer_key)
     
     def makeRanks(self, covProfiles, kmerSigs, contigLengths, silent=False):
-        self._calculateRanks(covProfiles, kmerSigs, contigLengths, silent=silent)
-        return (self._cacher.get("cov"), self._cacher.get("kmer"))
+        (cov_key, kmer_key) = self._calculateRanks(covProfiles, kmerSigs, contigLengths, silent=silent)
+        return (self._cacher.get(cov_key), self._cacher.get(kmer_key))
     
     def makeRankStat(self, covProfiles, kmerSigs, contigLengths, silent=False, fun=lambda a: a):
         """Compute norms in {coverage rank space x kmer rank space}
         """
-        self._calculateRanks(covProfiles, kmerSigs, contigLengths, silent=silent)
+        (cov_key, kmer_key) = self._calculateRanks(covProfiles, kmerSigs, contigLengths, silent=silent)
         #return self._cacher.get("cov")*self._cacher.get("kmer")
         
         dists_file = self._store.getWorkingFile()
-        fun(self._cacher.get("cov")).tofile(dists_file)
+        fun(self._cacher.get(cov_key)).tofile(dists_file)
         tmp_file = self._store.getWorkingFile()
-        self._cacher.get("kmer").tofile(tmp_file)
+        self._cacher.get(kmer_key).tofile(tmp_file)
         fold = lambda a, b: a+fun(b)
         stream.iapply_func_chunk(dists_file, tmp_file, fold, chunk_size=self._size)
         dists = np.fromfile(dists_file, dtype=np.double)
@@ -382,12 +589,15 @@ class Cacher:
         """
         pass
         
-    def store(self, key, value):
+    def store(self, key, value, keep=[]):
         """
         Parameters
         ----------
         key : string
         value : ndarray
+        keep : sequence of strings
+            Keys of values still in use, which must not be removed to make
+            room for `value`.
         
         """
         pass
@@ -420,52 +630,110 @@ class TempFileStore:
         
         
 class FileCacher(Cacher):
-    """Cache using numpy to/fromfile"""
+    """Cache using numpy to/fromfile. Values for each key are stored in a file
+    named by the prefix and key. When `maxSize` is set, the least recently used
+    files sharing the prefix are removed once their total size in bytes
+    exceeds `maxSize`.
+    """
     
-    def __init__(self, distStorePrefix, keys=['cov', 'kmer']):
+    def __init__(self, distStorePrefix, maxSize=None):
         self._prefix = distStorePrefix
-        self._stores = dict([(k, self._prefix+"."+k) for k in keys])
+        self._maxSize = maxSize
         self._owned = set()
         
+    def _getStore(self, key):
+        return self._prefix+"."+key
+        
     def _cleanupOne(self, filename):
         try:
             os.remove(filename)
         except OSError:
             pass
             
+    def _evict(self, keep):
+        """Remove least recently used files other than those in `keep`"""
+        if self._maxSize is None:
+            return
+        (dirname, basename) = os.path.split(self._prefix)
+        stores = []
+        total = 0
+        for name in os.listdir(dirname or os.curdir):
+            if not name.startswith(basename+"."):
+                continue
+            filename = os.path.join(dirname, name)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            if filename in keep:
+                total += st.st_size
+            else:
+                stores.append((st.st_mtime, st.st_size, filename))
+        for (_, size, filename) in sorted(stores, reverse=True):
+            total += size
+            if total > self._maxSize:
+                self._cleanupOne(filename)
+                total -= size
+            
     def get(self, key):
+        filename = self._getStore(key)
         try:
-            vals = np.fromfile(self._stores[key], dtype=np.double)
+            vals = np.fromfile(filename, dtype=np.double)
         except IOError:
             raise CacheUnavailableException()
+        try:
+            # mark as recently used
+            os.utime(filename, None)
+        except OSError:
+            pass
         return vals
         
-    def store(self, key, values):
-        if not os.path.lexists(self._stores[key]):
+    def store(self, key, values, keep=[]):
+        filename = self._getStore(key)
+        if not os.path.lexists(filename):
             self._owned.add(key)
-        np.asanyarray(values, dtype=np.double).tofile(self._stores[key])
+        np.asanyarray(values, dtype=np.double).tofile(filename)
+        self._evict(keep=set([filename] + [self._getStore(k) for k in keep]))
         
     def cleanup(self, silent=False):
         for key in self._owned:
             if not silent:
-                print("removing distance store {0}".format(self._stores[key]))
-            self._cleanupOne(self._stores[key]) 
+                print("removing distance store {0}".format(self._getStore(key)))
+            self._cleanupOne(self._getStore(key)) 
         
         
         
 class TablesCacher(Cacher):
-    """Cache using pytable"""
+    """Cache using pytable. When `maxSize` is set, the least recently used
+    arrays are removed once their total size in bytes exceeds `maxSize`.
+    """
 
-    def __init__(self, distStore, keys=["cov", "kmer"], descriptions=["Coverage distances", "Tetramer distances"]):
+    def __init__(self, distStore, maxSize=None):
         self._distStoreFile = distStore
+        self._maxSize = maxSize
         try:
             with tables.open_file(self._distStoreFile, mode="a", title="Distance store") as h5file:
                 pass
         except:
             print "Error creating database:", self._distStoreFile, sys.exc_info()[0]
             raise
-        self._tables = dict(zip(keys, descriptions))
         
+    def _evict(self, h5file, keep):
+        """Remove least recently used arrays other than those in `keep`"""
+        if self._maxSize is None:
+            return
+        nodes = []
+        total = 0
+        for node in h5file.list_nodes("/"):
+            if node._v_name in keep:
+                total += node.size_on_disk
+            else:
+                nodes.append((getattr(node._v_attrs, "last_used", 0), node.size_on_disk, node))
+        for (_, size, node) in sorted(nodes, key=lambda t: t[0], reverse=True):
+            total += size
+            if total > self._maxSize:
+                node._f_remove()
+                total -= size
             
     def cleanup(self):
         try:
@@ -475,18 +743,37 @@ class TablesCacher(Cacher):
     
     def get(self, key):
         try:
-            with tables.open_file(self._distStoreFile, mode="r") as h5file:
-                vals = h5file.get_node("/", key).read()
+            with tables.open_file(self._distStoreFile, mode="a") as h5file:
+                node = h5file.get_node("/", key)
+                vals = node.read()
+                node._v_attrs.last_used = time.time()
         except tables.exceptions.NoSuchNodeError:
             raise CacheUnavailableException()
         return vals
         
-    def store(self, key, values):
+    def store(self, key, values, keep=[]):
         with tables.open_file(self._distStoreFile, mode="a") as h5file:
-            h5file.create_array("/", key, values, self._tables[key])
+            try:
+                h5file.remove_node("/", key)
+            except tables.exceptions.NoSuchNodeError:
+                pass
+            node = h5file.create_array("/", key, values, "Distance ranks")
+            node._v_attrs.last_used = time.time()
+            self._evict(h5file, keep=set([key] + list(keep)))
 
         
-
+def cache_key(name, *arrays, **params):
+    """Content-addressed cache key for values computed from input arrays and
+    parameters."""
+    h = hashlib.sha1()
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        h.update(str((a.dtype.str, a.shape)))
+        h.update(a.view(np.uint8).data if a.size > 0 else "")
+    h.update(repr(sorted(params.items())))
+    return "{0}_{1}".format(name, h.hexdigest())
+    
+    
 def assert_num_obs(n, y):
     if n != sp_distance.num_obs_y(y):
         raise SavedDistancesInvalidNumberException("Saved distances for different number of observations")
@@ -798,6 +1085,65 @@ class ClusterQualityEngine:
         pass # subclass to override
         
         
+class _MarkerCheckCluster:
+    """Per taxonomy group marker counts and pairing probability sums for a
+    cluster of mappings, constructed by MarkerCheckCQE.
+    
+    Rows are kept in arrays that grow by doubling, keyed by group, so that
+    merging a smaller cluster in does not copy the rows of the larger one.
+    
+    Fields
+    ------
+    rows : dict
+        `rows[g]` is the row of group `g`.
+    size : int
+        Number of rows in use.
+    groups : ndarray
+        `groups[r]` is the group of row `r`.
+    n : ndarray
+        `n[r, k]` is the number of member mappings in the group of row `r`
+        that map to marker `k`.
+    N : ndarray
+        `N[r, k]` is the number of member mappings connected to the group of
+        row `r` that map to marker `k`.
+    S, T : ndarray
+        `S[r]` and `T[r]` are the sums of pairing probabilities and scaled
+        pairing probabilities of member mappings in the group of row `r`.
+    numMembers : int
+        Number of member mappings.
+    probSum, scaledSum : float
+        Sums of `S` and `T` over rows in use.
+    """
+    
+    def __init__(self, numMarkers):
+        self.rows = {}
+        self.size = 0
+        self.groups = np.empty(1, dtype=np.intp)
+        self.n = np.zeros((1, numMarkers), dtype=np.int32)
+        self.N = np.zeros((1, numMarkers), dtype=np.int32)
+        self.S = np.zeros(1)
+        self.T = np.zeros(1)
+        self.numMembers = 0
+        self.probSum = 0.
+        self.scaledSum = 0.
+        
+    def addGroup(self, group, n, N, S, T):
+        """Add a row for a group and return the row index"""
+        if self.size == len(self.groups):
+            for name in ["groups", "n", "N", "S", "T"]:
+                old = getattr(self, name)
+                new = np.zeros((2*len(old),) + old.shape[1:], dtype=old.dtype)
+                new[:len(old)] = old
+                setattr(self, name, new)
+        r = self.size
+        (self.groups[r], self.n[r], self.N[r], self.S[r], self.T[r]) = (group, n, N, S, T)
+        self.rows[group] = r
+        self.size += 1
+        self.probSum += S
+        self.scaledSum += T
+        return r
+        
+        
 class MarkerCheckCQE(ClusterQualityEngine):
     """Cluster quality scores using taxonomy and marker completeness.
     
@@ -832,25 +1178,184 @@ class MarkerCheckCQE(ClusterQualityEngine):
         self._alpha = 0.5
         self._mapping = profile.mapping
         
-        # Taxonomic connectivity matrix: L[i,j] = 1 where mapping i and j are 
-        # taxonomically 'similar enough', otherwise 0.
-        self._L = sp_distance.squareform(self._mapping.classification.makeDistances()) < self._d
-        
-        # Marker connectivity matrix: M[i, j] = 1 where mapping i and j are
-        # from the same marker, otherwise 0.
-        markerNames = self._mapping.markerNames
-        self._M = markerNames[:, None] == markerNames[None, :]
-        
-        # Compute the compatible marker group sizes
-        gsizes = np.array([np.count_nonzero(row) for row in self._L])
-        gweights = np.array([np.unique(markerNames[row], return_counts=True)[1].max() for row in self._L])
-        #self._gscalefactors = gweights * 1. / gsizes
-        self._gscalefactors = 1. / self._getProbs(self._L, self._M)
-        self._gscalefactors_ = 1. / np.array([ (1. / np.maximum(self._M[i, row].sum(), self._M[np.ix_(row, row)].sum(axis=1))).sum() for (i, row) in enumerate(self._L)])
-        assert np.all(self._gscalefactors == self._gscalefactors_)
+        # Taxonomic connectivity: mappings i and j are connected where
+        # taxonomically 'similar enough'.
+        self._connectivity = TaxonomicConnectivity(self._mapping.classification._table, d=self._d)
+        
+        # Marker index of each mapping
+        (_, self._markers) = np.unique(self._mapping.markerNames, return_inverse=True)
+        
+        # Compute the compatible marker group sizes from the marker counts of
+        # taxonomically similar mappings
+        probs = np.empty(len(self._markers))
+        for (indices, counts) in self._connectivity.iterNeighbourCounts(self._markers):
+            probs[indices] = self._getCountProbs(counts, self._markers[indices])
+        self._gscalefactors = 1. / probs
+        
+        # Mappings with the same taxonomy group and marker share scale factors
+        self._groups = self._connectivity.groups()
+        self._numMarkers = self._markers.max()+1 if len(self._markers) > 0 else 0
+        (self._groupKeys, first) = np.unique(self._groups * self._numMarkers + self._markers, return_index=True)
+        self._groupScales = self._gscalefactors[first]
     
     def _getProbs(self, L, M):
         return np.array([ (1. / np.maximum(M[i, row].sum(), M[np.ix_(row, row)].sum(axis=1))).sum() for (i, row) in enumerate(L)])
+        
+    def _getCountProbs(self, counts, markers):
+        """Pairing probabilities from counts of markers of taxonomically similar
+        mappings.
+        
+        Equivalent to `_getProbs`, where `counts[i, k]` is the number of
+        mappings in row `i` of `L` that map to marker `k`. The sum over the
+        row of `1 / max(c_i, c_k)` with `c_i` the count of the marker of
+        mapping `i`, is computed as the sum of counts no larger than `c_i`
+        divided by `c_i`, plus the number of larger counts.
+        """
+        own_counts = counts[np.arange(len(markers)), markers][:, None]
+        is_larger = counts > own_counts
+        return (np.where(is_larger, 0, counts).sum(axis=1) * 1. / own_counts[:, 0] +
+                is_larger.sum(axis=1))
+        
+    def makeScores(self, Z):
+        """Compute coefficients for hierarchical clustering
+        
+        Scores are identical to those of `ClusterQualityEngine.makeScores`
+        using `getScore`, but are computed incrementally. Mappings that share a
+        taxonomy group and marker have the same pairing probability within a
+        cluster, so for each cluster we keep, per taxonomy group, the counts
+        of markers of member mappings and of connected member mappings, along
+        with sums of pairing probabilities. When two clusters merge, the
+        groups of the smaller cluster are merged into the larger one, and only
+        the groups with new connected pairs are updated.
+        """
+        Z = np.asarray(Z)
+        n = Z.shape[0]+1
+        
+        coeffs = np.zeros(2*n-1, dtype=float)
+        
+        # { cluster_id : _MarkerCheckCluster }
+        # clusters are identified with their largest subcluster
+        self._clusters = {}
+        node_clusters = {}
+        
+        # Compute leaf clusters
+        for (i, leaf_data) in self.getLeafData().iteritems():
+            cid = reduce(self._merge, [self._makeCluster(j) for j in leaf_data])
+            node_clusters[i] = cid
+            coeffs[i] = self._getClusterScore(cid)
+        
+        # Bottom-up traversal of hierarchy, merging clusters of children and
+        # computing the score for each node with data from both children
+        for i in range(n-1):
+            left_child = int(Z[i, 0])
+            right_child = int(Z[i, 1])
+            current_node = n+i
+            left_cid = node_clusters.pop(left_child, None)
+            right_cid = node_clusters.pop(right_child, None)
+            
+            if left_cid is None:
+                coeffs[current_node] = coeffs[right_child]
+                cid = right_cid
+            elif right_cid is None:
+                coeffs[current_node] = coeffs[left_child]
+                cid = left_cid
+            else:
+                cid = self._merge(left_cid, right_cid)
+                coeffs[current_node] = self._getClusterScore(cid)
+            if cid is not None:
+                node_clusters[current_node] = cid
+            
+        del self._clusters
+        return coeffs
+        
+    def _makeCluster(self, i):
+        """Create a cluster for a single mapping and return its id"""
+        g = self._groups[i]
+        member_counts = np.zeros(self._numMarkers, dtype=np.int32)
+        member_counts[self._markers[i]] = 1
+        connected_counts = member_counts if self._connectivity.groupIsOpen(g) else np.zeros_like(member_counts)
+        cluster = _MarkerCheckCluster(self._numMarkers)
+        cluster.addGroup(g, member_counts, connected_counts, 1., self._gscalefactors[i])
+        cluster.numMembers = 1
+        self._clusters[i] = cluster
+        return i
+        
+    def _merge(self, cid_a, cid_b):
+        """Merge two clusters and return the id of the merged cluster
+        
+        The cluster with fewer mappings is merged into the larger one. Only
+        groups of the larger cluster connected to groups of the smaller one
+        are visited, using the connected groups above each group and the
+        range of connected groups below it.
+        """
+        a = self._clusters.pop(cid_a)
+        b = self._clusters.pop(cid_b)
+        if a.numMembers < b.numMembers:
+            (cid_a, a, cid_b, b) = (cid_b, b, cid_a, a)
+        
+        # add counts of newly connected mappings
+        groups_b = b.groups[:b.size]
+        above = self._connectivity.connectedGroupsAbove(groups_b)
+        (starts, ends) = self._connectivity.connectedGroupRanges(groups_b)
+        changed = set()
+        is_changed_b = np.zeros(b.size, dtype=bool)
+        for j in range(b.size):
+            rows = [a.rows[g] for g in above[j] if g in a.rows]
+            if ends[j] - starts[j] <= a.size:
+                rows.extend([a.rows[g] for g in xrange(starts[j], ends[j]) if g in a.rows])
+            else:
+                groups_a = a.groups[:a.size]
+                rows.extend(np.flatnonzero(np.logical_and(groups_a >= starts[j], groups_a < ends[j])))
+            if len(rows) == 0:
+                continue
+            rows = np.array(rows, dtype=np.intp)
+            b.N[j] += a.n[rows].sum(axis=0)
+            a.N[rows] += b.n[j]
+            changed.update(rows)
+            is_changed_b[j] = True
+            
+        # combine groups in both clusters
+        for j in range(b.size):
+            r = a.rows.get(groups_b[j])
+            if r is None:
+                r = a.addGroup(groups_b[j], b.n[j], b.N[j], b.S[j], b.T[j])
+                if is_changed_b[j]:
+                    changed.add(r)
+            else:
+                a.n[r] += b.n[j]
+                changed.add(r)
+        a.numMembers += b.numMembers
+        
+        if len(changed) > 0:
+            changed = np.fromiter(changed, dtype=np.intp, count=len(changed))
+            (S, T) = self._getGroupSums(a.groups[changed], a.n[changed], a.N[changed])
+            a.probSum += (S - a.S[changed]).sum()
+            a.scaledSum += (T - a.T[changed]).sum()
+            (a.S[changed], a.T[changed]) = (S, T)
+        self._clusters[cid_a] = a
+        return cid_a
+        
+    def _getGroupSums(self, groups, n, N):
+        """Sums of pairing probabilities and scaled pairing probabilities of
+        member mappings in each group of a cluster, from counts of markers of
+        member mappings `n` and connected member mappings `N`.
+        """
+        (rows, markers) = np.nonzero(n)
+        counts = N[rows]
+        # mappings in groups that are not open are connected to themselves
+        is_closed = ~self._connectivity.groupIsOpen(groups[rows])
+        counts[is_closed, markers[is_closed]] += 1
+        weighted = n[rows, markers] * self._getCountProbs(counts, markers)
+        scales = self._groupScales[np.searchsorted(self._groupKeys, groups[rows] * self._numMarkers + markers)]
+        return (np.bincount(rows, weighted, minlength=len(groups)),
+                np.bincount(rows, weighted * scales, minlength=len(groups)))
+        
+    def _getClusterScore(self, cid):
+        """Compute modified BCubed score for a cluster from probability sums"""
+        cluster = self._clusters[cid]
+        prec = cluster.probSum * 1. / cluster.numMembers
+        recall = cluster.scaledSum
+        return self._alpha * recall + (1 - self._alpha) * prec
     
     def getLeafData(self):
         """Leaf data is a list of indices of mappings."""
@@ -860,16 +1365,14 @@ class MarkerCheckCQE(ClusterQualityEngine):
         """Compute modified BCubed completeness and precision scores."""
         indices = np.asarray(indices)
         
-        probs = self._getProbs(self._L[np.ix_(indices, indices)], self._M[np.ix_(indices, indices)])
-        #probs = np.array([ (1. / np.maximum(self._M[i, indices[row]].sum(), self._M[np.ix_(indices[row], indices[row])].sum(axis=1))).sum() for (i, row) in enumerate(self._L[np.ix_(indices, indices)])])
+        markers = self._markers[indices]
+        probs = self._getProbs(self._connectivity.connected(indices), markers[:, None] == markers[None, :])
         
         # weighted item precision
         prec = (probs * 1. / len(indices)).sum()
-        #prec = np.sum([weights[i] * (weights[self._L[index, indices]].sum() + 1 - weights[i]) * 1. / len(indices) for (i, index) in enumerate(indices)])
         
         # weighted item completeness / recall
         recall = (probs * self._gscalefactors[indices]).sum()
-        #recall = np.sum([weights[i] * (weights[self._L[index, indices]].sum() + 1 - weights[i]) * self._gscalefactors[index] for (i, index) in enumerate(indices)])
         
         f = self._alpha * recall + (1 - self._alpha) * prec
         return f
@@ -45,11 +45,15 @@ __license__ = "GPL3"
 __maintainer__ = "Tim Lamberton"
 __email__ = "t.lamberton@uq.edu.au"
 
-__current_GMDB_version__ = 6
+__current_GMDB_version__ = 7
 
 ###############################################################################
 
 import sys
+import os
+from contextlib import contextmanager
+from itertools import islice
+from multiprocessing import Pool
 from os.path import splitext as op_splitext, basename as op_basename
 from string import maketrans as s_maketrans
 
@@ -59,9 +63,9 @@ import numpy.linalg as np_linalg
 import tempdir
 
 # GroopM imports
-from utils import CSVReader, FastaReader
+from utils import CSVReader, FastaReader, lookup_indices
 from map import SingleMMapper, GraftMMapper
-from groopmExceptions import BadTaxonomicStringException
+from groopmExceptions import BadTaxonomicStringException, DBReadOnlyException
 
 # BamM imports
 try:
@@ -112,8 +116,11 @@ class DataManager:
     #group = '/profile'
     #------------------------
     # **Kmer Signature**
+    #[version < 7]
     #table = 'kms'
     kms_desc = lambda self, mers: [(mer, float) for mer in mers]
+    #[version >= 7]
+    #array = 'kms'                              # float, numCons x numMers
     #
     # **Kmer Vals**
     #[version < 6] 
@@ -121,8 +128,11 @@ class DataManager:
     #kpca_desc = lambda n: [('pc%d' % i, float) for i in range(n)]
     #
     # **Coverage profile**
+    #[version < 7]
     #table = 'coverage'
     coverage_desc = lambda self, cols: [(col, float) for col in cols]
+    #[version >= 7]
+    #array = 'coverage'                         # float, numCons x numStoits
     #
     # **Transformed coverage profile**
     #[version < 6]
@@ -132,6 +142,13 @@ class DataManager:
     # **Coverage profile norms**
     #table = 'normCoverage'
     normCoverage_desc = [('normCov', float)]
+    #
+    # **Profile array storage**
+    #[version >= 7]
+    # Profile arrays are Blosc compressed and chunked by whole rows, so that
+    # reading a block of contigs decompresses a contiguous run of chunks
+    profile_filters = tables.Filters(complevel=5, complib='blosc', shuffle=True)
+    profile_chunk_bytes = 1 << 16
     #     
     #------------------------
     # LINKS
@@ -232,13 +249,16 @@ class DataManager:
     #[version < 6]
     #table = 'transCoverageCorners'
     #transCoverageCorners_desc = [('x', float), ('y', float), ('z', float)]
+    
+    def __init__(self):
+        self._handles = {} # open read handles keyed by DB file name
                              
 
 #------------------------------------------------------------------------------
 # DB CREATION / INITIALISATION
 
     def createDB(self, timer, bamFiles, contigsFile, dbFileName, cutoff, kmerSize=4, markerFile=None, 
-            workingDirectory=None, graftmPackageList=None, force=False, threads=1):
+            workingDirectory=None, graftmPackageList=None, force=False, threads=1, batchSize=10000):
         """Main wrapper for parsing all input files"""
         
         # make sure we're only overwriting existing DBs with the users consent
@@ -263,6 +283,9 @@ class DataManager:
                         graftm_package_list=graftmPackageList,
                         marker_file=markerFile)
         
+        # kmer signatures are staged here in file order
+        tmp_file_name = dbFileName+".kms.tmp"
+        
         # create the db
         try:
             with tables.open_file(dbFileName, mode = "w", title = "GroopM") as h5file:
@@ -280,6 +303,9 @@ class DataManager:
                 #
                 # Before writing to the database we will remove any of them having
                 # 0 coverage @ all stoits.
+                #
+                # Kmer signatures are streamed in batches to a staging file
+                # and copied to the database in contig order at the end.
                 #------------------------
                 import mimetypes
                 GM_open = open
@@ -294,7 +320,13 @@ class DataManager:
                     raise
                 with GM_open(contigsFile, "r") as f:
                     try:
-                        (con_names, con_gcs, con_lengths, con_ksigs) = conParser.parse(f, cutoff, kse)
+                        with open(tmp_file_name, "wb") as tmp_f:
+                            (con_names, con_gcs, con_lengths, con_rows) = conParser.parseToFile(f,
+                                                                                                cutoff,
+                                                                                                kse,
+                                                                                                tmp_f,
+                                                                                                threads=threads,
+                                                                                                batchSize=batchSize)
                         num_cons = len(con_names)
                     except:
                         print "Error parsing contigs"
@@ -308,9 +340,8 @@ class DataManager:
                                                                                   con_names,
                                                                                   cid_2_indices,
                                                                                   threads)
-                tot_cov = [sum(profile) for profile in cov_profiles]
-                good_indices = [i for (i, cov) in enumerate(tot_cov) if cov > 0]
-                bad_indices = [i for i in range(num_cons) if i not in good_indices]
+                is_good = cov_profiles.sum(axis=1) > 0
+                bad_indices = np.flatnonzero(~is_good)
 
                 if len(bad_indices) > 0:
                     # report the bad contigs to the user
@@ -325,13 +356,13 @@ class DataManager:
                       print '(+ %d additional contigs)' % (len(bad_indices)-5)
                     print "****************************************************************"
 
-                    con_names = con_names[good_indices]
-                    con_lengths = con_lengths[good_indices]
-                    con_gcs = con_gcs[good_indices]
-                    cov_profiles = cov_profiles[good_indices]
-                    con_ksigs = con_ksigs[good_indices]
+                    con_names = con_names[is_good]
+                    con_lengths = con_lengths[is_good]
+                    con_gcs = con_gcs[is_good]
+                    cov_profiles = cov_profiles[is_good]
+                    con_rows = con_rows[is_good]
 
-                num_cons = len(good_indices)
+                num_cons = len(con_names)
                 cid_2_indices = dict(zip(con_names, range(num_cons)))
                 
                 #------------------------
@@ -345,28 +376,34 @@ class DataManager:
                 #------------------------
                 # write kmer sigs
                 #------------------------
-                # store the raw calculated kmer sigs in one table
-                kms_data = np.array([tuple(i) for i in con_ksigs], dtype=self.kms_desc(kse.kmerCols))
-                h5file.create_table(profile_group,
-                                    'kms',
-                                    kms_data,
-                                    title='Kmer signatures',
-                                    expectedrows=num_cons
-                                    )
+                # store the raw calculated kmer sigs in one array
+                kms = self._createProfileArray(h5file,
+                                               profile_group,
+                                               'kms',
+                                               [],
+                                               len(kse.kmerCols),
+                                               title='Kmer signatures',
+                                               expectedrows=num_cons
+                                               )
+                if num_cons > 0:
+                    tmp_ksigs = np.memmap(tmp_file_name, dtype=np.float64, mode="r").reshape(-1, len(kse.kmerCols))
+                    for start in range(0, num_cons, batchSize):
+                        kms.append(tmp_ksigs[con_rows[start:start+batchSize]])
+                    del tmp_ksigs
 
                 #------------------------
                 # write cov profiles
                 #------------------------
-                # build a table template based on the number of bamfiles we have
+                # one column per bamfile
                 # _get_bam_descriptor rips off the ".bam" part of bam filenames
                 stoitColNames = np.array([_get_bam_descriptor(bf, i+1) for (i, bf) in enumerate(ordered_bamFiles)])
-                coverage_data = np.array([tuple(i) for i in cov_profiles], dtype=self.coverage_desc(stoitColNames))
-                h5file.create_table(profile_group,
-                                    'coverage',
-                                    coverage_data,
-                                    title="Bam based coverage",
-                                    expectedrows=num_cons
-                                    )
+                self._createProfileArray(h5file,
+                                         profile_group,
+                                         'coverage',
+                                         cov_profiles,
+                                         len(stoitColNames),
+                                         title="Bam based coverage"
+                                         )
 
                 # coverage norms
                 norm_coverages = np.linalg.norm(cov_profiles, axis=1)
@@ -495,6 +532,11 @@ class DataManager:
         except:
             print "Error creating database:", dbFileName, sys.exc_info()[0]
             raise
+        finally:
+            try:
+                os.remove(tmp_file_name)
+            except OSError:
+                pass
 
         print "****************************************************************"
         print "Data loaded successfully!"
@@ -538,6 +580,7 @@ class DataManager:
         if __current_GMDB_version__ == this_DB_version:
             if not silent:
                 print "    GroopM DB version (%s) up to date" % this_DB_version
+            self.recoverBinAssignments(dbFileName)
             return
 
         # now, if we get here then we need to do some work
@@ -548,6 +591,7 @@ class DataManager:
         upgrade_tasks[(3,4)] = self.upgradeDB_3_to_4
         upgrade_tasks[(4,5)] = self.upgradeDB_4_to_5
         upgrade_tasks[(5,6)] = self.upgradeDB_5_to_6
+        upgrade_tasks[(6,7)] = self.upgradeDB_6_to_7
 
         # we need to apply upgrades in order!
         # keep applying the upgrades as long as we need to
@@ -1142,8 +1186,108 @@ class DataManager:
             h5file.rename_node("/", "meta", "tmp_meta", overwrite=True)
         print "*******************************************************************************"
 
+    def upgradeDB_6_to_7(self, dbFileName):
+        """Upgrade a GM db from version 6 to version 7"""
+        print "*******************************************************************************\n"
+        print "              *** Upgrading GM DB from version 6 to version 7 ***"
+        print ""
+        print "                            please be patient..."
+        print ""
+        # the changes in this version are as follows:
+        #   profiles/kms table stored as a compressed array
+        #   profiles/coverage table stored as a compressed array
+        print "    Compressing kmer signature and coverage profiles"
+        
+        con_ksigs = self.getKmerSigs(dbFileName)
+        cov_profiles = self.getCoverages(dbFileName)
+        
+        with tables.open_file(dbFileName, mode='a', root_uep="/") as h5file:
+            profile_group = h5file.get_node("/", "profile")
+            
+            for (name, data, title) in [("kms", con_ksigs, "Kmer signatures"),
+                                        ("coverage", cov_profiles, "Bam based coverage")]:
+                try:
+                    h5file.remove_node(profile_group, "tmp_"+name)
+                except:
+                    pass
+                
+                self._createProfileArray(h5file,
+                                         profile_group,
+                                         "tmp_"+name,
+                                         data,
+                                         data.shape[1],
+                                         title=title
+                                         )
+                h5file.rename_node(profile_group, name, "tmp_"+name, overwrite=True)
+            
+        # update the formatVersion field and we're done
+        with tables.open_file(dbFileName, mode='a', root_uep="/meta") as h5file:
+            meta = h5file.root.meta.read()
+            meta[0]["formatVersion"] = 7
+            try:
+                h5file.remove_node("/", "tmp_meta")
+            except:
+                pass
+                
+            h5file.create_table("/",
+                                "tmp_meta",
+                                meta,
+                                title="Descriptive data",
+                                expectedrows=1
+                                )
+                                
+            h5file.rename_node("/", "meta", "tmp_meta", overwrite=True)
+            
+        # HDF5 does not reclaim the space of removed nodes, so copy the
+        # DB to drop the old tables
+        tmp_file = dbFileName+".tmp"
+        tables.copy_file(dbFileName, tmp_file, overwrite=True)
+        os.rename(tmp_file, dbFileName)
+        print "*******************************************************************************"
+
 #------------------------------------------------------------------------------
 # GET TABLES - GENERIC
+
+    @contextmanager
+    def openDB(self, dbFileName, mode='r'):
+        """Hold the DB open for the duration of a block
+        
+        Getters and setters called within the block share a single file
+        handle. Nested blocks reuse the open handle, so the outermost block
+        must be opened with mode 'a' if anything within it writes to the DB.
+        Writing within a read-only block raises DBReadOnlyException.
+        """
+        if self.isOpen(dbFileName):
+            yield self._getHandle(dbFileName, mode)
+            return
+        self._handles[dbFileName] = tables.open_file(dbFileName, mode)
+        try:
+            yield self._handles[dbFileName]
+        finally:
+            self._handles.pop(dbFileName).close()
+            
+    def isOpen(self, dbFileName):
+        """Is there an open handle for this DB?"""
+        return dbFileName in self._handles
+            
+    def _getHandle(self, dbFileName, mode='r'):
+        """Open handle for the DB, checked to allow writes if needed"""
+        h5file = self._handles[dbFileName]
+        if mode != 'r' and h5file.mode == 'r':
+            raise DBReadOnlyException("Database '%s' is open read-only" % dbFileName)
+        return h5file
+            
+    @contextmanager
+    def _openGroup(self, dbFileName, where, mode='r'):
+        """Group node of the DB, using an open handle when available"""
+        if self.isOpen(dbFileName):
+            h5file = self._getHandle(dbFileName, mode)
+            yield h5file.get_node(where)
+            if mode != 'r':
+                h5file.flush()
+        else:
+            with tables.open_file(dbFileName, mode) as h5file:
+                yield h5file.get_node(where)
             
     def iterrows(self, table, rows):
         """iterate selected rows of table"""
@@ -1152,46 +1296,104 @@ class DataManager:
         else:
             return (x.fetch_all_fields() for x in table)
             
+    def readRows(self, table, rows=[], field=None):
+        """Read selected rows of table, or of a single field, into an array"""
+        if(len(rows) != 0):
+            return table.read_coordinates(np.asarray(rows, dtype=np.int64), field=field)
+        else:
+            return table.read(field=field)
+            
+    def readMatrix(self, table, rows=[]):
+        """Read selected rows of table into a 2-D array with a column per field"""
+        data = self.readRows(table, rows)
+        names = data.dtype.names
+        out = np.empty((len(data), len(names)), dtype=np.result_type(*[data.dtype[name] for name in names]))
+        for (i, name) in enumerate(names):
+            out[:, i] = data[name]
+        return out
+        
+    def readArray(self, array, rows=[]):
+        """Read selected rows of a profile array
+        
+        Rows are read in contiguous blocks, merging runs separated by less
+        than a chunk. Profiles stored as row tables [version < 7] are read
+        with readMatrix.
+        """
+        if isinstance(array, tables.Table):
+            return self.readMatrix(array, rows)
+        if(len(rows) == 0):
+            return array.read()
+        (urows, inverse) = np.unique(np.asarray(rows, dtype=np.int64), return_inverse=True)
+        gap = 1 if array.chunkshape is None else array.chunkshape[0]
+        blocks = np.split(urows, np.flatnonzero(np.diff(urows) > gap) + 1)
+        data = np.concatenate([array.read(block[0], block[-1]+1)[block - block[0]] for block in blocks])
+        return data[inverse]
+        
+    def _createProfileArray(self, h5file, where, name, data, numCols, title="", expectedrows=None):
+        """Store a profile matrix as a compressed array chunked by whole rows"""
+        data = np.asarray(data, dtype=np.float64).reshape(-1, numCols)
+        if expectedrows is None:
+            expectedrows = len(data)
+        chunk_rows = max(1, self.profile_chunk_bytes // (8 * numCols))
+        array = h5file.create_earray(where,
+                                     name,
+                                     atom=tables.Float64Atom(),
+                                     shape=(0, numCols),
+                                     title=title,
+                                     filters=self.profile_filters,
+                                     chunkshape=(chunk_rows, numCols),
+                                     expectedrows=max(expectedrows, 1)
+                                     )
+        array.append(data)
+        return array
+        
+    def readStrings(self, table, rows=[], field=None):
+        """Read a string field, trimming the string size to the longest value"""
+        data = self.readRows(table, rows, field=field)
+        if len(data) == 0:
+            return data
+        return data.astype("S%d" % max(np.char.str_len(data).max(), 1))
+            
 #------------------------------------------------------------------------------
 # GET TABLES - PROFILES
 
     def getKmerSigs(self, dbFileName, indices=[]):
         """Load columns from kmer sig profile"""
-        with tables.open_file(dbFileName, 'r', root_uep='/profile') as h5file:
-            return np.array([list(x) for x in self.iterrows(h5file.root.kms, indices)])
+        with self._openGroup(dbFileName, "/profile") as group:
+            return self.readArray(group.kms, indices)
         
     def getCoverages(self, dbFileName, indices=[]):
         """Load columns from coverage profile"""
-        with tables.open_file(dbFileName, 'r', root_uep='/profile') as h5file:
-            return np.array([list(x) for x in self.iterrows(h5file.root.coverage, indices)])
+        with self._openGroup(dbFileName, "/profile") as group:
+            return self.readArray(group.coverage, indices)
         
     def getNormCoverages(self, dbFileName, indices=[]):
         """Load columns for coverage norms"""
-        with tables.open_file(dbFileName, 'r', root_uep='/profile') as h5file:
-            return np.array([list(x) for x in self.iterrows(h5file.root.normCoverage, indices)])
+        with self._openGroup(dbFileName, "/profile") as group:
+            return self.readMatrix(group.normCoverage, indices)
 
 #------------------------------------------------------------------------------
 # GET TABLES - MAPPINGS
 
     def getMappingContigs(self, dbFileName):
         """Load mapping contig indices"""
-        with tables.open_file(dbFileName, "r", root_uep="/mappings") as h5file:
-            return np.array([x for x in h5file.root.mappings.cols.contig])
+        with self._openGroup(dbFileName, "/mappings") as group:
+            return self.readRows(group.mappings, field="contig")
             
     def getMappingMarkers(self, dbFileName):
         """Load mapping marker ids"""
-        with tables.open_file(dbFileName, "r", root_uep="/mappings") as h5file:
-            return np.array([x for x in h5file.root.mappings.cols.marker])
+        with self._openGroup(dbFileName, "/mappings") as group:
+            return self.readRows(group.mappings, field="marker")
             
     def getMappingTaxstrings(self, dbFileName):
         """Load mapping contig indices"""
-        with tables.open_file(dbFileName, "r", root_uep="/mappings") as h5file:
-            return np.array([x for x in h5file.root.mappings.cols.taxstring])
+        with self._openGroup(dbFileName, "/mappings") as group:
+            return self.readStrings(group.mappings, field="taxstring")
             
     def getClassification(self, dbFileName):
         """Load classification table"""
-        with tables.open_file(dbFileName, "r", root_uep="/mappings") as h5file:
-            return np.array([list(x.fetch_all_fields()) for x in h5file.root.classification])
+        with self._openGroup(dbFileName, "/mappings") as group:
+            return self.readMatrix(group.classification)
            
 #------------------------------------------------------------------------------
 # GET LINKS
@@ -1222,28 +1424,28 @@ class DataManager:
         """return the indices into the db which meet the condition"""
         if('' == condition):
             condition = "cid != ''" # no condition breaks everything!
-        with tables.open_file(dbFileName, 'r', root_uep="/meta") as h5file:
-            return np.array([x.nrow for x in h5file.root.contigs.where(condition)])
+        with self._openGroup(dbFileName, "/meta") as group:
+            return group.contigs.get_where_list(condition)
 
     def getContigNames(self, dbFileName, indices=[]):
         """Load contig names"""
-        with tables.open_file(dbFileName, 'r', root_uep="/meta") as h5file:
-            return np.array([x["cid"] for x in self.iterrows(h5file.root.contigs,  indices)])
+        with self._openGroup(dbFileName, "/meta") as group:
+            return self.readStrings(group.contigs, indices, field="cid")
         
     def getBins(self, dbFileName, indices=[]):
         """Load bin assignments"""
-        with tables.open_file(dbFileName, 'r', root_uep="/meta") as h5file:
-            return np.array([x["bid"] for x in self.iterrows(h5file.root.contigs,  indices)])
+        with self._openGroup(dbFileName, "/meta") as group:
+            return self.readRows(group.contigs, indices, field="bid")
 
     def getContigLengths(self, dbFileName, indices=[]):
         """Load contig lengths"""
-        with tables.open_file(dbFileName, 'r', root_uep="/meta") as h5file:
-            return np.array([x["length"] for x in self.iterrows(h5file.root.contigs,  indices)])
+        with self._openGroup(dbFileName, "/meta") as group:
+            return self.readRows(group.contigs, indices, field="length")
 
     def getContigGCs(self, dbFileName, indices=[]):
         """Load contig gcs"""
-        with tables.open_file(dbFileName, 'r', root_uep="/meta") as h5file:
-            return np.array([x["gc"] for x in self.iterrows(h5file.root.contigs,  indices)])
+        with self._openGroup(dbFileName, "/meta") as group:
+            return self.readRows(group.contigs, indices, field="gc")
                             
 #------------------------------------------------------------------------------
 # GET TABLES - BINS
@@ -1254,8 +1456,9 @@ class DataManager:
         Returns a dict of type:
         { bid : numMembers }
         """
-        with tables.open_file(dbFileName, 'r', root_uep="/meta") as h5file:
-            return dict([(x["bid"], x["numMembers"]) for x in h5file.root.bins])
+        with self._openGroup(dbFileName, "/meta") as group:
+            bins = group.bins.read()
+        return dict(zip(bins["bid"], bins["numMembers"]))
             
 #------------------------------------------------------------------------------
 # GET TABLES - REACHABILITY
@@ -1265,17 +1468,18 @@ class DataManager:
         
         Returns a tuple: (ordered_indices, distances)
         """
-        with tables.open_file(dbFileName, 'r', root_uep="/meta") as h5file:
-            (indices, dists) = zip(*[(x["contig"], x["distance"]) for x in h5file.root.reachability])
-        return (np.array(indices), np.array(dists))
+        with self._openGroup(dbFileName, "/meta") as group:
+            reachability = group.reachability.read()
+        return (np.ascontiguousarray(reachability["contig"]),
+                np.ascontiguousarray(reachability["distance"]))
         
 #------------------------------------------------------------------------------
 # GET TABLES - MARKERS
 
     def getMarkerNames(self, dbFileName, indices=[]):
         """Load marker names"""
-        with tables.open_file(dbFileName, 'r', root_uep="/meta") as h5file:
-            return np.array([x["markerid"] for x in self.iterrows(h5file.root.markers, indices)])
+        with self._openGroup(dbFileName, "/meta") as group:
+            return self.readStrings(group.markers, indices, field="markerid")
             
     def getMarkerStats(self, dbFileName):
         """Load data from markers table
@@ -1283,24 +1487,25 @@ class DataManager:
         Returns a dict of type:
             { markerid: numMappings }
         """
-        with tables.open_file(dbFileName, 'r', root_uep="/meta") as h5file:
-            return dict([(x["markerid"], x["numMappings"]) for x in h5file.root.markers])
+        with self._openGroup(dbFileName, "/meta") as group:
+            markers = group.markers.read()
+        return dict(zip(markers["markerid"], markers["numMappings"]))
 
 #------------------------------------------------------------------------------
 # GET TABLES - TAXONS
 
     def getTaxonNames(self, dbFileName, indices=[]):
         """Load taxon names"""
-        with tables.open_file(dbFileName, 'r', root_uep="/meta") as h5file:
-            return np.array([x["taxonid"] for x in self.iterrows(h5file.root.taxons, indices)])
+        with self._openGroup(dbFileName, "/meta") as group:
+            return self.readStrings(group.taxons, indices, field="taxonid")
             
 #------------------------------------------------------------------------------
 # GET METADATA
 
     def _getMeta(self, dbFileName):
         """return the metadata table as a structured array"""
-        with tables.open_file(dbFileName, 'r', root_uep="/meta") as h5file:
-            return h5file.root.meta[0]
+        with self._openGroup(dbFileName, "/meta") as meta_group:
+            return meta_group.meta[0]
 
     def getGMDBFormat(self, dbFileName):
         """return the format version of this GM file"""
@@ -1361,82 +1566,117 @@ class DataManager:
         updates is a dictionary which looks like:
         { tableRow : bid }
         """
-        
-        # get the contigs table image
-        with tables.open_file(dbFileName, mode='r', root_uep='/meta') as h5file:
+        self.setBinIds(dbFileName,
+                       np.fromiter(updates.keys(), dtype=int, count=len(updates)),
+                       np.fromiter(updates.values(), dtype=int, count=len(updates)),
+                       nuke=nuke)
+
+    def setBinIds(self, dbFileName, indices, binIds, nuke=False):
+        """Set bins for the contigs at the given table rows
+
+        Parameters
+        ----------
+        dbFileName : string
+            Path to the GroopM database.
+        indices : ndarray
+            Global contig table rows to update.
+        binIds : ndarray
+            New bin id for each row in `indices`.
+        nuke : bool
+            Clear all existing bin assignments first.
+
+        Notes
+        -----
+        The new bin id column is first saved to /meta/tmp_bids and then
+        written over the `bid` column of the contigs table in place. If that
+        write is interrupted the saved column is re-applied by
+        `recoverBinAssignments` the next time the DB is checked.
+        """
+        with self._openGroup(dbFileName, "/meta") as meta_group:
             if nuke:
-                (con_names, con_lengths, con_gcs) = zip(*[(x["cid"], x["length"], x["gc"]) for x in h5file.root.contigs])
-                num_cons = len(con_lengths)
-                # clear all bin assignments
-                bins = [0]*num_cons
+                bins = np.zeros(meta_group.contigs.nrows, dtype=int)
             else:
-                (con_names, bins, con_lengths, con_gcs) = zip(*[tuple(x) for x in h5file.root.contigs])
-        
-        # now apply the updates
-        for tr in updates.keys():
-            bins[tr] = updates[tr]
+                bins = meta_group.contigs.col('bid')
+        bins[np.asarray(indices, dtype=int)] = binIds
 
-        # build the new contigs table image
-        contigs_data = np.array(zip(con_names, bins, con_lengths, con_gcs),
-                                dtype=self.contigs_desc)
-        
-        # build the new bins table image
-        (bids, num_members) = np.unique(bins, return_counts=True)
-        updates = [(bid, num_members, False) for (bid, num_members) in zip(bids, num_members)] #isLikelyChimeric is always false
-        bins_data = np.array(updates, dtype=self.bins_desc)
-        
-        # update num bins metadata
-        num_bins = len(bids) - int(0 in bids)
-        meta = self._getMeta(dbFileName)
-        meta['numBins'] = num_bins  
-        if num_bins > 0:
-            meta['clustered'] = True
-        meta_data = np.array([meta], dtype=self.meta_desc)
-                                
-          
-        # Let's do the update atomically... 
-        with tables.open_file(dbFileName, mode='a', root_uep='/meta') as h5file:
-            
+        with self._openGroup(dbFileName, "/meta", mode='a') as meta_group:
+            h5file = meta_group._v_file
             try:
                 # get rid of any failed attempts
-                h5file.remove_node('/', 'tmp_contigs')
-            except:
-                pass
-            h5file.create_table('/',
-                                'tmp_contigs',
-                                contigs_data,
-                                title="Contig information",
-                                expectedrows=num_cons)
-                
-            # update bin table
-            try:
-                h5file.remove_node(meta_group, 'tmp_bins')
+                h5file.remove_node(meta_group, 'tmp_bids')
             except:
                 pass
+            h5file.create_array(meta_group,
+                                'tmp_bids',
+                                bins,
+                                title="Pending bin assignments")
+            self._applyBinIds(meta_group)
+
+    def recoverBinAssignments(self, dbFileName):
+        """Finish any bin assignment update that was interrupted"""
+        with self._openGroup(dbFileName, "/meta") as meta_group:
+            pending = 'tmp_bids' in meta_group
+        if pending:
+            print "    Completing interrupted bin assignment update"
+            with self._openGroup(dbFileName, "/meta", mode='a') as meta_group:
+                self._applyBinIds(meta_group)
+
+    def _applyBinIds(self, meta_group):
+        """Write the pending bid column over the contigs table
+
+        The bins and meta tables are rebuilt from the new column and swapped in,
+        and the pending column is removed only once all tables are updated.
+        """
+        h5file = meta_group._v_file
+        h5file.flush()
+        bins = meta_group.tmp_bids.read()
+        meta_group.contigs.modify_column(column=bins, colname='bid')
 
-            h5file.create_table('/',
-                                'tmp_bins',
-                                bins_data,
-                                title="Bin information",
-                                expectedrows=len(bids))
-                
-            # update meta table
-            try:
-                h5file.remove_node(meta_group, 'tmp_meta')
-            except:
-                pass
-                
-            h5file.create_table('/',
-                                'tmp_meta',
-                                meta_data,
-                                title="Descriptive data",
-                                expectedrows=1)
+        # build the new bins table image
+        counts = np.bincount(bins)
+        bids = np.flatnonzero(counts)
+        bins_data = np.zeros(len(bids), dtype=self.bins_desc)
+        bins_data['bid'] = bids
+        bins_data['numMembers'] = counts[bids]
+        bins_data['isLikelyChimeric'] = False #isLikelyChimeric is always false
+
+        # update num bins metadata
+        num_bins = len(bids) - int(0 in bids)
+        meta_data = meta_group.meta.read()
+        meta_data['numBins'] = num_bins
+        if num_bins > 0:
+            meta_data['clustered'] = True
+
+        # update bin table
+        try:
+            h5file.remove_node(meta_group, 'tmp_bins')
+        except:
+            pass
+
+        h5file.create_table(meta_group,
+                            'tmp_bins',
+                            bins_data,
+                            title="Bin information",
+                            expectedrows=len(bids))
+
+        # update meta table
+        try:
+            h5file.remove_node(meta_group, 'tmp_meta')
+        except:
+            pass
+
+        h5file.create_table(meta_group,
+                            'tmp_meta',
+                            meta_data,
+                            title="Descriptive data",
+                            expectedrows=1)
+
+        # rename the tmp tables to overwrite
+        h5file.rename_node(meta_group, 'bins', 'tmp_bins', overwrite=True)
+        h5file.rename_node(meta_group, 'meta', 'tmp_meta', overwrite=True)
+        h5file.flush()
+        h5file.remove_node(meta_group, 'tmp_bids')
 
-            # rename the tmp tables to overwrite
-            h5file.rename_node("/", 'contigs', 'tmp_contigs', overwrite=True)
-            h5file.rename_node("/", 'bins', 'tmp_bins', overwrite=True)
-            h5file.rename_node("/", 'meta', 'tmp_meta', overwrite=True)
-            
     def nukeBins(self, dbFileName):
         """Reset all bin information, completely"""
         print "    Clearing all old bin information from",dbFileName
@@ -1450,28 +1690,47 @@ class DataManager:
 
         updates is a list of (contig, distance) pairs in reachability order
         """
-        
+        if len(updates) > 0:
+            (indices, distances) = zip(*updates)
+        else:
+            (indices, distances) = ([], [])
+        self.setReachability(dbFileName, indices, distances)
+
+    def setReachability(self, dbFileName, indices, distances):
+        """Set per-contig reachability
+
+        Parameters
+        ----------
+        dbFileName : string
+            Path to the GroopM database.
+        indices : ndarray
+            Global contig table rows in reachability order.
+        distances : ndarray
+            Reachability distance for each row in `indices`.
+        """
         # build the new reachability table image
-        reachability_data = np.array(updates,
-                                     dtype=self.reachability_desc)
+        reachability_data = np.empty(len(indices), dtype=self.reachability_desc)
+        reachability_data["contig"] = indices
+        reachability_data["distance"] = distances
           
         # Update database 
-        with tables.open_file(dbFileName, mode='a', root_uep='/meta') as h5file:
+        with self._openGroup(dbFileName, "/meta", mode='a') as meta_group:
+            h5file = meta_group._v_file
             
             try:
                 # get rid of any failed attempts
-                h5file.remove_node('/', 'tmp_reachability')
+                h5file.remove_node(meta_group, 'tmp_reachability')
             except:
                 pass
                 
-            h5file.create_table('/',
+            h5file.create_table(meta_group,
                                 'tmp_reachability',
                                 reachability_data,
                                 title="Reachability ordering",
-                                expectedrows=len(updates))
+                                expectedrows=len(reachability_data))
 
             # rename the tmp tables to overwrite
-            h5file.rename_node("/", 'reachability', 'tmp_reachability', overwrite=True)
+            h5file.rename_node(meta_group, 'reachability', 'tmp_reachability', overwrite=True)
 
 #------------------------------------------------------------------------------
 # FILE / IO
@@ -1596,6 +1855,16 @@ def _get_bam_descriptor(fullPath, index_num):
     """AUX: Reduce a full path to just the file name minus extension"""
     return str(index_num) + '_' + op_splitext(op_basename(fullPath))[0]
     
+# kmer signature engine of a contig parsing worker process
+_worker_kse = None
+
+def _init_contig_worker(kLen):
+    global _worker_kse
+    _worker_kse = KmerSigEngine(kLen)
+    
+def _parse_contig_seq(seq):
+    return ContigParser().parseSeq(seq, _worker_kse)
+    
 def _DB1_PCAKsigs(ksigs):
     # stub pca calculation
     return (ksigs[:, :2], np.zeros(len(ksigs)))
@@ -1632,19 +1901,11 @@ class _DB4_CoverageTransformer:
 class ContigParser:
     """Main class for reading in and parsing contigs"""
     
-    def parse(self, contigFile, cutoff, kse):
+    def parse(self, contigFile, cutoff, kse, threads=1, batchSize=10000):
         """Do the heavy lifting of parsing"""
-        print "Parsing contigs"
         contigInfo = {} # save everything here first so we can sort accordingly
-        reader = FastaReader()
-        for cid,seq in reader.readFasta(contigFile):
-            if len(seq) >= cutoff:
-                try:
-                    gc = self.calculateGC(seq)
-                except ZeroDivisionError:
-                    print "***WARNING*** Using 0.5 as GC percentage of sequence '%s' " % seq
-                    gc = 0.5
-                contigInfo[cid] = (kse.getKSig(seq.upper()), len(seq), gc)
+        for (cids, ksigs, lengths, gcs) in self.iterBatches(contigFile, cutoff, kse, threads=threads, batchSize=batchSize):
+            contigInfo.update(zip(cids, zip(ksigs, lengths, gcs)))
 
         # sort the contig names here once!
         con_names = np.array(sorted(contigInfo.keys()))
@@ -1655,6 +1916,86 @@ class ContigParser:
         con_ksigs = np.array([contigInfo[cid][0] for cid in con_names])
 
         return (con_names, con_gcs, con_lengths, con_ksigs)
+        
+    def parseToFile(self, contigFile, cutoff, kse, out, threads=1, batchSize=10000):
+        """Parse contigs, writing kmer signatures to a binary file in file order
+        
+        Only one batch of signatures is held in memory at a time. Signatures
+        are written to `out` as rows of doubles. Returns a tuple
+        (con_names, con_gcs, con_lengths, con_rows) sorted by contig name,
+        where con_rows are the rows of `out` holding the signatures. When a
+        name is repeated the last contig is used.
+        """
+        names = []
+        gcs = []
+        lengths = []
+        for (cids, ksigs, batch_lengths, batch_gcs) in self.iterBatches(contigFile, cutoff, kse, threads=threads, batchSize=batchSize):
+            out.write(ksigs.astype(np.float64).tobytes())
+            names.append(cids)
+            gcs.append(batch_gcs)
+            lengths.append(batch_lengths)
+        if len(names) == 0:
+            return (np.array([], dtype=str), np.array([]), np.array([], dtype=int), np.array([], dtype=int))
+        names = np.concatenate(names)
+        
+        # index of the last contig with each name, in sorted name order
+        (con_names, rindices) = np.unique(names[::-1], return_index=True)
+        indices = len(names) - 1 - rindices
+        return (con_names, np.concatenate(gcs)[indices], np.concatenate(lengths)[indices], indices)
+        
+    def iterBatches(self, contigFile, cutoff, kse, threads=1, batchSize=10000):
+        """Parse contigs in batches, in file order
+        
+        Yields tuples (cids, ksigs, lengths, gcs) for up to batchSize contigs
+        at a time. With more than one process, each batch is parsed by a pool
+        of worker processes while the next batch is read and the previous one
+        is consumed, so at most two batches are held in memory.
+        """
+        if threads > 1:
+            print "Parsing contigs using %d processes" % threads
+        else:
+            print "Parsing contigs"
+        reader = FastaReader()
+        records = ((cid, seq) for (cid, seq) in reader.readFasta(contigFile) if len(seq) >= cutoff)
+        batches = iter(lambda: list(islice(records, batchSize)), [])
+        if threads <= 1:
+            for batch in batches:
+                yield self._makeBatch(batch, [self.parseSeq(seq, kse) for (_, seq) in batch], kse)
+            return
+        
+        pool = Pool(threads, initializer=_init_contig_worker, initargs=(kse.kLen,))
+        try:
+            pending = None
+            for batch in batches:
+                # submit this batch before waiting on the previous one
+                result = pool.map_async(_parse_contig_seq,
+                                        [seq for (_, seq) in batch],
+                                        chunksize=max(1, len(batch) // (4*threads)))
+                if pending is not None:
+                    yield self._makeBatch(pending[0], pending[1].get(), kse)
+                pending = (batch, result)
+            if pending is not None:
+                yield self._makeBatch(pending[0], pending[1].get(), kse)
+        finally:
+            pool.close()
+            pool.join()
+            
+    def _makeBatch(self, batch, infos, kse):
+        """Batch tuple (cids, ksigs, lengths, gcs) from parsed contig infos"""
+        (ksigs, lengths, gcs) = zip(*infos)
+        return (np.array([cid for (cid, _) in batch]),
+                np.array(ksigs).reshape(len(batch), kse.numMers),
+                np.array(lengths),
+                np.array(gcs))
+        
+    def parseSeq(self, seq, kse):
+        """Kmer signature, length and GC of a contig sequence"""
+        try:
+            gc = self.calculateGC(seq)
+        except ZeroDivisionError:
+            print "***WARNING*** Using 0.5 as GC percentage of sequence '%s' " % seq
+            gc = 0.5
+        return (kse.getKSig(seq.upper()), len(seq), gc)
 
     def calculateGC(self, seq):
       """Calculate fraction of nucleotides that are G or C."""
@@ -1664,11 +2005,20 @@ class ContigParser:
 
       return float(gc) / (gc + at)
 
-    def getWantedSeqs(self, contigFile, wanted, out_dict):
-        """Do the heavy lifting of parsing"""
+    def getWantedSeqs(self, contigFile, wanted, out_dict, index=None):
+        """Do the heavy lifting of parsing
+        
+        If the `.fai` index of the file is given, only the wanted contigs are
+        read.
+        """
         print "Parsing contigs"
         reader = FastaReader()
-        for cid,seq in reader.readFasta(contigFile):
+        wanted = set(wanted)
+        if index is not None:
+            records = reader.readIndexedFasta(contigFile, index, wanted)
+        else:
+            records = reader.readFasta(contigFile)
+        for cid,seq in records:
             if(cid in wanted):
                 out_dict[cid] = seq
 
@@ -1688,6 +2038,12 @@ class KmerSigEngine:
         (self.kmerCols, self.llDict) = self.makeKmerColNames(makeLL=True)
         self.numMers = len(self.kmerCols)
         
+        # 2-bit codes for each base, other characters (e.g. N) are coded 4
+        self.baseCodes = np.full(256, 4, dtype=np.int64)
+        for (i, base) in enumerate("ACGT"):
+            self.baseCodes[ord(base)] = i
+        self.colIndices = self.makeKmerColIndices()
+        
     def calculateGCVector(self):
         return [float(gc)/(gc+at) for (gc, at) in ((mer.count('G')+mer.count('C'), mer.count('A')+mer.count('T')) for mer in self.kmerCols)]
 
@@ -1707,17 +2063,31 @@ class KmerSigEngine:
             out_list = working_list
 
         # pare it down based on lexicographical ordering
-        ret_list = []
+        ret_set = set()
         ll_dict = {}
         for mer in out_list:
             lmer = self.shiftLowLexi(mer)
             ll_dict[mer] = lmer
-            if lmer not in ret_list:
-                ret_list.append(lmer)
+            ret_set.add(lmer)
         if makeLL:
-            return (sorted(ret_list), ll_dict)
+            return (sorted(ret_set), ll_dict)
         else:
-            return sorted(ret_list)
+            return sorted(ret_set)
+            
+    def makeKmerColIndices(self):
+        """Work out the kmer column for each 2-bit kmer code
+        
+        Codes of a kmer and its reverse complement map to the same column.
+        With bases coded in lexicographical order, the lowest code is the
+        lexicographically lowest form, so columns follow kmerCols.
+        """
+        codes = np.arange(4**self.kLen, dtype=np.int64)
+        rcodes = np.zeros_like(codes)
+        for i in range(self.kLen):
+            # complement of base i from the end is base i from the start of the reverse
+            rcodes |= (3 - ((codes >> (2*i)) & 3)) << (2*(self.kLen-1-i))
+        lcodes = np.minimum(codes, rcodes)
+        return np.searchsorted(np.unique(lcodes), lcodes)
 
     def getGC(self, seq):
         """Get the GC of a sequence"""
@@ -1738,23 +2108,31 @@ class KmerSigEngine:
 
         returns a tuple of floats which is the kmer sig
         """
-        # tmp storage
-        sig = dict(zip(self.kmerCols, [0.0] * self.numMers))
+        bases = self.baseCodes[np.frombuffer(seq, dtype=np.uint8)]
         # the number fo kmers in this sequence
         num_mers = len(seq)-self.kLen+1
-        for i in range(0,num_mers):
-            try:
-                sig[self.llDict[seq[i:i+self.kLen]]] += 1.0
-            except KeyError:
-                # typically due to an N in the sequence. Reduce the number of mers we've seen
-                num_mers -= 1
+        sig = np.zeros(self.numMers)
+        if num_mers > 0:
+            # skip mers containing a base other than ACGT, typically an N
+            num_bad = np.concatenate(([0], np.cumsum(bases > 3)))
+            is_good = num_bad[self.kLen:] == num_bad[:num_mers]
+            
+            # rolling forward and reverse complement codes for each mer
+            fcodes = np.zeros(num_mers, dtype=np.int64)
+            rcodes = np.zeros(num_mers, dtype=np.int64)
+            for i in range(self.kLen):
+                b = bases[i:i+num_mers] & 3
+                fcodes = (fcodes << 2) | b
+                rcodes |= (3 - b) << (2*i)
+            lcodes = np.minimum(fcodes, rcodes)[is_good]
+            num_mers = len(lcodes)
+            sig += np.bincount(self.colIndices[lcodes], minlength=self.numMers)
 
         # normalise by length and return
-        try:
-            return tuple([sig[x] / num_mers for x in self.kmerCols])
-        except ZeroDivisionError:
+        if num_mers <= 0:
             print "***WARNING*** Sequence '%s' is not playing well with the kmer signature engine " % seq
             return tuple([0.0] * self.numMers)
+        return tuple(sig / num_mers)
         
             
 ###############################################################################
@@ -1776,22 +2154,17 @@ class BamParser:
                      verbose=True)
 
         # we need to make sure that the ordering of contig names is consistent
-        # first we get a dict that connects a contig name to the index in
-        # the coverages array
-        con_name_lookup = dict(zip(BP.BFI.contigNames,
-                                   range(len(BP.BFI.contigNames))))
-
-        # Next we build the cov_sigs array by appending the coverage
-        # profiles in the same order. We need to handle the case where
-        # there is no applicable contig in the BamM-derived coverages
-        cov_sigs = []
-        for cid in contigNames:
-            try:
-                cov_sigs.append(tuple(BP.BFI.coverages[con_name_lookup[cid]]))
-            except KeyError:
-                # when a contig is missing from the BAM we just give it 0
-                # coverage. It will be removed later with a warning then
-                cov_sigs.append(tuple([0.]*len(bamFiles)))
+        # so we find the index of each contig in the coverages array
+        con_indices = lookup_indices(BP.BFI.contigNames, contigNames)
+
+        # Next we build the cov_sigs array with the coverage profiles in the
+        # same order. When a contig is missing from the BamM-derived coverages
+        # we just give it 0 coverage. It will be removed later with a warning
+        cov_sigs = np.zeros((len(contigNames), len(bamFiles)))
+        is_found = con_indices >= 0
+        if np.any(is_found):
+            coverages = np.asarray(BP.BFI.coverages, dtype=np.double).reshape(-1, len(bamFiles))
+            cov_sigs[is_found] = coverages[con_indices[is_found]]
 
         #######################################################################
         # LINKS ARE DISABLED UNTIL STOREM COMES ONLINE
@@ -1813,7 +2186,7 @@ class BamParser:
 
         return ([BP.BFI.bamFiles[i].fileName for i in range(len(bamFiles))],
                 rowwise_links,
-                np.array(cov_sigs))
+                cov_sigs)
 
     
 ###############################################################################
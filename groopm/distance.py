@@ -51,8 +51,10 @@ import numpy as np
 import scipy.spatial.distance as sp_distance
 import scipy.stats as sp_stats
 import scipy.misc as sp_misc
+import scipy.sparse as sp_sparse
 
 # local imports
+import distance_ext
 
 np.seterr(all='raise')
 
@@ -93,7 +95,7 @@ def iargrank(out, weight_fun=None):
     _ifractional_rank(out, weight_fun=weight_fun)
 
     
-def core_distance(Y, weight_fun=None, minWt=None, minPts=None):
+def core_distance(Y, weight_fun=None, minWt=None, minPts=None, weights=None, threads=1):
     """Compute core distance for data points, defined as the distance to the furtherest
     neighbour where the cumulative weight of closer points is less than minWt.
 
@@ -108,6 +110,12 @@ def core_distance(Y, weight_fun=None, minWt=None, minPts=None):
         Total cumulative neighbour weight used to compute density distance for individual points.
     minPts : int
         Number of neighbours used to compute density distance.
+    weights : ndarray, optional
+        1-D array of observation weights. The weight of a pair of observations
+        is the product of their weights. Used in place of `weight_fun`, and
+        allows the computation to run entirely in compiled code.
+    threads : int, optional
+        Number of threads used to compute core distances.
         
     Returns
     -------
@@ -116,31 +124,34 @@ def core_distance(Y, weight_fun=None, minWt=None, minPts=None):
     """
     (Y, _) = validate_y(Y, name="Y")
     n = sp_distance.num_obs_y(Y)
+    Y = np.ascontiguousarray(Y, dtype=np.double)
+    mp = np.empty(n, dtype=np.intp)
+    mp[:] = n-1 if minPts is None else minPts
+    if minWt is not None:
+        mw = np.empty(n, dtype=np.double)
+        mw[:] = minWt
+    if weight_fun is None or minWt is None or weights is not None:
+        if weights is not None and minWt is not None:
+            weights = np.ascontiguousarray(weights, dtype=np.double)
+            if weights.shape != (n,):
+                raise ValueError("weights is not a 1-D array with compatible size to Y.")
+            return distance_ext.core_distance(Y, n, mp, weights=weights, minWt=mw, num_threads=threads)
+        return distance_ext.core_distance(Y, n, mp, num_threads=threads)
+    
     core_dist = np.empty(n, dtype=Y.dtype)
     m = np.empty(n, dtype=Y.dtype) # store row distances
-    minPts = n-1 if minPts is None else minPts
-    if weight_fun is None or minWt is None:
-        for (i, mp) in np.broadcast(np.arange(n), minPts):
-            others = np.flatnonzero(np.arange(n)!=i)
-            m[others] = Y[condensed_index(n, i, others)]
-            m[i] = 0
-            m.sort()
-            core_dist[i] = m[np.minimum(n-1, mp)]
-    else:
-        w = np.empty(n, dtype=np.double) # store row weights
-        for (i, mp, mw) in np.broadcast(np.arange(n), minPts, minWt):
-            others = np.flatnonzero(np.arange(n)!=i)
-            m[others] = Y[condensed_index(n, i, others)]
-            m[i] = 0
-            w[others] = weight_fun(i, others)
-            w[i] = 0
-            sorting_indices = m.argsort()
-            minPts = np.minimum(int(np.sum(w[sorting_indices].cumsum() < mw)), mp)
-            core_dist[i] = m[sorting_indices[np.minimum(n-1, minPts)]]
+    w = np.empty(n, dtype=np.double) # store row weights
+    for i in range(n):
+        others = np.flatnonzero(np.arange(n)!=i)
+        m[others] = Y[condensed_index(n, i, others)]
+        m[i] = 0
+        w[others] = weight_fun(i, others)
+        w[i] = 0
+        core_dist[i] = distance_ext.row_core_distance(m, w, mp[i], mw[i])
     return core_dist
 
     
-def reachability_order(Y, core_dist=None):
+def reachability_order(Y, core_dist=None, threads=1):
     """Traverse collection of nodes by choosing the closest unvisited node to
     a visited node at each step to produce a reachability plot.
     
@@ -150,6 +161,8 @@ def reachability_order(Y, core_dist=None):
         Condensed distance matrix
     core_dist : ndarray
         Core distances for original observations of Y.
+    threads : int, optional
+        Number of threads used to update reachability distances.
         
     Returns
     -------
@@ -158,31 +171,114 @@ def reachability_order(Y, core_dist=None):
     d : ndarray
         1-D array. `d[i]` is the `i`th traversal distance.
     """
-    Y = np.asanyarray(Y)
+    Y = np.ascontiguousarray(Y, dtype=np.double)
     n = sp_distance.num_obs_y(Y)
     if core_dist is not None:
-        core_dist = np.asarray(core_dist)
+        core_dist = np.ascontiguousarray(core_dist, dtype=np.double)
         if core_dist.shape != (n,):
             raise ValueError("core_dist is not a 1-D array with compatible size to Y.")
-    o = np.empty(n, dtype=np.intp)
-    to_visit = np.ones(n, dtype=bool)
-    closest = 0
-    o[0] = 0
-    to_visit[0] = False
-    d = np.empty(n, dtype=Y.dtype)
-    d[0] = 0
-    d[1:] = Y[condensed_index(n, 0, np.arange(1, n))]
+    return distance_ext.reachability_order(Y, n, core_dist, num_threads=threads)
+    
+    
+def sparse_core_distance(G, minWt=None, minPts=None, weights=None, threads=1):
+    """Compute core distances for data points from a sparse graph of distances
+    to neighbouring points.
+    
+    Parameters
+    ----------
+    G : sparse matrix
+        Square matrix with `G[i, j]` the distance between observation `i` and
+        neighbouring observation `j`. Only stored entries are considered.
+    minWt : ndarray
+        Total cumulative neighbour weight used to compute density distance for individual points.
+    minPts : int
+        Number of neighbours used to compute density distance.
+    weights : ndarray, optional
+        1-D array of observation weights. The weight of a pair of observations
+        is the product of their weights.
+    threads : int, optional
+        Number of threads used to compute core distances.
+        
+    Returns
+    -------
+    core_distance : ndarray
+        Core distances for data points. Where a point has too few stored
+        neighbours to satisfy `minPts` or `minWt`, the distance to the
+        furtherest stored neighbour is used.
+    """
+    (indptr, indices, data) = validate_graph(G)
+    n = len(indptr) - 1
+    mp = np.empty(n, dtype=np.intp)
+    mp[:] = n-1 if minPts is None else minPts
+    if weights is not None and minWt is not None:
+        weights = np.ascontiguousarray(weights, dtype=np.double)
+        if weights.shape != (n,):
+            raise ValueError("weights is not a 1-D array with compatible size to G.")
+        mw = np.empty(n, dtype=np.double)
+        mw[:] = minWt
+        return distance_ext.sparse_core_distance(indptr, indices, data, mp, weights=weights, minWt=mw, num_threads=threads)
+    return distance_ext.sparse_core_distance(indptr, indices, data, mp, num_threads=threads)
+    
+    
+def sparse_reachability_order(G, core_dist=None, fill=None):
+    """Traverse a sparse graph of distances between neighbouring nodes by
+    choosing the closest unvisited node to a visited node at each step to
+    produce a reachability plot.
+    
+    Parameters
+    ----------
+    G : sparse matrix
+        Square symmetric matrix with `G[i, j]` the distance between observation
+        `i` and neighbouring observation `j`. Only stored entries are considered.
+    core_dist : ndarray
+        Core distances for original observations of G.
+    fill : float, optional
+        Traversal distance used to step between disconnected components of
+        `G`. Defaults to the largest stored distance.
+        
+    Returns
+    -------
+    o : ndarray
+        1-D array of indices of original observations in traversal order.
+    d : ndarray
+        1-D array. `d[i]` is the `i`th traversal distance.
+    """
+    (indptr, indices, data) = validate_graph(G)
+    n = len(indptr) - 1
     if core_dist is not None:
-        d = np.maximum(d, core_dist[0])
-    for i in range(1, n):
-        closest = np.flatnonzero(to_visit)[d[to_visit].argmin()]
-        o[i] = closest
-        to_visit[closest] = False
-        m = Y[condensed_index(n, closest, np.flatnonzero(to_visit))]
-        if core_dist is not None:
-            m = np.maximum(m, core_dist[closest])
-        d[to_visit] = np.minimum(d[to_visit], m)
-    return (o, d[o])
+        core_dist = np.ascontiguousarray(core_dist, dtype=np.double)
+        if core_dist.shape != (n,):
+            raise ValueError("core_dist is not a 1-D array with compatible size to G.")
+    if fill is None:
+        fill = data.max() if len(data) > 0 else 0
+        if core_dist is not None and n > 0:
+            fill = max(fill, core_dist.max())
+    return distance_ext.sparse_reachability_order(indptr, indices, data, core_dist, fill)
+    
+
+def taxonomic_distance(table, threads=1):
+    """Compute condensed taxonomic distances between mapping taxonomies.
+    
+    Distances are identical to `ClassificationEngine.getDistance` applied to
+    all pairs of rows.
+    
+    Parameters
+    ----------
+    table : ndarray
+        n-by-7 array of taxon indices, where 0 is an untagged rank and 1 is an
+        empty tag.
+    threads : int, optional
+        Number of threads used to compute distances.
+        
+    Returns
+    -------
+    Y : ndarray
+        Condensed distance matrix.
+    """
+    table = np.ascontiguousarray(table, dtype=np.intp)
+    if table.ndim != 2:
+        raise ValueError("table is not a 2-D array.")
+    return distance_ext.taxonomic_distance(table, num_threads=threads)
     
 
 def condensed_index(n, i, j):
@@ -329,7 +425,17 @@ def validate_y(Y, weights=None, name="Y"):
             raise ValueError("weights should have the same shape as %s." % name)
     return (Y, weights)
     
-
+    
+def validate_graph(G):
+    G = sp_sparse.csr_matrix(G)
+    if G.shape[0] != G.shape[1]:
+        raise ValueError("G is not a square matrix.")
+    indptr = np.ascontiguousarray(G.indptr, dtype=np.intp)
+    indices = np.ascontiguousarray(G.indices, dtype=np.intp)
+    data = np.ascontiguousarray(G.data, dtype=np.double)
+    return (indptr, indices, data)
+    
+    
 def logratio(X, axis=-1, mode="centered"):
     X = np.asanyarray(X)
     if mode=="additive":
@@ -0,0 +1,464 @@
+# distance_ext.pyx
+# cython: language_level=2, boundscheck=False, wraparound=False, cdivision=True
+
+cimport numpy as np
+from cython.parallel cimport parallel, prange
+from libc.stdlib cimport malloc, free
+from libc.math cimport INFINITY
+
+import numpy as np
+
+np.import_array()
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+# helpers
+cdef inline np.npy_intp _condensed_index(np.npy_intp n, np.npy_intp i, np.npy_intp j) nogil:
+    if i < j:
+        return n*i - (i*(i+1))//2 + (j-i-1)
+    return n*j - (j*(j+1))//2 + (i-j-1)
+
+
+cdef inline int _swap(double* v, double* w, np.npy_intp i, np.npy_intp j) nogil:
+    cdef double t = v[i]
+    v[i] = v[j]
+    v[j] = t
+    if w != NULL:
+        t = w[i]
+        w[i] = w[j]
+        w[j] = t
+    return 0
+
+
+cdef inline double _median3(double a, double b, double c) nogil:
+    if a < b:
+        if b < c:
+            return b
+        return c if a < c else a
+    if a < c:
+        return a
+    return c if b < c else b
+
+
+cdef double _select(double* v, double* w, np.npy_intp size, np.npy_intp kmax, double minwt) nogil:
+    """Find the value in position `c` of the sorted values in `v`, where `c` is
+    the lesser of `kmax` and the number of sorted values with cumulative weight
+    in `w` less than `minwt`.
+
+    Values are partially reordered in place. Pass a NULL pointer for `w` to
+    select the `kmax`th smallest value.
+    """
+    cdef np.npy_intp lo = 0
+    cdef np.npy_intp hi = size
+    cdef np.npy_intp a, b, i
+    cdef double acc = 0 # cumulative weight of values below position `lo`
+    cdef double below, pivot
+    if w != NULL and minwt <= 0:
+        # no values have cumulative weight less than the limit
+        w = NULL
+        kmax = 0
+    while True:
+        # three-way partition of [lo, hi) into values less than [lo, a), equal
+        # to [a, b) and greater than [b, hi) the pivot
+        pivot = _median3(v[lo], v[lo + (hi - lo) // 2], v[hi - 1])
+        a = lo
+        b = hi
+        i = lo
+        while i < b:
+            if v[i] < pivot:
+                _swap(v, w, a, i)
+                a += 1
+                i += 1
+            elif v[i] > pivot:
+                b -= 1
+                _swap(v, w, i, b)
+            else:
+                i += 1
+
+        if kmax < a:
+            hi = a
+            continue
+        if w == NULL:
+            if kmax < b:
+                return pivot
+            lo = b
+            continue
+
+        # the same running total is used for the limit checks and carried
+        # forward, so that rounding can't disagree between them
+        below = acc
+        for i in range(lo, a):
+            below += w[i]
+        if below >= minwt:
+            # cumulative weight limit is reached below the pivot
+            if a == lo:
+                return pivot
+            hi = a
+            continue
+        for i in range(a, b):
+            below += w[i]
+        if kmax < b or below >= minwt or b >= hi:
+            return pivot
+        acc = below
+        lo = b
+
+
+cdef int _update_reach(double[::1] Y,
+                      np.npy_intp n,
+                      np.npy_intp c,
+                      double cd,
+                      np.npy_intp* rem,
+                      np.npy_intp lo,
+                      np.npy_intp hi,
+                      double* dist,
+                      np.npy_intp* best) nogil:
+    """Lower reachability distances of unvisited observations `rem[lo:hi]`
+    using distances from newly visited observation `c` with core distance
+    `cd`, and find the position of the closest unvisited observation. Ties are
+    broken using the lowest observation index."""
+    cdef np.npy_intp k, j
+    cdef np.npy_intp b = -1
+    cdef double v
+    for k in range(lo, hi):
+        j = rem[k]
+        v = Y[_condensed_index(n, c, j)]
+        if v < cd:
+            v = cd
+        if v < dist[j]:
+            dist[j] = v
+        if b == -1 or dist[j] < dist[rem[b]] or (dist[j] == dist[rem[b]] and j < rem[b]):
+            b = k
+    best[0] = b
+    return 0
+
+
+cdef inline bint _heap_less(double* keys, np.npy_intp* ids, np.npy_intp a, np.npy_intp b) nogil:
+    return keys[a] < keys[b] or (keys[a] == keys[b] and ids[a] < ids[b])
+
+
+cdef inline int _heap_swap(double* keys, np.npy_intp* ids, np.npy_intp a, np.npy_intp b) nogil:
+    cdef double k = keys[a]
+    cdef np.npy_intp i = ids[a]
+    keys[a] = keys[b]
+    ids[a] = ids[b]
+    keys[b] = k
+    ids[b] = i
+    return 0
+
+
+cdef np.npy_intp _heap_push(double* keys, np.npy_intp* ids, np.npy_intp size, double key, np.npy_intp id) nogil:
+    """Push onto binary min-heap ordered by key then id. Returns new heap size."""
+    cdef np.npy_intp pos = size
+    cdef np.npy_intp parent
+    keys[pos] = key
+    ids[pos] = id
+    while pos > 0:
+        parent = (pos - 1) // 2
+        if not _heap_less(keys, ids, pos, parent):
+            break
+        _heap_swap(keys, ids, pos, parent)
+        pos = parent
+    return size + 1
+
+
+cdef np.npy_intp _heap_pop(double* keys, np.npy_intp* ids, np.npy_intp size) nogil:
+    """Move the heap minimum to position `size-1`. Returns new heap size."""
+    cdef np.npy_intp pos = 0
+    cdef np.npy_intp child
+    size -= 1
+    _heap_swap(keys, ids, 0, size)
+    while True:
+        child = 2*pos + 1
+        if child >= size:
+            break
+        if child + 1 < size and _heap_less(keys, ids, child + 1, child):
+            child += 1
+        if not _heap_less(keys, ids, child, pos):
+            break
+        _heap_swap(keys, ids, pos, child)
+        pos = child
+    return size
+
+
+cdef int _gather_row(double[::1] Y, np.npy_intp n, np.npy_intp i, double* m) nogil:
+    """Copy distances from observation `i` to other observations into `m`,
+    with `m[i]` set to zero."""
+    cdef np.npy_intp j
+    cdef np.npy_intp k
+    for j in range(i):
+        m[j] = Y[_condensed_index(n, i, j)]
+    m[i] = 0
+    k = _condensed_index(n, i, i+1) if i < n-1 else 0
+    for j in range(i+1, n):
+        m[j] = Y[k]
+        k += 1
+    return 0
+
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+def core_distance(double[::1] Y,
+                  np.npy_intp n,
+                  np.npy_intp[::1] minPts,
+                  double[::1] weights=None,
+                  double[::1] minWt=None,
+                  int num_threads=1):
+    """Compute core distances for rows of a condensed distance matrix.
+
+    Rows are distributed across `num_threads` threads. `minPts` and `minWt`
+    are 1-D arrays of per-observation limits. If `weights` is not None, the
+    weight of a pair `(i, j)` is `weights[i]*weights[j]`.
+    """
+    cdef double[::1] out = np.empty(n, dtype=np.double)
+    cdef bint weighted = weights is not None and minWt is not None
+    cdef np.npy_intp i, j, kmax
+    cdef double* m
+    cdef double* w
+
+    with nogil, parallel(num_threads=num_threads):
+        m = <double*> malloc(n * sizeof(double))
+        w = <double*> malloc(n * sizeof(double)) if weighted else NULL
+        for i in prange(n, schedule='dynamic', chunksize=16):
+            _gather_row(Y, n, i, m)
+            kmax = minPts[i] if minPts[i] < n-1 else n-1
+            if weighted:
+                for j in range(n):
+                    w[j] = weights[i] * weights[j]
+                w[i] = 0
+                out[i] = _select(m, w, n, kmax, minWt[i])
+            else:
+                out[i] = _select(m, NULL, n, kmax, 0)
+        free(m)
+        if w != NULL:
+            free(w)
+
+    return np.asarray(out)
+
+
+def row_core_distance(double[::1] m, double[::1] w, np.npy_intp minPts, double minWt):
+    """Core distance from an array of distances `m` to other observations and
+    pairwise weights `w`. Arrays are reordered in place."""
+    cdef np.npy_intp size = m.shape[0]
+    cdef np.npy_intp kmax = minPts if minPts < size-1 else size-1
+    return _select(&m[0], &w[0], size, kmax, minWt)
+
+
+def reachability_order(double[::1] Y,
+                       np.npy_intp n,
+                       double[::1] core_dist=None,
+                       int num_threads=1):
+    """Prim-style traversal of a condensed distance matrix, visiting the
+    closest unvisited observation at each step.
+
+    Unvisited observations are kept in a compact array so each step only
+    sweeps unvisited observations, updating reachability distances in place
+    and locating the next closest observation in the same pass. Sweeps are
+    split across `num_threads` threads for large numbers of unvisited
+    observations.
+    """
+    cdef np.npy_intp[::1] o = np.empty(n, dtype=np.intp)
+    cdef double[::1] d = np.empty(n, dtype=np.double)
+    if n == 0:
+        return (np.asarray(o), np.asarray(d))
+    cdef double[::1] dist = np.empty(n, dtype=np.double)
+    cdef np.npy_intp[::1] rem = np.arange(1, n, dtype=np.intp)
+    cdef np.npy_intp[::1] best = np.empty(max(num_threads, 1), dtype=np.intp)
+    cdef bint has_core = core_dist is not None
+    cdef np.npy_intp size = n-1
+    cdef np.npy_intp i, j, k, t, b, c, nchunks, chunk
+    cdef double cd
+
+    with nogil:
+        for j in range(n):
+            dist[j] = INFINITY
+        # traversal starts from the first observation
+        c = 0
+        dist[0] = core_dist[0] if has_core and core_dist[0] > 0 else 0
+        i = 0
+        while True:
+            o[i] = c
+            d[i] = dist[c]
+            if size == 0:
+                break
+            cd = core_dist[c] if has_core else -INFINITY
+            nchunks = num_threads if num_threads > 1 and size >= 16384 else 1
+            if nchunks == 1:
+                _update_reach(Y, n, c, cd, &rem[0], 0, size, &dist[0], &best[0])
+                b = best[0]
+            else:
+                chunk = (size + nchunks - 1) // nchunks
+                for t in prange(nchunks, num_threads=nchunks, schedule='static'):
+                    _update_reach(Y, n, c, cd, &rem[0], t*chunk, min((t+1)*chunk, size), &dist[0], &best[t])
+                b = -1
+                for t in range(nchunks):
+                    k = best[t]
+                    if k == -1:
+                        continue
+                    if b == -1 or dist[rem[k]] < dist[rem[b]] or (dist[rem[k]] == dist[rem[b]] and rem[k] < rem[b]):
+                        b = k
+            # visit the closest observation and remove it from the unvisited array
+            c = rem[b]
+            size -= 1
+            rem[b] = rem[size]
+            i += 1
+
+    return (np.asarray(o), np.asarray(d))
+
+
+def sparse_core_distance(np.npy_intp[::1] indptr,
+                         np.npy_intp[::1] indices,
+                         double[::1] data,
+                         np.npy_intp[::1] minPts,
+                         double[::1] weights=None,
+                         double[::1] minWt=None,
+                         int num_threads=1):
+    """Compute core distances for rows of a sparse distance graph in CSR
+    format, using only the stored neighbours of each observation.
+
+    Semantics are as for `core_distance`, except that if the stored neighbours
+    are exhausted the distance to the furthest stored neighbour is used.
+    """
+    cdef np.npy_intp n = indptr.shape[0] - 1
+    cdef double[::1] out = np.empty(n, dtype=np.double)
+    cdef bint weighted = weights is not None and minWt is not None
+    cdef np.npy_intp i, k, deg, kmax
+    cdef np.npy_intp maxdeg = 0
+    cdef double* m
+    cdef double* w
+
+    for i in range(n):
+        if indptr[i+1] - indptr[i] > maxdeg:
+            maxdeg = indptr[i+1] - indptr[i]
+
+    with nogil, parallel(num_threads=num_threads):
+        m = <double*> malloc((maxdeg + 1) * sizeof(double))
+        w = <double*> malloc((maxdeg + 1) * sizeof(double)) if weighted else NULL
+        for i in prange(n, schedule='dynamic', chunksize=256):
+            deg = indptr[i+1] - indptr[i]
+            m[0] = 0
+            for k in range(deg):
+                m[k+1] = data[indptr[i] + k]
+            kmax = minPts[i] if minPts[i] < deg else deg
+            if weighted:
+                w[0] = 0
+                for k in range(deg):
+                    w[k+1] = weights[i] * weights[indices[indptr[i] + k]]
+                out[i] = _select(m, w, deg + 1, kmax, minWt[i])
+            else:
+                out[i] = _select(m, NULL, deg + 1, kmax, 0)
+        free(m)
+        if w != NULL:
+            free(w)
+
+    return np.asarray(out)
+
+
+def sparse_reachability_order(np.npy_intp[::1] indptr,
+                              np.npy_intp[::1] indices,
+                              double[::1] data,
+                              double[::1] core_dist=None,
+                              double fill=INFINITY):
+    """Prim-style traversal of a sparse distance graph in CSR format, using a
+    binary heap of reachable observations.
+
+    When no unvisited observation is reachable, traversal continues from the
+    lowest indexed unvisited observation, which is assigned a reachability
+    distance of `fill`.
+    """
+    cdef np.npy_intp n = indptr.shape[0] - 1
+    cdef np.npy_intp nnz = indptr[n]
+    cdef np.npy_intp[::1] o = np.empty(n, dtype=np.intp)
+    cdef double[::1] d = np.empty(n, dtype=np.double)
+    if n == 0:
+        return (np.asarray(o), np.asarray(d))
+    cdef double[::1] dist = np.full(n, INFINITY, dtype=np.double)
+    cdef np.uint8_t[::1] visited = np.zeros(n, dtype=np.uint8)
+    cdef double[::1] heap_keys = np.empty(nnz + 1, dtype=np.double)
+    cdef np.npy_intp[::1] heap_ids = np.empty(nnz + 1, dtype=np.intp)
+    cdef bint has_core = core_dist is not None
+    cdef np.npy_intp size = 0
+    cdef np.npy_intp first_unvisited = 0
+    cdef np.npy_intp i, j, k, c
+    cdef double v, cd
+
+    with nogil:
+        # traversal starts from the first observation
+        c = 0
+        dist[0] = core_dist[0] if has_core and core_dist[0] > 0 else 0
+        for i in range(n):
+            if i > 0:
+                c = -1
+                while size > 0:
+                    size = _heap_pop(&heap_keys[0], &heap_ids[0], size)
+                    j = heap_ids[size]
+                    if not visited[j] and heap_keys[size] == dist[j]:
+                        c = j
+                        break
+                if c == -1:
+                    # jump to the next disconnected component
+                    while visited[first_unvisited]:
+                        first_unvisited += 1
+                    c = first_unvisited
+                    dist[c] = fill
+            o[i] = c
+            d[i] = dist[c]
+            visited[c] = 1
+            cd = core_dist[c] if has_core else -INFINITY
+            for k in range(indptr[c], indptr[c+1]):
+                j = indices[k]
+                if visited[j]:
+                    continue
+                v = data[k] if data[k] > cd else cd
+                if v < dist[j]:
+                    dist[j] = v
+                    size = _heap_push(&heap_keys[0], &heap_ids[0], size, v, j)
+
+    return (np.asarray(o), np.asarray(d))
+
+
+def taxonomic_distance(np.npy_intp[:, ::1] table,
+                       int num_threads=1):
+    """Condensed taxonomic distances between rows of a taxonomy table.
+
+    Entries of 0 are untagged ranks, which are coherent with any tag, and
+    entries of 1 are empty tags, which are incoherent with all tags. The
+    distance is `7-j` for the first rank `j` above any untagged rank where
+    the tags differ or either is empty, and 0 otherwise. Rows are distributed
+    across `num_threads` threads.
+    """
+    cdef np.npy_intp n = table.shape[0]
+    cdef np.npy_intp k = table.shape[1] if table.shape[1] < 7 else 7
+    cdef double[::1] Y = np.zeros(n*(n-1)//2, dtype=np.double)
+    cdef np.npy_intp[::1] lengths = np.empty(n, dtype=np.intp)
+    cdef np.npy_intp i, j, r, l, b
+
+    # number of ranks above the first untagged rank
+    for i in range(n):
+        l = 0
+        while l < k and table[i, l] != 0:
+            l += 1
+        lengths[i] = l
+
+    with nogil, parallel(num_threads=num_threads):
+        for i in prange(n, schedule='dynamic', chunksize=16):
+            b = _condensed_index(n, i, i+1) if i < n-1 else 0
+            for j in range(i+1, n):
+                l = lengths[i] if lengths[i] < lengths[j] else lengths[j]
+                for r in range(l):
+                    if table[i, r] == 1 or table[i, r] != table[j, r]:
+                        Y[b+j-i-1] = 7 - r
+                        break
+
+    return np.asarray(Y)
+
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
@@ -53,13 +53,14 @@ import sys
 import errno
 import numpy as np
 import scipy.spatial.distance as sp_distance
+from multiprocessing.pool import ThreadPool
 from bamm.bamExtractor import BamExtractor as BMBE
 
 # local imports
 from profileManager import ProfileManager
 from binManager import BinManager
 from data3 import ContigParser, MappingParser
-from utils import makeSurePathExists, CSVReader
+from utils import makeSurePathExists, CSVReader, FastaReader
 from cluster import MarkerCheckTreePrinter
 import distance
 import hierarchy
@@ -84,6 +85,11 @@ class BinExtractor:
     def loadProfile(self, timer, bids=[], cutoff=0):
         removeBins = bids is None or bids == []
         return self._pm.loadData(timer, 
+                                 loadCovProfiles=False,
+                                 loadKmerSigs=False,
+                                 loadStoitNames=False,
+                                 loadContigLengths=False,
+                                 loadContigGCs=False,
                                  loadMarkers=False,
                                  loadBins=True,
                                  bids=[0] if removeBins else bids,
@@ -96,8 +102,16 @@ class BinExtractor:
                        bids=[],
                        fasta=[],
                        prefix='',
-                       cutoff=0):
-        """Extract contigs and write to file"""
+                       cutoff=0,
+                       createIndex=False,
+                       gzipOutput=False,
+                       threads=1):
+        """Extract contigs and write to file
+        
+        Contigs in an uncompressed fasta file which has a `.fai` index, or
+        when createIndex is set, are streamed from the file straight into
+        their bin files. Contigs in other files are loaded into memory first.
+        """
         
         if prefix is None or prefix == '':
             prefix=os.path.basename(self.dbFileName) \
@@ -109,8 +123,11 @@ class BinExtractor:
         
         # load all the contigs which have been assigned to bins
         cp = ContigParser()
+        reader = FastaReader()
         # contigs looks like cid->seq
         contigs = {}
+        # locations looks like cid->(file_name, index entry)
+        locations = {}
         import mimetypes
         try:
             for file_name in fasta:
@@ -124,26 +141,68 @@ class BinExtractor:
                 except:
                     print "Error when guessing contig file mimetype"
                     raise
-                with gm_open(file_name, "r") as f:
-                    cp.getWantedSeqs(f, profile.contigNames, out_dict=contigs)
+                index = reader.loadIndex(file_name, create=createIndex) if gm_open is open else None
+                if index is not None:
+                    # later files take precedence
+                    wanted = set(profile.contigNames)
+                    for entry in index:
+                        if entry[0] in wanted:
+                            locations[entry[0]] = (file_name, entry)
+                            contigs.pop(entry[0], None)
+                else:
+                    with gm_open(file_name, "r") as f:
+                        found = {}
+                        cp.getWantedSeqs(f, profile.contigNames, out_dict=found)
+                    for cid in found:
+                        locations.pop(cid, None)
+                    contigs.update(found)
         except:
             print "Could not parse contig file:",fasta[0],sys.exc_info()[0]
             raise
 
         # now print out the sequences
         print "Writing files"
-        for bid in bm.getBids():
-            file_name = os.path.join(self._outDir, "%s_bin_%d.fna" % (prefix, bid))
+        jobs = [(os.path.join(self._outDir, "%s_bin_%d.fna%s" % (prefix, bid, ".gz" if gzipOutput else "")),
+                 bm.profile.contigNames[bm.getBinIndices(bid)]) for bid in bm.getBids()]
+        write_bin = lambda job: self._writeBinContigs(job[0], job[1], contigs, locations, gzipOutput)
+        if threads > 1:
+            pool = ThreadPool(threads)
             try:
-                with open(file_name, 'w') as f:
-                    for cid in bm.profile.contigNames[bm.getBinIndices(bid)]:
-                        if(cid in contigs):
-                            f.write(">%s\n%s\n" % (cid, contigs[cid]))
-                        else:
-                            print "These are not the contigs you're looking for. ( %s )" % (cid)
-            except:
-                print "Could not open file for writing:",file_name,sys.exc_info()[0]
-                raise
+                pool.map(write_bin, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for job in jobs:
+                write_bin(job)
+                
+    def _writeBinContigs(self, file_name, cids, contigs, locations, gzipOutput=False):
+        """Write the contigs of a bin, reading indexed contigs from disk one at a time"""
+        reader = FastaReader()
+        fasta_files = {}
+        try:
+            if gzipOutput:
+                import gzip
+                out_open = gzip.open
+            else:
+                out_open = open
+            with out_open(file_name, 'w') as f:
+                for cid in cids:
+                    if(cid in contigs):
+                        f.write(">%s\n%s\n" % (cid, contigs[cid]))
+                    elif(cid in locations):
+                        (fasta_name, entry) = locations[cid]
+                        if fasta_name not in fasta_files:
+                            fasta_files[fasta_name] = open(fasta_name, "r")
+                        f.write(">%s\n%s\n" % (cid, reader.readIndexedRecord(fasta_files[fasta_name], entry)))
+                    else:
+                        print "These are not the contigs you're looking for. ( %s )" % (cid)
+        except:
+            print "Could not open file for writing:",file_name,sys.exc_info()[0]
+            raise
+        finally:
+            for fh in fasta_files.values():
+                fh.close()
 
     def extractReads(self,
                      timer,
@@ -214,6 +273,10 @@ class MarkerExtractor:
     def loadProfile(self, timer, bids=[], cutoff=0):
         removeBins = bids is None or bids == []
         return self._pm.loadData(timer,
+                                 loadCovProfiles=False,
+                                 loadKmerSigs=False,
+                                 loadStoitNames=False,
+                                 loadContigGCs=False,
                                  loadBins=True,
                                  loadMarkers=True,
                                  loadTaxstrings=True,
@@ -276,6 +339,9 @@ class BinStatsDumper:
         
     def loadProfile(self, timer):
         return self._pm.loadData(timer,
+                                 loadKmerSigs=False,
+                                 loadContigNames=False,
+                                 loadStoitNames=False,
                                  loadMarkers=True,
                                  loadBins=True,
                                  bids=[0],
@@ -384,35 +450,36 @@ class BinImporter:
                              separator):
         """Parse assignment file for bin contigs"""
         
-        profile = self.loadProfile(timer)
-        br = BinReader()
-        # looks like cid->bid
-        contig_bins = {}
-        try:
-            with open(infile, "r") as f:
-                try:
-                    (con_names, con_bins) = br.parse(f, separator)
-                    (_, con_bid) = np.unique(con_bins, return_inverse=True)
-                    con_bid += 1 # bid zero is unbinned
-                    contig_bins = dict(zip(con_names, con_bid))
-                except:
-                    print "Error parsing bin assignments"
-                    raise
-        except:
-            print "Could not parse bin assignment file:",infile,sys.exc_info()[0]
-            raise
-
-        # now get the internal indices for contigs
-        for (i, cid) in enumerate(profile.contigNames):
+        with self._pm.session(timer, mode='a'):
+            profile = self.loadProfile(timer)
+            br = BinReader()
+            # looks like cid->bid
+            contig_bins = {}
             try:
-                profile.binIds[i] = contig_bins[cid]
-            except KeyError:
-                pass
+                with open(infile, "r") as f:
+                    try:
+                        (con_names, con_bins) = br.parse(f, separator)
+                        (_, con_bid) = np.unique(con_bins, return_inverse=True)
+                        con_bid += 1 # bid zero is unbinned
+                        contig_bins = dict(zip(con_names, con_bid))
+                    except:
+                        print "Error parsing bin assignments"
+                        raise
+            except:
+                print "Could not parse bin assignment file:",infile,sys.exc_info()[0]
+                raise
+
+            # now get the internal indices for contigs
+            for (i, cid) in enumerate(profile.contigNames):
+                try:
+                    profile.binIds[i] = contig_bins[cid]
+                except KeyError:
+                    pass
         
-        # Now save all the stuff to disk!
-        print "Saving bins"
-        self._pm.setBinAssignments(profile, nuke=True)
-        print "    %s" % timer.getTimeStamp()
+            # Now save all the stuff to disk!
+            print "Saving bins"
+            self._pm.setBinAssignments(profile, nuke=True)
+            print "    %s" % timer.getTimeStamp()
 
         
 class BinReader:   
@@ -68,6 +68,11 @@ class GMProfileException(BaseException): pass
 class ContigNotFoundException(GMProfileException): pass
 class DistanceStoreContigNotFoundException(GMProfileException): pass
 
+#------------------------------------------------------------------------------
+# DATA MANAGER
+class GMDataException(BaseException): pass
+class DBReadOnlyException(GMDataException): pass
+
 #------------------------------------------------------------------------------
 # ARG PARSER
 class GMARGException(BaseException): pass
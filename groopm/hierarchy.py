@@ -52,6 +52,9 @@ import scipy.cluster.hierarchy as sp_hierarchy
 import scipy.spatial.distance as sp_distance
 import operator
 
+# local imports
+import hierarchy_ext
+
 np.seterr(all='raise')
 
 ###############################################################################
@@ -83,6 +86,21 @@ def maxscoresbelow(Z, scores, fun=np.maximum):
         clusters below cluster `i`.
     """
     Z = np.asarray(Z)
+    scores = np.asarray(scores)
+    if fun in (operator.add, np.add, max, np.maximum):
+        # compiled traversal for sums and maxima of numeric scores
+        if scores.dtype.kind in "biu":
+            score_type = np.int64
+        elif scores.dtype == np.double:
+            score_type = np.double
+        else:
+            score_type = None
+        if score_type is not None:
+            max_below_scores = hierarchy_ext.maxscoresbelow(_linkage_children(Z),
+                                                            scores.astype(score_type),
+                                                            fun in (operator.add, np.add))
+            return max_below_scores.astype(scores.dtype, copy=False)
+        
     n = Z.shape[0]+1
     max_scores = np.copy(scores)
     max_below_scores = np.zeros(n-1, dtype=max_scores.dtype)
@@ -103,25 +121,33 @@ def iterlinkage(Z):
     """Bottom-up iteration over leaf node sets for cluster hierarchy nodes"""
     Z = np.asarray(Z)
     n = Z.shape[0]+1
-    
-    # Store cluster leaves
-    leaves_dict = dict([(i, [i]) for i in range(n)])
+    (leaves, start, end) = leaf_ranges(Z)
     
     # Bottom-up traversal
     for i in range(n-1):
-        left_child = int(Z[i, 0])
-        right_child = int(Z[i, 1])
-        current_node = n+i
-        
-        # update leaf cache
-        current_leaves = leaves_dict[left_child] + leaves_dict[right_child]
-        del leaves_dict[left_child]
-        del leaves_dict[right_child]
-        leaves_dict[current_node] = current_leaves
-        
-        yield current_leaves
+        yield leaves[start[n+i]:end[n+i]]
 
     
+def leaf_ranges(Z):
+    """Leaf ordering and leaf ranges for cluster hierarchy nodes
+    
+    Parameters
+    ----------
+    Z : ndarray
+        Linkage matrix encoding hierarchical clustering.
+        
+    Returns
+    -------
+    leaves : ndarray
+        1-D array of original observations ordered so that the observations
+        below each node are contiguous.
+    start, end : ndarray
+        1-D arrays. The observations below node `i` are
+        `leaves[start[i]:end[i]]`.
+    """
+    return hierarchy_ext.leaf_ranges(_linkage_children(Z))
+    
+    
 def fcluster_merge(Z, merge, return_nodes=False):
     """Partition a hierarchical clustering by flattening clusters.
     
@@ -146,14 +172,10 @@ def fcluster_merge(Z, merge, return_nodes=False):
         `return_nodes` is True.
     """
     Z = np.asarray(Z)
-    n = Z.shape[0]+1
     
     # Compute leaf clusters
-    leaders = np.arange(n)
-    
-    for (i, leaves) in enumerate(iterlinkage(Z)):
-        if merge[i]:
-            leaders[leaves] = n+i
+    leaders = hierarchy_ext.merge_leaders(_linkage_children(Z),
+                                          np.ascontiguousarray(merge, dtype=bool).view(np.uint8))
     
     (_, bids) = np.unique(leaders, return_inverse=True)
     
@@ -170,16 +192,8 @@ def flatten_nodes(Z):
     """Map nested cluster nodes to their earliest equal height ancestor
     """
     Z = np.asarray(Z)
-    n = Z.shape[0] + 1
-    
-    node_ids = np.arange(n-1)
-    for i in range(n-2, -1, -1):
-        children = Z[i, :2].astype(int)
-        for c in children:
-            if c >= n and Z[i, 2] == Z[c - n, 2]:
-                node_ids[c - n] = node_ids[i]
-            
-    return node_ids
+    return hierarchy_ext.flatten_nodes(_linkage_children(Z),
+                                       np.ascontiguousarray(Z[:, 2], dtype=np.double))
 
     
 def embed_nodes(Z, leaves):
@@ -234,57 +248,16 @@ def linkage_from_reachability(o, d):
     if np.all(np.argsort(o) != o):
         raise ValueError("Argument for parameter `o` must be a valid permutation array.")
         
-    n = len(o)
-    Z = np.empty((n - 1, 4), dtype=d.dtype)
-    
     # observations ordered from smallest to largest density distance. clusters
-    # will be formed by repeatedly splitting the parent cluster containing the
-    # largest distance.
+    # are formed by repeatedly splitting the parent cluster at the position of
+    # its largest distance, so that the splits form a Cartesian tree over the
+    # ordering positions. The rows in the linkage matrix encoding are in
+    # reverse splitting order (i.e. last row is first split, etc.).
     splits = reachability_splits(d)
-    # dict of { node_id: (range_from, range_to) }
-    # this encodes the range of `o` of observations below the node with `node_id` in the hierarchy
-    # the root node with id `2*n-2` contains the whole dataset
-    indices_dict = dict([(2*n-2, (0, n))])
-    
-    for i in range(n-2, -1, -1):
-        # ordering positions of observations in current cluster
-        (low, high) = indices_dict.pop(n+i)
-        # determine the next largest observation at which to split the cluster
-        split = splits[i]
-        # the split clusters will occupy ordering positions in the ranges
-        # (low, split) and (split, high)
-        
-        # determine the iterations at which the split clusters will themselves
-        # be split by finding the descendent observations with the largest
-        # density distance in the `splits` list. The rows in the linkage matrix
-        # encoding are in reverse splitting order (i.e. last row is first split,
-        # etc.).
-        if split == low + 1:
-            # singleton left cluster
-            left_node = o[low]
-        else:
-            # look in range (low, split) for position of observation with
-            # largest density distance.
-            left_node = np.flatnonzero(np.logical_and(low <= splits[:i], splits[:i] < split))[-1]+n
-            indices_dict[left_node] = (low, split)
-            
-        if split == high - 1:
-            # singleton right cluster
-            right_node = o[split]
-        else:
-            # look in range (split, high) for position of observation with
-            # largest density distance.
-            right_node = np.flatnonzero(np.logical_and(split <= splits[:i], splits[:i] < high))[-1]+n
-            indices_dict[right_node] = (split, high)
-        
-        if left_node < right_node:
-            Z[i, :2] = np.array([left_node, right_node])
-        else:
-            Z[i, :2] = np.array([right_node, left_node])
-        Z[i, 2] = d[split]
-        Z[i, 3] = high - low
-        
-    return Z
+    Z = hierarchy_ext.linkage_from_splits(o.astype(np.intp),
+                                          d.astype(np.double),
+                                          splits.astype(np.intp))
+    return Z.astype(d.dtype, copy=False)
     
     
 def reachability_splits(d):
@@ -311,20 +284,13 @@ def descendents(Z, indices, inclusive=False):
     """
     Z = np.asarray(Z)
     n = Z.shape[0] + 1
-    is_descendent = np.zeros(2*n-1, dtype=bool)
-    is_descendent_or_index = is_descendent.copy()
-    is_descendent_or_index[indices] = True
-    for i in range(n-2, -1, -1):
-        left_child = int(Z[i, 0])
-        is_descendent[left_child] = is_descendent[left_child] or is_descendent_or_index[n+i]
-        is_descendent_or_index[left_child] = is_descendent_or_index[left_child] or is_descendent[left_child]
-        
-        right_child = int(Z[i, 1])
-        is_descendent[right_child] = is_descendent[right_child] or is_descendent_or_index[n+i]
-        is_descendent_or_index[right_child] = is_descendent_or_index[right_child] or is_descendent[right_child]
+    is_index = np.zeros(2*n-1, dtype=bool)
+    is_index[indices] = True
+    is_descendent = hierarchy_ext.descendents_mask(_linkage_children(Z),
+                                                   is_index.view(np.uint8))
         
     if inclusive:
-        return np.flatnonzero(is_descendent_or_index)
+        return np.flatnonzero(np.logical_or(is_descendent, is_index))
     else:
         return np.flatnonzero(is_descendent)
     
@@ -348,17 +314,20 @@ def ancestors(Z, indices, inclusive=False):
     """
     Z = np.asarray(Z)
     n = Z.shape[0] + 1
-    isancestor = np.zeros(2*n-1, dtype=bool)
-    isancestor_or_index = isancestor.copy()
-    isancestor_or_index[indices] = True
-    for i in range(n-1):
-        isancestor[i+n] = isancestor[i+n] or isancestor_or_index[Z[i,:2].astype(int)].any()
-        isancestor_or_index[i+n] = isancestor_or_index[i+n] or isancestor[i+n]
+    is_index = np.zeros(2*n-1, dtype=bool)
+    is_index[indices] = True
+    isancestor = hierarchy_ext.ancestors_mask(_linkage_children(Z),
+                                              is_index.view(np.uint8))
         
     if inclusive:
-        return np.flatnonzero(isancestor_or_index)
+        return np.flatnonzero(np.logical_or(isancestor, is_index))
     else:
         return np.flatnonzero(isancestor)
+        
+        
+def _linkage_children(Z):
+    """Child node indices for each row of a linkage matrix"""
+    return np.ascontiguousarray(np.asarray(Z)[:, :2], dtype=np.intp)
 
         
 ###############################################################################
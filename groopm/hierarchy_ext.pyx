@@ -0,0 +1,206 @@
+# hierarchy_ext.pyx
+# cython: language_level=2, boundscheck=False, wraparound=False
+
+cimport numpy as np
+
+import numpy as np
+
+np.import_array()
+
+# score types for tree traversals
+ctypedef fused score_t:
+    np.int64_t
+    double
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+# Tree traversals. `children[i]` holds the child nodes of the cluster encoded by
+# row `i` of a linkage matrix, so that rows are ordered children first.
+
+def leaf_ranges(np.npy_intp[:, ::1] children):
+    """Leaf ordering and per-node leaf ranges of a cluster hierarchy.
+
+    Returns arrays `(leaves, start, end)`, such that the leaves below node
+    `k` are `leaves[start[k]:end[k]]`.
+    """
+    cdef np.npy_intp n = children.shape[0] + 1
+    cdef np.npy_intp[::1] leaves = np.empty(n, dtype=np.intp)
+    cdef np.npy_intp[::1] start = np.zeros(2*n-1, dtype=np.intp)
+    cdef np.npy_intp[::1] end = np.ones(2*n-1, dtype=np.intp)
+    cdef np.npy_intp i, l, r
+
+    # bottom-up pass for cluster sizes
+    for i in range(n - 1):
+        end[n+i] = end[children[i, 0]] + end[children[i, 1]]
+
+    # top-down pass for leaf range starts
+    for i in range(n - 2, -1, -1):
+        l = children[i, 0]
+        r = children[i, 1]
+        start[l] = start[n+i]
+        start[r] = start[n+i] + end[l]
+
+    for i in range(2*n-1):
+        end[i] += start[i]
+    for i in range(n):
+        leaves[start[i]] = i
+    return (np.asarray(leaves), np.asarray(start), np.asarray(end))
+
+
+def maxscoresbelow(np.npy_intp[:, ::1] children,
+                   score_t[::1] scores,
+                   bint add):
+    """Maximum cumulative score of disjoint clusters below each cluster node.
+
+    Child scores are combined by adding if `add` is set, otherwise by taking
+    the maximum.
+    """
+    cdef np.npy_intp n = children.shape[0] + 1
+    cdef score_t[::1] max_scores = np.array(scores, copy=True)
+    cdef score_t[::1] max_below = np.empty(n - 1, dtype=np.asarray(scores).dtype)
+    cdef score_t a, b, v
+    cdef np.npy_intp i
+    for i in range(n - 1):
+        a = max_scores[children[i, 0]]
+        b = max_scores[children[i, 1]]
+        if add:
+            v = a + b
+        else:
+            v = a if a > b else b
+        max_below[i] = v
+        if v > max_scores[n+i]:
+            max_scores[n+i] = v
+    return np.asarray(max_below)
+
+
+def descendents_mask(np.npy_intp[:, ::1] children,
+                     np.uint8_t[::1] is_index):
+    """Flag nodes with an ancestor in `is_index` (top-down pass)"""
+    cdef np.npy_intp n = children.shape[0] + 1
+    cdef np.uint8_t[::1] out = np.zeros(2*n-1, dtype=np.uint8)
+    cdef np.npy_intp i
+    for i in range(n - 2, -1, -1):
+        if out[n+i] or is_index[n+i]:
+            out[children[i, 0]] = 1
+            out[children[i, 1]] = 1
+    return np.asarray(out).view(bool)
+
+
+def ancestors_mask(np.npy_intp[:, ::1] children,
+                   np.uint8_t[::1] is_index):
+    """Flag nodes with a descendent in `is_index` (bottom-up pass)"""
+    cdef np.npy_intp n = children.shape[0] + 1
+    cdef np.uint8_t[::1] out = np.zeros(2*n-1, dtype=np.uint8)
+    cdef np.npy_intp i, l, r
+    for i in range(n - 1):
+        l = children[i, 0]
+        r = children[i, 1]
+        if out[l] or is_index[l] or out[r] or is_index[r]:
+            out[n+i] = 1
+    return np.asarray(out).view(bool)
+
+
+def merge_leaders(np.npy_intp[:, ::1] children,
+                  np.uint8_t[::1] merge):
+    """Highest merged ancestor node of each leaf, or the leaf itself if no
+    ancestor is merged (top-down pass)
+    """
+    cdef np.npy_intp n = children.shape[0] + 1
+    cdef np.npy_intp[::1] top = np.full(2*n-1, -1, dtype=np.intp)
+    cdef np.npy_intp i
+    for i in range(n - 2, -1, -1):
+        if top[n+i] == -1 and merge[i]:
+            top[n+i] = n+i
+        top[children[i, 0]] = top[n+i]
+        top[children[i, 1]] = top[n+i]
+    for i in range(n):
+        if top[i] == -1:
+            top[i] = i
+    return np.asarray(top[:n])
+
+
+def flatten_nodes(np.npy_intp[:, ::1] children,
+                  double[::1] heights):
+    """Earliest equal height ancestor row of each row (top-down pass)"""
+    cdef np.npy_intp n = children.shape[0] + 1
+    cdef np.npy_intp[::1] node_ids = np.arange(n - 1, dtype=np.intp)
+    cdef np.npy_intp i, j, c
+    for i in range(n - 2, -1, -1):
+        for j in range(2):
+            c = children[i, j]
+            if c >= n and heights[i] == heights[c-n]:
+                node_ids[c-n] = node_ids[i]
+    return np.asarray(node_ids)
+
+
+# hot loop
+def linkage_from_splits(np.npy_intp[::1] o,
+                        double[::1] d,
+                        np.npy_intp[::1] splits):
+    """Linkage matrix from reachability ordering `o`, distances `d` and split
+    positions `splits` in order of increasing distance.
+
+    The splits form a Cartesian tree over reachability positions, with the
+    position split last at the root. The tree is built in a single pass using
+    a stack of positions on the current right spine, after which each row of
+    the linkage matrix is filled in from the child splits.
+    """
+    cdef np.npy_intp n = o.shape[0]
+    cdef np.ndarray[np.double_t, ndim=2] Z = np.empty((max(n - 1, 0), 4), dtype=np.double)
+    if n < 2:
+        return Z
+    cdef np.npy_intp[::1] rank = np.empty(n, dtype=np.intp)
+    cdef np.npy_intp[::1] left = np.full(n, -1, dtype=np.intp)
+    cdef np.npy_intp[::1] right = np.full(n, -1, dtype=np.intp)
+    cdef np.npy_intp[::1] stack = np.empty(n, dtype=np.intp)
+    cdef np.npy_intp[::1] sizes = np.empty(n - 1, dtype=np.intp)
+    cdef np.npy_intp top = 0
+    cdef np.npy_intp i, p, last, a, b, size
+
+    for i in range(n):
+        rank[splits[i]] = i
+
+    # Cartesian tree over split positions, larger ranks nearer the root
+    for p in range(1, n):
+        last = -1
+        while top > 0 and rank[stack[top-1]] < rank[p]:
+            top -= 1
+            last = stack[top]
+        left[p] = last
+        if top > 0:
+            right[stack[top-1]] = p
+        stack[top] = p
+        top += 1
+
+    # rows in order of increasing split distance, children before parents
+    for i in range(n - 1):
+        p = splits[i]
+        if left[p] == -1:
+            # singleton left cluster
+            a = o[p-1]
+            size = 1
+        else:
+            a = n + rank[left[p]]
+            size = sizes[rank[left[p]]]
+        if right[p] == -1:
+            # singleton right cluster
+            b = o[p]
+            size += 1
+        else:
+            b = n + rank[right[p]]
+            size += sizes[rank[right[p]]]
+        sizes[i] = size
+        Z[i, 0] = a if a < b else b
+        Z[i, 1] = b if a < b else a
+        Z[i, 2] = d[p]
+        Z[i, 3] = size
+    return Z
+
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
@@ -72,35 +72,36 @@ class BinImporter:
                              separator):
         """Parse assignment file for bin contigs"""
         
-        profile = self.loadProfile(timer)
-        br = BinReader()
-        # looks like cid->bid
-        contig_bins = {}
-        try:
-            with open(infile, "r") as f:
-                try:
-                    (con_names, con_bins) = br.parse(f, separator)
-                    (_, con_bid) = np.unique(con_bins, return_inverse=True)
-                    con_bid += 1 # bid zero is unbinned
-                    contig_bins = dict(zip(con_names, con_bid))
-                except:
-                    print "Error parsing bin assignments"
-                    raise
-        except:
-            print "Could not parse bin assignment file:",infile,sys.exc_info()[0]
-            raise
-
-        # now get the internal indices for contigs
-        for (i, cid) in enumerate(profile.contigNames):
+        with self._pm.session(timer, mode='a'):
+            profile = self.loadProfile(timer)
+            br = BinReader()
+            # looks like cid->bid
+            contig_bins = {}
             try:
-                profile.binIds[i] = contig_bins[cid]
-            except KeyError:
-                pass
+                with open(infile, "r") as f:
+                    try:
+                        (con_names, con_bins) = br.parse(f, separator)
+                        (_, con_bid) = np.unique(con_bins, return_inverse=True)
+                        con_bid += 1 # bid zero is unbinned
+                        contig_bins = dict(zip(con_names, con_bid))
+                    except:
+                        print "Error parsing bin assignments"
+                        raise
+            except:
+                print "Could not parse bin assignment file:",infile,sys.exc_info()[0]
+                raise
+
+            # now get the internal indices for contigs
+            for (i, cid) in enumerate(profile.contigNames):
+                try:
+                    profile.binIds[i] = contig_bins[cid]
+                except KeyError:
+                    pass
         
-        # Now save all the stuff to disk!
-        print "Saving bins"
-        self._pm.setBinAssignments(profile, nuke=True)
-        print "    %s" % timer.getTimeStamp()
+            # Now save all the stuff to disk!
+            print "Saving bins"
+            self._pm.setBinAssignments(profile, nuke=True)
+            print "    %s" % timer.getTimeStamp()
 
         
 class BinReader:   
@@ -102,6 +102,8 @@ class ExplorePlotManager:
 
     def loadProfile(self, timer):
         return self._pm.loadData(timer,
+                                 loadContigNames=False,
+                                 loadStoitNames=False,
                                  loadMarkers=True,
                                  loadBins=True,
                                  loadReachability=True)
@@ -118,7 +120,8 @@ class ExplorePlotManager:
              groupfile="",
              separator=",",
              savedDistsPrefix="",
-             keepDists=False
+             keepDists=False,
+             maxCacheSize=None
             ):
             
         profile = self.loadProfile(timer)
@@ -153,7 +156,7 @@ class ExplorePlotManager:
         
         if savedDistsPrefix=="":
             savedDistsPrefix = self._dbFileName+".dists"
-        cacher = FileCacher(savedDistsPrefix)
+        cacher = FileCacher(savedDistsPrefix, maxSize=maxCacheSize)
 
         print "    Initialising plotter"
         fplot = ContigExplorerPlotter(profile,
@@ -252,7 +255,9 @@ class ReachabilityPlotManager:
             
     def loadProfile(self, timer):
         return self._pm.loadData(timer, loadBins=True, loadMarkers=True,
-                loadReachability=True)
+                loadReachability=True, loadCovProfiles=False, loadKmerSigs=False,
+                loadStoitNames=False, loadContigNames=False, loadContigLengths=False,
+                loadContigGCs=False)
 
         return profile
         
@@ -50,10 +50,11 @@ import numpy as np
 import scipy.spatial.distance as sp_distance
 import sys
 import os
+from contextlib import contextmanager
 
 # GroopM imports
 from data3 import DataManager, ClassificationEngine
-from utils import group_iterator
+from utils import group_iterator, lookup_indices
 from groopmExceptions import ContigNotFoundException
 import distance
 
@@ -64,6 +65,33 @@ np.seterr(all='raise')
 ###############################################################################
 ###############################################################################
 
+class _LazyFields:
+    """Mixin for data carriers with fields that are loaded on first access
+    
+    A loader is registered for a field using `defer`. On first access the
+    loader is called with the object as argument, and the result is cached
+    as a normal attribute.
+    """
+    
+    def defer(self, name, loader):
+        """Register a function to load field `name` when it is first accessed"""
+        self.__dict__.setdefault("_loaders", {})[name] = loader
+        
+    def load(self, *names):
+        """Load deferred fields now"""
+        for name in names:
+            getattr(self, name)
+        
+    def __getattr__(self, name):
+        try:
+            loader = self.__dict__["_loaders"].pop(name)
+        except KeyError:
+            raise AttributeError(name)
+        value = loader(self)
+        setattr(self, name, value)
+        return value
+        
+        
 class _Classification:
     """
     Class for carrying gene taxonomic classification data around, constructed 
@@ -95,7 +123,7 @@ class _Classification:
         return [t+self._taxons[i] for (t, i) in zip(self._ce.TAGS, self._table[index]) if i!=0]
         
     def makeDistances(self):
-        return sp_distance.pdist(self._table, self._ce.getDistance)
+        return distance.taxonomic_distance(self._table)
         
     def getPrefixed(self, taxstring):
         """Return indices of taxonomies that have the search taxonomy as a prefix"""
@@ -115,9 +143,10 @@ class _Classification:
         
         
         
-class _Mappings:
+class _Mappings(_LazyFields):
     """Class for carrying gene mapping data around, constructed using
-    ProfileManager class.
+    ProfileManager class. Taxstrings are loaded on first access unless
+    requested up front.
     
     Fields
     ------
@@ -170,9 +199,14 @@ class _Mappings:
         
         return dm
         
-class _Profile:
+class _Profile(_LazyFields):
     """Class for carrying profile data around, construct using ProfileManager class.
     
+    Contig data fields not requested from `ProfileManager.loadData` are loaded
+    from the DB for the current `indices` on first access. Accesses made within
+    a `ProfileManager.session` block share its file handle. Mappings are only
+    present if requested.
+    
     Fields
     ------
     # contig data
@@ -220,6 +254,19 @@ class ProfileManager:
     def __init__(self, dbFileName):
         # misc
         self.dbFileName = dbFileName         # db containing all the data we'd like to use
+        self._dm = DataManager()             # shares open DB handles between calls
+        
+    @contextmanager
+    def session(self, timer, mode='r', silent=False):
+        """Hold the DB open for the duration of a command
+        
+        The DB is checked and upgraded if needed before opening. Loads and
+        saves made within the block share a single file handle.
+        """
+        if not self._dm.isOpen(self.dbFileName):
+            self._dm.checkAndUpgradeDB(self.dbFileName, timer, silent=silent)
+        with self._dm.openDB(self.dbFileName, mode=mode) as h5file:
+            yield h5file
 
     def loadData(self,
                  timer,
@@ -246,160 +293,177 @@ class ProfileManager:
         if verbose:
             print "Loading data from:", self.dbFileName
             
-        dm = DataManager()
-        dm.checkAndUpgradeDB(self.dbFileName, timer, silent=silent)
-        try:
-            prof = _Profile()
+        dm = self._dm
+        with self.session(timer, silent=silent):
+            try:
+                prof = _Profile()
                  
-            # Collect contig data
-            if(loadReachability):
-                (prof.indices, prof.reachDists) = dm.getReachabilityOrder(self.dbFileName)
-                if(verbose):
-                    print "    Loaded previously clustered contigs in reachability ordering"
-                prof.numContigs = len(prof.indices)
-                prof.reachOrder = np.arange(prof.numContigs)
+                # Collect contig data
+                if(loadReachability):
+                    (prof.indices, prof.reachDists) = dm.getReachabilityOrder(self.dbFileName)
+                    if(verbose):
+                        print "    Loaded previously clustered contigs in reachability ordering"
+                    prof.numContigs = len(prof.indices)
+                    prof.reachOrder = np.arange(prof.numContigs)
                                 
-                if prof.numContigs == 0:
-                    print "    WARNING: No previously clustered contigs. Please run `core` step before proceeding."
-                    return prof
-            else:
-                # Conditional filter
-                condition = _getConditionString(minLength=minLength, bids=bids, removeBins=removeBins)
-                prof.indices = dm.getConditionalIndices(self.dbFileName,
-                                                    condition=condition)
-                if(verbose):
-                    print "    Loaded indices with condition:", condition
+                    if prof.numContigs == 0:
+                        print "    WARNING: No previously clustered contigs. Please run `core` step before proceeding."
+                        return prof
+                else:
+                    # Conditional filter
+                    condition = _getConditionString(minLength=minLength, bids=bids, removeBins=removeBins)
+                    prof.indices = dm.getConditionalIndices(self.dbFileName,
+                                                        condition=condition)
+                    if(verbose):
+                        print "    Loaded indices with condition:", condition
                     
-                prof.numContigs = len(prof.indices)
-                prof.reachOrder = np.zeros(prof.numContigs, dtype=int)
-                prof.reachDists = np.zeros(prof.numContigs, dtype=float)
+                    prof.numContigs = len(prof.indices)
+                    prof.reachOrder = np.zeros(prof.numContigs, dtype=int)
+                    prof.reachDists = np.zeros(prof.numContigs, dtype=float)
 
-                if prof.numContigs == 0:
-                    print "    WARNING: No contigs loaded using condition:", condition
-                    return prof
+                    if prof.numContigs == 0:
+                        print "    WARNING: No contigs loaded using condition:", condition
+                        return prof
 
-            if(not silent):
-                print "    Working with: %d contigs" % prof.numContigs
+                if(not silent):
+                    print "    Working with: %d contigs" % prof.numContigs
 
-            if(loadCovProfiles):
-                if(verbose):
-                    print "    Loading coverage profiles"
-                prof.covProfiles = dm.getCoverages(self.dbFileName, indices=prof.indices)
-                prof.normCoverages = dm.getNormCoverages(self.dbFileName, indices=prof.indices)
+                # defer loading of fields until first access
+                db = self.dbFileName
+                self._defer(prof, "covProfiles", lambda p: dm.getCoverages(db, indices=p.indices))
+                self._defer(prof, "normCoverages", lambda p: dm.getNormCoverages(db, indices=p.indices))
+                self._defer(prof, "kmerSigs", lambda p: dm.getKmerSigs(db, indices=p.indices))
+                self._defer(prof, "contigNames", lambda p: dm.getContigNames(db, indices=p.indices))
+                self._defer(prof, "contigLengths", lambda p: dm.getContigLengths(db, indices=p.indices))
+                self._defer(prof, "contigGCs", lambda p: dm.getContigGCs(db, indices=p.indices))
+                self._defer(prof, "stoitNames", lambda p: np.array(dm.getCovColNames(db).split(",")))
 
-            if(loadKmerSigs):
-                if(verbose):
-                    print "    Loading kmer sigs"
-                prof.kmerSigs = dm.getKmerSigs(self.dbFileName, indices=prof.indices)
+                if(loadCovProfiles):
+                    if(verbose):
+                        print "    Loading coverage profiles"
+                    prof.load("covProfiles", "normCoverages")
+
+                if(loadKmerSigs):
+                    if(verbose):
+                        print "    Loading kmer sigs"
+                    prof.load("kmerSigs")
                 
-            if(loadContigNames):
-                if(verbose):
-                    print "    Loading contig names"
-                prof.contigNames = dm.getContigNames(self.dbFileName, indices=prof.indices)
+                if(loadContigNames):
+                    if(verbose):
+                        print "    Loading contig names"
+                    prof.load("contigNames")
 
-            if(loadContigLengths):
-                prof.contigLengths = dm.getContigLengths(self.dbFileName, indices=prof.indices)
-                if(verbose):
-                    print "    Loading contig lengths (Total: %d BP)" % ( sum(prof.contigLengths) )
+                if(loadContigLengths):
+                    prof.load("contigLengths")
+                    if(verbose):
+                        print "    Loading contig lengths (Total: %d BP)" % ( sum(prof.contigLengths) )
 
-            if(loadContigGCs):
-                prof.contigGCs = dm.getContigGCs(self.dbFileName, indices=prof.indices)
-                if(verbose):
-                    print "    Loading contig GC ratios (Average GC: %0.3f)" % ( np.mean(prof.contigGCs) )
+                if(loadContigGCs):
+                    prof.load("contigGCs")
+                    if(verbose):
+                        print "    Loading contig GC ratios (Average GC: %0.3f)" % ( np.mean(prof.contigGCs) )
 
-            if(loadBins):
-                if(verbose):
-                    print "    Loading bin assignments"
-                prof.binIds = dm.getBins(self.dbFileName, indices=prof.indices)
-            else:
-                # we need zeros as bin indicies then...
-                prof.binIds = np.zeros(prof.numContigs, dtype=int)
+                if(loadBins):
+                    if(verbose):
+                        print "    Loading bin assignments"
+                    prof.binIds = dm.getBins(self.dbFileName, indices=prof.indices)
+                else:
+                    # we need zeros as bin indicies then...
+                    prof.binIds = np.zeros(prof.numContigs, dtype=int)
 
-            if(loadMarkers):
-                if verbose:
-                    print "    Loading marker data"
-                map_indices = dm.getMappingContigs(self.dbFileName)
-                map_markers = dm.getMappingMarkers(self.dbFileName)
-                
-                indices_2_rows = dict(zip(prof.indices, range(prof.numContigs)))
-                map_row_indices = []
-                map_keep = []
-                for (i, index) in enumerate(map_indices):
-                    try:
-                        row = indices_2_rows[index]
-                    except KeyError:
-                        continue
-                    map_row_indices.append(row)
-                    map_keep.append(i)
-                    
-                markers = _Mappings()
-                markers.rowIndices = np.array(map_row_indices)
-                markers.indices = np.array(map_keep, dtype=int)
-                
-                if verbose:
-                    print "    Loading marker names"
-                marker_names = dm.getMarkerNames(self.dbFileName)
-                markers.markerNames = marker_names[map_markers][markers.indices]
-                markers.numMappings = len(markers.indices)
-                
-                if loadTaxstrings:
+                if(loadMarkers):
                     if verbose:
-                        print "    Loading marker taxonomies"
-                    taxstrings = dm.getMappingTaxstrings(self.dbFileName)
-                    markers.taxstrings = taxstrings[markers.indices]
-                
-                classif = _Classification()
-                
-                if verbose:
-                    print "    Loading marker classifications"
-                map_table = dm.getClassification(self.dbFileName)
-                classif._table = map_table[map_keep]
-                
-                if verbose:
-                    print "    Loading marker taxons"
-                classif._taxons = dm.getTaxonNames(self.dbFileName)
-                
-                markers.classification = classif
-                prof.mapping = markers
+                        print "    Loading marker data"
+                    prof.mapping = self._loadMappings(prof.indices, loadTaxstrings=loadTaxstrings, verbose=verbose)
                 
-            # Stoit names
-            prof.numStoits = dm.getNumStoits(self.dbFileName)
-            if(loadStoitNames):
-                print "    Loading stoit names"
-                prof.stoitNames = np.array(dm.getCovColNames(self.dbFileName).split(","))
+                # Stoit names
+                prof.numStoits = dm.getNumStoits(self.dbFileName)
+                if(loadStoitNames):
+                    print "    Loading stoit names"
+                    prof.load("stoitNames")
             
-        except:
-            print "Error loading DB:", self.dbFileName, sys.exc_info()[0]
-            raise
+            except:
+                print "Error loading DB:", self.dbFileName, sys.exc_info()[0]
+                raise
                 
         if(not silent):
             print "    %s" % timer.getTimeStamp()
             
         return prof
         
+    def _defer(self, obj, name, loader):
+        """Register a loader for a field of a data carrier
+        
+        The loader reads within a DB session, reusing the handle of an
+        enclosing `session` block if there is one.
+        """
+        def load(o):
+            with self._dm.openDB(self.dbFileName):
+                return loader(o)
+        obj.defer(name, load)
+        
+    def _loadMappings(self, indices, loadTaxstrings=False, verbose=False):
+        """Load marker mappings to the contigs at global `indices`"""
+        dm = self._dm
+        db = self.dbFileName
+        map_indices = dm.getMappingContigs(db)
+        map_markers = dm.getMappingMarkers(db)
+    
+        # keep mappings to loaded contigs
+        map_rows = lookup_indices(indices, map_indices)
+        map_keep = np.flatnonzero(map_rows >= 0)
+        
+        markers = _Mappings()
+        markers.rowIndices = map_rows[map_keep]
+        markers.indices = map_keep
+        
+        if verbose:
+            print "    Loading marker names"
+        marker_names = dm.getMarkerNames(db)
+        markers.markerNames = marker_names[map_markers[map_keep]]
+        markers.numMappings = len(map_keep)
+        
+        self._defer(markers, "taxstrings", lambda m: dm.getMappingTaxstrings(db)[m.indices])
+        if loadTaxstrings:
+            if verbose:
+                print "    Loading marker taxonomies"
+            markers.load("taxstrings")
+        
+        classif = _Classification()
+        
+        if verbose:
+            print "    Loading marker classifications"
+        classif._table = dm.getClassification(db)[map_keep]
+        
+        if verbose:
+            print "    Loading marker taxons"
+        classif._taxons = dm.getTaxonNames(db)
+        
+        markers.classification = classif
+        return markers
+        
     def setBinAssignments(self, profile, nuke=False):
         """Save bins into the DB
         
-        dataManager.setBinAssignments needs GLOBAL row indices
-        { global_index : bid }
+        dataManager.setBinIds needs GLOBAL row indices
         """
-        assignments = dict(zip(profile.indices, profile.binIds))
-        DataManager().setBinAssignments(self.dbFileName,
-                                        assignments,
-                                        nuke=nuke)
+        self._dm.setBinIds(self.dbFileName,
+                           profile.indices,
+                           profile.binIds,
+                           nuke=nuke)
                                    
     def setReachabilityOrder(self, profile):
         """Save mapping distances
         
-        dataManager.setReachabilityOrder needs GLOBAL indices
-        [(global_index, distance)]
+        dataManager.setReachability needs GLOBAL indices
         """
-        updates = zip(profile.indices[profile.reachOrder], profile.reachDists)
-        DataManager().setReachabilityOrder(self.dbFileName, updates)
+        self._dm.setReachability(self.dbFileName,
+                                 profile.indices[profile.reachOrder],
+                                 profile.reachDists)
 
     def promptOnOverwrite(self, minimal=False):
         """Check that the user is ok with possibly overwriting the DB"""
-        if(DataManager().isClustered(self.dbFileName)):
+        if(self._dm.isClustered(self.dbFileName)):
             input_not_ok = True
             valid_responses = ['Y','N']
             vrs = ",".join([str.lower(str(x)) for x in valid_responses])
@@ -51,9 +51,10 @@ import numpy as np
 import scipy.spatial.distance as sp_distance
 import scipy.stats as sp_stats
 import os
+from multiprocessing.pool import ThreadPool
 
 # local imports
-from stream_ext import merge
+from stream_ext import merge_runs
 
 np.seterr(all='raise')
 
@@ -62,20 +63,35 @@ np.seterr(all='raise')
 ###############################################################################
 ###############################################################################
 
-def pdist_chunk(X, filename, chunk_size=None, **kwargs):
+def index_dtype(size):
+    """
+    Smallest integer data-type used to store indices into `size` values.
+    """
+    return np.uint32 if size <= 2**32 else np.int64
+    
+    
+def pdist_chunk(X, filename, chunk_size=None, threads=1, block_size=2**20, dtype=np.double, **kwargs):
     """
     Pairwise distances between observations in n-dimensional space. Output is
     written to the passed file, without loading all of the distances into memory.
     
+    Rows of the condensed output are split into blocks of roughly `block_size`
+    pairs, which are computed by a pool of `threads` threads and written into
+    their own slice of the output file. Distances are stored as `dtype`.
+    
     X and kwargs are passed to scipy `pdist` and `cdist` functions. See:
         https://docs.scipy.org/doc/scipy/reference/generated/scipy.spatial.distance.pdist.html#scipy-spatial-distance-pdist
     """
     X = np.asarray(X)
     n = X.shape[0]
     size = n * (n - 1) // 2
-    dbytes = np.dtype(np.double).itemsize
+    dbytes = np.dtype(dtype).itemsize
     bytes = long(size*dbytes)
     
+    # offsets[i] is the position of the first distance for row i
+    rows = np.arange(n, dtype=np.int64)
+    offsets = rows*n - rows*(rows+1)//2
+    
     # setup storage
     with open(filename, 'w+b') as f:
         # Allocate required space on disk
@@ -83,32 +99,64 @@ def pdist_chunk(X, filename, chunk_size=None, **kwargs):
         f.write(np.compat.asbytes("\0"))
         f.flush()
         
-        row = 0
-        k = 0
-        rem = size
-        if chunk_size is not None:
-            while rem > chunk_size:
-                storage = np.memmap(f, dtype=np.double, mode="r+", offset=k*dbytes, shape=(chunk_size,))
-                pos_storage = 0
-                while pos_storage + n-1-row < chunk_size:
-                    storage[pos_storage:pos_storage+n-1-row] = sp_distance.cdist(X[row:row+1], X[row+1:], **kwargs)
-                    pos_storage += n-1-row
-                    row += 1
+        pool = ThreadPool(threads) if threads > 1 else None
+        try:
+            row = 0
+            while row < n-1:
+                # last row (exclusive) for which distances fit into chunk
+                if chunk_size is None:
+                    end = n-1
+                else:
+                    end = np.searchsorted(offsets, offsets[row]+chunk_size, side="right")-1
+                    end = min(max(end, row+1), n-1)
+                storage = np.memmap(f, dtype=dtype, mode="r+", offset=offsets[row]*dbytes, shape=(offsets[end]-offsets[row],))
+                
+                # split rows into blocks with balanced numbers of pairs
+                starts = np.searchsorted(offsets, np.arange(offsets[row], offsets[end], block_size), side="right")-1
+                bounds = np.unique(np.concatenate((starts, [end])))
+                
+                def fill_block(block):
+                    (a, b) = block
+                    # distances within block rows, and from block rows to later rows
+                    inner = sp_distance.pdist(X[a:b], **kwargs)
+                    outer = sp_distance.cdist(X[a:b], X[b:], **kwargs)
+                    k = offsets[a]-offsets[row]
+                    l = 0
+                    for i in range(b-a):
+                        storage[k:k+b-a-1-i] = inner[l:l+b-a-1-i]
+                        k += b-a-1-i
+                        l += b-a-1-i
+                        storage[k:k+n-b] = outer[i]
+                        k += n-b
+                
+                blocks = zip(bounds[:-1], bounds[1:])
+                if pool is None:
+                    map(fill_block, blocks)
+                else:
+                    pool.map(fill_block, blocks)
                 storage.flush()
-                k += pos_storage
-                rem -= pos_storage
-        storage = np.memmap(f, dtype=np.double, mode="r+", offset=k*dbytes, shape=(rem,))
-        storage[:] = sp_distance.pdist(X[row:], **kwargs)
-        storage.flush()
+                row = end
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
 
         
-def argsort_chunk_mergesort(infilename, outfilename, chunk_size=None, dtype=np.double):
+def argsort_chunk_mergesort(infilename, outfilename, chunk_size=None, dtype=np.double, threads=1, itype=np.int):
     """
     Sort input file data and store sorting indices in an output file, without
     loading all input data into memory at once.
+    
+    Input data is split into runs which are sorted in place by a pool of
+    `threads` threads, with the total size of runs being sorted at once
+    limited to `chunk_size`. Sorted runs are then combined in a single k-way
+    merge pass.
+    
+    Input values are read as `dtype`, and sorting indices are stored as
+    `itype`.
     """
     dbytes = np.dtype(dtype).itemsize
-    ibytes = np.dtype(np.int).itemsize
+    ibytes = np.dtype(itype).itemsize
     
     # load input
     fin = open(infilename, 'r+b')
@@ -127,22 +175,22 @@ def argsort_chunk_mergesort(infilename, outfilename, chunk_size=None, dtype=np.d
     
     # helper functions
     def get_val_storage(offset, size):
-        return np.memmap(fin, dtype=np.double, mode="r+", offset=offset*dbytes, shape=(size,))
+        return np.memmap(fin, dtype=dtype, mode="r+", offset=offset*dbytes, shape=(size,))
     
     def get_ind_storage(offset, size):
-        return np.memmap(fout, dtype=np.int, mode="r+", offset=offset*ibytes, shape=(size,))
+        return np.memmap(fout, dtype=itype, mode="r+", offset=offset*ibytes, shape=(size,))
     
-    if chunk_size is not None:
-        # optimise chunk size so that the number of chunks is a power of 2
-        num_rounds = np.ceil(np.log2(size * 1. / chunk_size))
-        num_chunks = 2**num_rounds
-        chunk_size = int(np.ceil(size * 1. / num_chunks))
+    # split input into runs
+    if chunk_size is None:
+        run_size = size
+    else:
+        run_size = max(int(np.ceil(chunk_size * 1. / threads)), 1)
+    run_starts = np.arange(0, size, run_size)
+    run_lens = np.minimum(run_size, size - run_starts)
                  
-    # initial sorting of segments
-    k = 0
-    rem = size
-    while rem > 0:
-        l = rem if chunk_size is None or rem < chunk_size else chunk_size
+    # initial sorting of runs
+    def sort_run(run):
+        (k, l) = run
         val_i_storage = get_val_storage(offset=k, size=l)
         indices = np.argsort(val_i_storage)
         ind_i_storage = get_ind_storage(offset=k, size=l)
@@ -151,124 +199,81 @@ def argsort_chunk_mergesort(infilename, outfilename, chunk_size=None, dtype=np.d
         ind_i_storage.flush()
         val_i_storage.flush()
         
+    runs = zip(run_starts, run_lens)
+    if threads > 1 and len(runs) > 1:
+        pool = ThreadPool(threads)
+        try:
+            pool.map(sort_run, runs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        map(sort_run, runs)
+    
+    if len(runs) <= 1:
+        fin.close()
+        fout.close()
+        return
+    
+    # k-way merge of sorted runs into temporary files, one output chunk at a
+    # time. At most a chunk of values can be merged from each run per output
+    # chunk.
+    f2in = open(infilename+".2", "w+b")
+    f2out = open(outfilename+".2", "w+b")
+    f2in.seek(long(size*dbytes)-1, 0)
+    f2in.write(np.compat.asbytes('\0'))
+    f2in.flush()
+    f2out.seek(long(size*ibytes)-1, 0)
+    f2out.write(np.compat.asbytes('\0'))
+    f2out.flush()
+    
+    pos = np.zeros(len(runs), dtype=np.intp) # first unmerged position in runs
+    k = 0
+    rem = size
+    while rem > 0:
+        l = rem if chunk_size is None or rem < chunk_size else chunk_size
+        val_runs = []
+        ind_runs = []
+        for (start, length, p) in zip(run_starts, run_lens, pos):
+            rl = min(l, length - p)
+            if rl > 0:
+                val_runs.append(get_val_storage(offset=start+p, size=rl))
+                ind_runs.append(get_ind_storage(offset=start+p, size=rl))
+            else:
+                val_runs.append(np.empty(0, dtype=dtype))
+                ind_runs.append(np.empty(0, dtype=itype))
+        val_out = np.memmap(f2in, dtype=dtype, mode="r+", offset=k*dbytes, shape=(l,))
+        ind_out = np.memmap(f2out, dtype=itype, mode="r+", offset=k*ibytes, shape=(l,))
+        pos += merge_runs(val_runs, ind_runs, val_out, ind_out)
+        val_out.flush()
+        ind_out.flush()
+        del val_runs, ind_runs, val_out, ind_out
+        
         k += l
         rem -= l
     
-    if chunk_size is None:
-        assert rem == 0
-        return 
-        
-    
-    # standard mergesort applied to initial sorted segments
-    # loop over and merge pairs of adjacent segments, double
-    # segment size and repeat, stopping when segment size
-    # contains the entire array.
-        
-    segment_size = chunk_size
-    while segment_size < size:
-        
-        # Pairs of segments are sorted and stored into the same memory,
-        # using a buffered, chunked mergesort. A chunk of the first segment,
-        # 'i' is copied to temporary value and index buffers, then a chunk of
-        # the temporary buffer and the second segment, 'j' are read and used to
-        # sort a chunk of data into segment i, keeping track of how many values
-        # from the buffer and segment j were merged. The process repeats, with
-        # the next chunk from the first segment being buffered, and chunks from
-        # the buffer and segment j being read starting from the first unmerged
-        # elements.
-        
-        k = 0
-        rem = size
-        while rem > 0:
-            assert rem > segment_size
-            l = np.minimum(2*segment_size, rem) # size of the pair of segments
-                        
-            # we use two temporary files to buffer unsorted values and indices
-            f2in = open(infilename+".2", "w+b")
-            f2out = open(outfilename+".2", "w+b")
-            
-            def get_val_buff(offset, size):
-                return np.memmap(f2in, dtype=np.double, mode="r+", offset=offset*dbytes, shape=(size,))
-                
-            def get_ind_buff(offset, size):
-                return np.memmap(f2out, dtype=np.int, mode="r+", offset=offset*ibytes, shape=(size,))
-            
-            offset_i = 0 # segment i
-            offset_j = segment_size # segment j
-            offset_buff = 0 # buffer
-            while offset_i < l:
-                
-                # get a chunk of values and indices from segment i
-                il = np.minimum(chunk_size, l - offset_i)
-                val_i_storage = get_val_storage(offset=k+offset_i, size=il)
-                ind_i_storage = get_ind_storage(offset=k+offset_i, size=il)
-                
-                if offset_i < segment_size:
-                    # append the values and indices to the buffer storage
-                    val_buff = get_val_buff(offset=offset_i, size=il)
-                    ind_buff = get_ind_buff(offset=offset_i, size=il)
-                    val_buff[:] = val_i_storage
-                    ind_buff[:] = ind_i_storage
-                    val_buff.flush()
-                    ind_buff.flush()
-                    
-                
-                # next chunk from buffer to be merged
-                buffl = np.minimum(chunk_size, segment_size - offset_buff)
-                val_buff= get_val_buff(offset=offset_buff, size=buffl)
-                ind_buff = get_ind_buff(offset=offset_buff, size=buffl)
-                
-                # next chunk from segment j to be merged
-                jl = np.minimum(chunk_size, l - offset_j)
-                val_j_storage = get_val_storage(offset=k+offset_j, size=jl)
-                ind_j_storage = get_ind_storage(offset=k+offset_j, size=jl)
-                                               
-                (pos_buff, pos_j) = merge(val_buff,
-                                          ind_buff,
-                                          val_j_storage,
-                                          ind_j_storage,
-                                          val_i_storage,
-                                          ind_i_storage)
-                
-                
-                val_i_storage.flush()
-                ind_i_storage.flush()
-                val_buff.flush()
-                ind_buff.flush()
-                val_j_storage.flush()
-                ind_j_storage.flush()
-                
-                offset_i += il # end of merged values
-                offset_j += pos_j # first unmerged position in segment j
-                offset_buff += pos_buff # first unmerged position in buffer
-                
-                
-            f2in.close()
-            os.remove(f2out.name)
-            f2out.close()
-            os.remove(f2in.name)
-            
-            k += l
-            rem -= l
-        
-        segment_size = 2 * segment_size
-        
+    # replace input and output files with merged data
     fin.close()
     fout.close()
+    f2in.close()
+    f2out.close()
+    os.rename(f2in.name, infilename)
+    os.rename(f2out.name, outfilename)
 
         
-def argrank_chunk(out_filename, indices_filename, weight_fun=None, chunk_size=None, dtype=np.double):
+def argrank_chunk(out_filename, indices_filename, weight_fun=None, chunk_size=None, dtype=np.double, threads=1, itype=np.int):
     """
-    Reads a file of sorted values and a file of ordering indices, calculates
-    fractional ranks and writes them to the first file, without loading all
-    values into memory.
+    Sorts a file of values of type `dtype`, storing ordering indices of type
+    `itype` in a second file, and calculates fractional ranks without loading
+    all values into memory.
     
-    Returns an array of ranks in the order specified by the ordering indices file.
+    Returns an array of ranks in the original order of values. Ranks are
+    calculated and returned in double precision regardless of `dtype`.
     """
     
-    argsort_chunk_mergesort(out_filename, indices_filename, chunk_size=chunk_size, dtype=dtype)
+    argsort_chunk_mergesort(out_filename, indices_filename, chunk_size=chunk_size, dtype=dtype, threads=threads, itype=itype)
     
-    ibytes = np.dtype(np.int).itemsize
+    ibytes = np.dtype(itype).itemsize
     dbytes = np.dtype(dtype).itemsize
     
     # load input
@@ -286,10 +291,10 @@ def argrank_chunk(out_filename, indices_filename, weight_fun=None, chunk_size=No
     
     # helpers
     def get_val_storage(offset, size):
-        return np.memmap(fval, dtype=np.double, mode="r+", offset=offset*dbytes, shape=(size,))
+        return np.memmap(fval, dtype=dtype, mode="r", offset=offset*dbytes, shape=(size,))
     
     def get_ind_storage(offset, size):
-        return np.memmap(find, dtype=np.int, mode="r+", offset=offset*ibytes, shape=(size,))
+        return np.memmap(find, dtype=itype, mode="r", offset=offset*ibytes, shape=(size,))
     
     def calc_fractional_ranks(inds, flag):
         """
@@ -319,6 +324,9 @@ def argrank_chunk(out_filename, indices_filename, weight_fun=None, chunk_size=No
         iflag = np.concatenate(([False], flag[:-1])).cumsum()
         return (rflag[iflag], total)
        
+    # output array
+    out = np.empty(size, dtype=np.double)
+    
     current_rank = 0
     k = 0
     rem = size
@@ -339,11 +347,11 @@ def argrank_chunk(out_filename, indices_filename, weight_fun=None, chunk_size=No
             ind_storage = get_ind_storage(offset=k, size=keep)
             flag = flag[:keep]
             
-            (val_storage[:keep], total) = calc_fractional_ranks(ind_storage, flag)
-            val_storage[:keep] += current_rank
+            (ranks, total) = calc_fractional_ranks(ind_storage, flag)
+            ranks += current_rank
+            out[ind_storage] = ranks
             current_rank += total
-            val_storage.flush()
-            ind_storage.flush()
+            del val_storage, ind_storage, ranks
             
             k += keep
             rem -= keep
@@ -354,29 +362,11 @@ def argrank_chunk(out_filename, indices_filename, weight_fun=None, chunk_size=No
     np.not_equal(val_storage[1:], val_storage[:-1], out=flag[:-1])
     
     ind_storage = get_ind_storage(offset=k, size=rem)
-    (val_storage[:], total) = calc_fractional_ranks(ind_storage, flag)
-    val_storage[:] += current_rank
+    (ranks, total) = calc_fractional_ranks(ind_storage, flag)
+    ranks += current_rank
+    out[ind_storage] = ranks
     current_rank += total
-    val_storage.flush()
-    ind_storage.flush()
-    
-    # output array
-    out = np.empty(size, dtype=np.double)
-    
-    k = 0
-    rem = size
-    if chunk_size is not None:
-        while rem > 0:
-            l = np.minimum(rem, chunk_size)
-            val_storage = get_val_storage(offset=k, size=l)
-            ind_storage = get_ind_storage(offset=k, size=l)
-            
-            out[ind_storage] = val_storage
-            val_storage.flush()
-            ind_storage.flush()
-            
-            k += l
-            rem -= l
+    del val_storage, ind_storage, ranks
     
     find.close()
     fval.close()
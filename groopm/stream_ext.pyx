@@ -3,6 +3,18 @@
 #import cython
 cimport numpy as np
 
+# storage types for streamed values and indices
+ctypedef fused val_t:
+    float
+    double
+    
+ctypedef fused ind_t:
+    np.uint32_t
+    np.int_t
+from libc.stdlib cimport malloc, free
+
+import numpy as np
+
 # hot loop
 def merge(np.ndarray[np.double_t] x,
           np.ndarray[np.int_t] x_inds,
@@ -28,6 +40,89 @@ def merge(np.ndarray[np.double_t] x,
             i += 1
     #assert i + j == out_len
     return (i, j)
+    
+    
+cdef inline bint _run_less(val_t** vals, np.npy_intp* pos, np.npy_intp r, np.npy_intp s):
+    # ties are broken by run order to keep the merge stable
+    return vals[r][pos[r]] < vals[s][pos[s]] or (vals[r][pos[r]] == vals[s][pos[s]] and r < s)
+    
+    
+cdef void _sift_down(np.npy_intp* heap, np.npy_intp size, val_t** vals, np.npy_intp* pos):
+    cdef np.npy_intp p = 0
+    cdef np.npy_intp c, t
+    while True:
+        c = 2*p + 1
+        if c >= size:
+            break
+        if c + 1 < size and _run_less(vals, pos, heap[c+1], heap[c]):
+            c += 1
+        if not _run_less(vals, pos, heap[c], heap[p]):
+            break
+        t = heap[p]
+        heap[p] = heap[c]
+        heap[c] = t
+        p = c
+        
+        
+# hot loop
+def merge_runs(list vals,
+               list inds,
+               val_t[::1] out,
+               ind_t[::1] out_inds):
+    """k-way merge of sorted runs of values `vals` and their indices `inds`
+    into `out` and `out_inds`, using a heap of run heads. Stops when `out` is
+    full or the runs are exhausted. Runs must have the same types as the
+    output arrays.
+    
+    Returns an array of the number of values merged from each run.
+    """
+    cdef np.npy_intp k = len(vals)
+    cdef np.npy_intp out_len = out.shape[0]
+    cdef val_t** v = <val_t**> malloc(k * sizeof(val_t*))
+    cdef ind_t** w = <ind_t**> malloc(k * sizeof(ind_t*))
+    cdef np.npy_intp* lens = <np.npy_intp*> malloc(k * sizeof(np.npy_intp))
+    cdef np.npy_intp* heap = <np.npy_intp*> malloc(k * sizeof(np.npy_intp))
+    cdef np.npy_intp[::1] pos = np.zeros(k, dtype=np.intp)
+    cdef val_t[::1] run_vals
+    cdef ind_t[::1] run_inds
+    cdef np.npy_intp size = 0
+    cdef np.npy_intp i, j, r
+    try:
+        for r in range(k):
+            run_vals = vals[r]
+            run_inds = inds[r]
+            if run_inds.shape[0] != run_vals.shape[0]:
+                raise ValueError("Run values and indices must have equal lengths.")
+            lens[r] = run_vals.shape[0]
+            if lens[r] > 0:
+                v[r] = &run_vals[0]
+                w[r] = &run_inds[0]
+                # build heap of non-empty runs by sifting up
+                j = size
+                heap[j] = r
+                size += 1
+                while j > 0 and _run_less(v, &pos[0], heap[j], heap[(j-1)//2]):
+                    heap[j] = heap[(j-1)//2]
+                    heap[(j-1)//2] = r
+                    j = (j-1)//2
+                    
+        for i in range(out_len):
+            if size == 0:
+                break
+            r = heap[0]
+            out[i] = v[r][pos[r]]
+            out_inds[i] = w[r][pos[r]]
+            pos[r] += 1
+            if pos[r] == lens[r]:
+                size -= 1
+                heap[0] = heap[size]
+            _sift_down(heap, size, v, &pos[0])
+    finally:
+        free(v)
+        free(w)
+        free(lens)
+        free(heap)
+    return np.asarray(pos)
         
     
     
@@ -29,12 +29,51 @@ from nose.tools import assert_true
 from tools import equal_arrays
 import numpy as np
 import numpy.random as np_random
-from groopm.classification import greedy_clique_by_elimination
+import scipy.spatial.distance as sp_distance
+from groopm.classification import (greedy_clique_by_elimination,
+                                   TaxonomicConnectivity)
+from groopm.data3 import ClassificationEngine
 
 ###############################################################################
 ###############################################################################
 ###############################################################################
 ###############################################################################
+
+def test_TaxonomicConnectivity():
+    ce = ClassificationEngine()
+    
+    def _test_one():
+        m = np_random.random_integers(2, 60)
+        # random taxonomies with untagged ranks and empty tags
+        table = np_random.choice([0, 1, 2, 3, 4], size=(m, 7), p=[.25, .1, .3, .2, .15])
+        d = np_random.random_integers(1, 8)
+        L = sp_distance.squareform(sp_distance.pdist(table, ce.getDistance)) < d
+        L[np.diag_indices(m)] = True
+        
+        tc = TaxonomicConnectivity(table, d=d)
+        indices = np_random.permutation(m)[:np_random.random_integers(1, m)]
+        assert_true(equal_arrays(tc.connected(indices), L[np.ix_(indices, indices)]),
+                    "computes connectivity matrix for taxonomic distances less than d")
+        groups = tc.groups()
+        C = tc.connectedGroups(groups, groups)
+        C[np.diag_indices(m)] = True
+        assert_true(equal_arrays(C, L),
+                    "computes connectivity between groups of mappings")
+        group_ids = np.unique(groups)
+        CG = tc.connectedGroups(group_ids, group_ids)
+        above = tc.connectedGroupsAbove(group_ids)
+        (starts, ends) = tc.connectedGroupRanges(group_ids)
+        assert_true(all([sorted(above[i][above[i] >= 0]) + range(starts[i], ends[i]) == list(np.flatnonzero(CG[i]))
+                         for i in range(len(group_ids))]),
+                    "finds connected groups above and in a range below each group")
+        values = np_random.randint(0, 4, m)
+        assert_true(all([equal_arrays(counts, [np.bincount(values[L[i]], minlength=values.max()+1) for i in indices])
+                         for (indices, counts) in tc.iterNeighbourCounts(values, chunkSize=7)]),
+                    "counts values of connected mappings")
+        
+    for _ in range(20):
+        _test_one()
+        
                                     
 def test_greedy_clique_by_elimination():
     #
@@ -26,10 +26,27 @@ __email__ = "tim.lamberton@gmail.com"
 
 from nose.tools import assert_true
 import numpy as np
+import numpy.random as np_random
+import scipy.spatial.distance as sp_distance
+import scipy.cluster.hierarchy as sp_hierarchy
+import os
+import shutil
+import tempfile
+import time
 
 # local imports
 from tools import equal_arrays, is_isomorphic
-from groopm.cluster import ClusterQualityEngine, FlatClusterEngine
+from groopm.distance import condensed_index
+from groopm.cluster import (ClusterQualityEngine,
+                            MarkerCheckCQE,
+                            FlatClusterEngine,
+                            KNNProfileDistanceEngine,
+                            StreamingProfileDistanceEngine,
+                            FileCacher,
+                            TablesCacher,
+                            cache_key)
+from groopm.groopmExceptions import CacheUnavailableException
+from groopm.profileManager import _Profile, _Mappings, _Classification
 
 ###############################################################################
 ###############################################################################
@@ -95,6 +112,35 @@ def test_ClusterQualityEngine():
                 "computes non-trivial function of combined leaf data points")
              
              
+def test_MarkerCheckCQE():
+    
+    def _test_one():
+        n = np_random.random_integers(2, 50)
+        m = np_random.random_integers(1, 60)
+        mapping = _Mappings()
+        mapping.rowIndices = np.sort(np_random.randint(0, n, m))
+        mapping.markerNames = np.array(["PF0000%d" % i for i in np_random.randint(0, 5, m)])
+        mapping.numMappings = m
+        # random taxonomies with untagged ranks to generate non-transitive similarities
+        table = np.zeros((m, 7), dtype=int)
+        table[:, 0] = 2
+        table[:, 1] = np_random.choice([0, 3, 4], m)
+        table[:, 2] = np.where(table[:, 1] > 0, np_random.choice([0, 5, 6], m), 0)
+        mapping.classification = _Classification()
+        mapping.classification._table = table
+        mapping.classification._taxons = np.array(["", "", "Bacteria", "P1", "P2", "C1", "C2"])
+        profile = _Profile()
+        profile.mapping = mapping
+        
+        Z = sp_hierarchy.linkage(np_random.rand(n, 2), method="average")
+        qe = MarkerCheckCQE(profile)
+        assert_true(np.allclose(qe.makeScores(Z), ClusterQualityEngine.makeScores(qe, Z), rtol=1e-12, atol=0),
+                    "computes scores incrementally matching scores from concatenated leaf data")
+        
+    for _ in range(20):
+        _test_one()
+             
+             
 class ClusterEngineTester(FlatClusterEngine):
     def __init__(self, scores, qualities):
         self.getScores = lambda _: scores
@@ -236,6 +282,140 @@ def test_ClusterEngineTester():
                 "merges nested clusters of equal height when parent cluster "
                 "would be merged with non-nested descendents")
         
+        
+def test_KNNProfileDistanceEngine():
+    n = 50
+    covProfiles = np_random.rand(n, 3)
+    kmerSigs = np_random.rand(n, 5)
+    contigLengths = np_random.random_integers(1000, 5000, size=n)
+    
+    de = KNNProfileDistanceEngine(5)
+    (i, j) = de.makeNeighbours(covProfiles, kmerSigs)
+    assert_true(np.all(i < j) and len(np.unique(i*n+j)) == len(i),
+                "returns unique pairs of neighbours")
+    Y = sp_distance.pdist(covProfiles)
+    nearest = [np.flatnonzero(np.arange(n)!=k)[Y[condensed_index(n, k, np.flatnonzero(np.arange(n)!=k))].argmin()] for k in range(n)]
+    pairs = set(zip(i, j))
+    assert_true(all((min(k, l), max(k, l)) in pairs for (k, l) in enumerate(nearest)),
+                "includes nearest neighbour in coverage space of each contig")
+    
+    (i, j, cov_ranks, kmer_ranks) = KNNProfileDistanceEngine(n).makeRanks(covProfiles, kmerSigs, contigLengths, silent=True)
+    assert_true(len(i) == n*(n-1)//2,
+                "includes all pairs when number of neighbours is large")
+    dists = Y[condensed_index(n, i, j)]
+    assert_true(np.all(np.diff(cov_ranks[dists.argsort()]) >= 0),
+                "approximate ranks are monotonic in distance")
+    
+    G = KNNProfileDistanceEngine(5).makeRankStat(covProfiles, kmerSigs, contigLengths, silent=True)
+    assert_true(G.shape == (n, n) and (G != G.T).nnz == 0,
+                "returns a symmetric sparse matrix")
+        
+    
+
+def test_StreamingProfileDistanceEngine():
+    n = 50
+    covProfiles = np_random.rand(n, 3)
+    kmerSigs = np_random.rand(n, 5)
+    contigLengths = np_random.random_integers(1000, 5000, size=n)
+    
+    workingDir = tempfile.mkdtemp(prefix="test_cluster")
+    try:
+        de = StreamingProfileDistanceEngine(FileCacher(os.path.join(workingDir, "full.dists")), size=100)
+        (cov_ranks, kmer_ranks) = de.makeRanks(covProfiles, kmerSigs, contigLengths, silent=True)
+        dists = de.makeRankStat(covProfiles, kmerSigs, contigLengths, silent=True)
+        assert_true(np.all(dists == cov_ranks + kmer_ranks),
+                    "sums coverage and kmer ranks")
+        
+        # cache only has room for one of the rank arrays
+        for cacher in [FileCacher(os.path.join(workingDir, "small.dists"), maxSize=n*(n-1)//2*8+10),
+                       TablesCacher(os.path.join(workingDir, "small.h5"), maxSize=n*(n-1)//2*8+10)]:
+            de = StreamingProfileDistanceEngine(cacher, size=100)
+            assert_true(np.all(de.makeRankStat(covProfiles, kmerSigs, contigLengths, silent=True) == dists),
+                        "keeps ranks in use when cache size limit is smaller than both rank arrays")
+            assert_true(np.all(de.makeRankStat(covProfiles, kmerSigs, contigLengths, silent=True) == dists),
+                        "computes same statistic from partially cached ranks")
+    finally:
+        shutil.rmtree(workingDir)
+        
+    
+def test_cache_key():
+    a = np_random.rand(10, 3)
+    l = np_random.random_integers(1000, 5000, size=10)
+    assert_true(cache_key("cov", a, l, metric="euclidean") == cache_key("cov", a.copy(), l.copy(), metric="euclidean"),
+                "returns same key for equal inputs")
+    assert_true(cache_key("cov", a, l, metric="euclidean") != cache_key("cov", a[:9], l[:9], metric="euclidean"),
+                "returns different keys for different inputs")
+    assert_true(cache_key("cov", a, l, metric="euclidean") != cache_key("cov", a, l, metric="cityblock"),
+                "returns different keys for different parameters")
+    
+    
+def _is_unavailable(cacher, key):
+    try:
+        cacher.get(key)
+    except CacheUnavailableException:
+        return True
+    return False
+    
+    
+def test_FileCacher():
+    workingDir = tempfile.mkdtemp(prefix="test_cluster")
+    try:
+        cacher = FileCacher(os.path.join(workingDir, "test.dists"), maxSize=2*10*8)
+        values = [np_random.rand(10) for _ in range(3)]
+        cacher.store("a", values[0])
+        time.sleep(0.01)
+        cacher.store("b", values[1])
+        time.sleep(0.01)
+        assert_true(equal_arrays(cacher.get("a"), values[0]),
+                    "retrieves stored values")
+        time.sleep(0.01)
+        cacher.store("c", values[2])
+        assert_true(_is_unavailable(cacher, "b"),
+                    "removes least recently used values when over size limit")
+        assert_true(equal_arrays(cacher.get("a"), values[0]) and equal_arrays(cacher.get("c"), values[2]),
+                    "keeps recently used values")
+        time.sleep(0.01)
+        cacher.get("c")
+        time.sleep(0.01)
+        cacher.store("b", values[1], keep=["a"])
+        assert_true(_is_unavailable(cacher, "c"),
+                    "removes recently used values not in use")
+        assert_true(equal_arrays(cacher.get("a"), values[0]) and equal_arrays(cacher.get("b"), values[1]),
+                    "keeps values in use")
+        cacher.cleanup(silent=True)
+        assert_true(len(os.listdir(workingDir)) == 0,
+                    "removes created files on cleanup")
+    finally:
+        shutil.rmtree(workingDir)
+        
+        
+def test_TablesCacher():
+    workingDir = tempfile.mkdtemp(prefix="test_cluster")
+    try:
+        cacher = TablesCacher(os.path.join(workingDir, "test.dists.h5"), maxSize=2*10*8)
+        values = [np_random.rand(10) for _ in range(3)]
+        cacher.store("a", values[0])
+        time.sleep(0.01)
+        cacher.store("b", values[1])
+        time.sleep(0.01)
+        assert_true(equal_arrays(cacher.get("a"), values[0]),
+                    "retrieves stored values")
+        time.sleep(0.01)
+        cacher.store("c", values[2])
+        assert_true(_is_unavailable(cacher, "b"),
+                    "removes least recently used values when over size limit")
+        assert_true(equal_arrays(cacher.get("a"), values[0]) and equal_arrays(cacher.get("c"), values[2]),
+                    "keeps recently used values")
+        time.sleep(0.01)
+        cacher.get("c")
+        time.sleep(0.01)
+        cacher.store("b", values[1], keep=["a"])
+        assert_true(_is_unavailable(cacher, "c"),
+                    "removes recently used values not in use")
+        assert_true(equal_arrays(cacher.get("a"), values[0]) and equal_arrays(cacher.get("b"), values[1]),
+                    "keeps values in use")
+    finally:
+        shutil.rmtree(workingDir)
     
                         
 ###############################################################################
@@ -0,0 +1,306 @@
+###############################################################################
+#                                                                             #
+#    This library is free software; you can redistribute it and/or            #
+#    modify it under the terms of the GNU Lesser General Public               #
+#    License as published by the Free Software Foundation; either             #
+#    version 3.0 of the License, or (at your option) any later version.       #
+#                                                                             #
+#    This library is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU        #
+#    Lesser General Public License for more details.                          #
+#                                                                             #
+#    You should have received a copy of the GNU Lesser General Public         #
+#    License along with this library.                                         #
+#                                                                             #
+###############################################################################
+
+__author__ = "Tim Lamberton"
+__copyright__ = "Copyright 2016"
+__credits__ = ["Tim Lamberton"]
+__license__ = "GPL3"
+__maintainer__ = "Tim Lamberton"
+__email__ = "tim.lamberton@gmail.com"
+
+###############################################################################
+
+from nose.tools import assert_true, assert_raises
+import numpy as np
+import numpy.random as np_random
+import tables
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+
+# local imports
+from tools import equal_arrays
+from groopm.data3 import (DataManager,
+                          ContigParser,
+                          KmerSigEngine,
+                          __current_GMDB_version__)
+from groopm.groopmTimekeeper import TimeKeeper
+from groopm.groopmExceptions import DBReadOnlyException
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+class TestDataManager:
+
+    @classmethod
+    def setup_class(self):
+        self.workingDir = tempfile.mkdtemp(prefix="test_data3", dir=os.path.join(os.path.split(__file__)[0]))
+        self.dbFileName = os.path.join(self.workingDir, "test_data3.gm")
+        self.dataManager = DataManager()
+        dm = self.dataManager
+
+        self.numCons = 3000
+        self.mers = ["AAAA", "AAAC", "AAAG"]
+        self.stoits = ["s1", "s2"]
+        self.kmerSigs = np_random.rand(self.numCons, len(self.mers))
+        self.covProfiles = np_random.rand(self.numCons, len(self.stoits))
+        self.normCoverages = np_random.rand(self.numCons, 1)
+        self.contigNames = np.array(["contig_%d" % i for i in range(self.numCons)])
+        self.bins = np_random.randint(0, 4, self.numCons)
+        self.lengths = np_random.randint(1000, 10000, self.numCons)
+        self.gcs = np_random.rand(self.numCons)
+        self.reachOrder = np_random.permutation(self.numCons)
+        self.reachDists = np_random.rand(self.numCons)
+        self.markerNames = np.array(["PF0000%d" % i for i in range(5)])
+        self.mappingMarkers = np_random.randint(0, 5, 12)
+        self.mappingContigs = np_random.randint(0, self.numCons, 12)
+        self.mappingTaxstrings = np.array(["d__Bacteria;p__P%d" % i for i in range(12)])
+        self.classification = np_random.randint(0, 10, (12, 7))
+
+        self.createDB(self.dbFileName, __current_GMDB_version__)
+        
+    @classmethod
+    def createDB(self, dbFileName, formatVersion):
+        dm = self.dataManager
+        with tables.open_file(dbFileName, "w") as h5file:
+            profile_group = h5file.create_group("/", "profile")
+            if formatVersion < 7:
+                h5file.create_table(profile_group, "kms",
+                                    np.array([tuple(r) for r in self.kmerSigs], dtype=dm.kms_desc(self.mers)))
+                h5file.create_table(profile_group, "coverage",
+                                    np.array([tuple(r) for r in self.covProfiles], dtype=dm.coverage_desc(self.stoits)))
+            else:
+                dm._createProfileArray(h5file, profile_group, "kms", self.kmerSigs, len(self.mers))
+                dm._createProfileArray(h5file, profile_group, "coverage", self.covProfiles, len(self.stoits))
+            h5file.create_table(profile_group, "normCoverage",
+                                np.array([tuple(r) for r in self.normCoverages], dtype=dm.normCoverage_desc))
+
+            meta_group = h5file.create_group("/", "meta")
+            h5file.create_table(meta_group, "contigs",
+                                np.array(zip(self.contigNames, self.bins, self.lengths, self.gcs), dtype=dm.contigs_desc))
+            h5file.create_table(meta_group, "reachability",
+                                np.array(zip(self.reachOrder, self.reachDists), dtype=dm.reachability_desc))
+            h5file.create_table(meta_group, "meta",
+                                np.array([(",".join(self.stoits), len(self.stoits), ",".join(self.mers), 4, len(self.mers),
+                                           self.numCons, 0, 5, False, False, formatVersion)], dtype=dm.meta_desc))
+            h5file.create_table(meta_group, "markers",
+                                np.array(zip(self.markerNames, range(5)), dtype=dm.markers_desc))
+
+            mappings_group = h5file.create_group("/", "mappings")
+            h5file.create_table(mappings_group, "mappings",
+                                np.array(zip(self.mappingMarkers, self.mappingContigs, self.mappingTaxstrings), dtype=dm.mappings_desc))
+            h5file.create_table(mappings_group, "classification",
+                                np.array([tuple(r) for r in self.classification], dtype=dm.classification_desc))
+
+    @classmethod
+    def teardown_class(self):
+        shutil.rmtree(self.workingDir)
+
+    def _testLoaders(self):
+        dm = self.dataManager
+        db = self.dbFileName
+        indices = np.array([5, 2, 2, 17, 0])
+
+        assert_true(equal_arrays(dm.getKmerSigs(db), self.kmerSigs), "loads kmer signatures")
+        assert_true(equal_arrays(dm.getKmerSigs(db, indices), self.kmerSigs[indices]), "loads kmer signatures for unsorted indices")
+        assert_true(equal_arrays(dm.getCoverages(db, indices), self.covProfiles[indices]), "loads coverage profiles")
+        assert_true(equal_arrays(dm.getNormCoverages(db, indices), self.normCoverages[indices]), "loads coverage norms")
+
+        contigNames = dm.getContigNames(db, indices)
+        assert_true(equal_arrays(contigNames, self.contigNames[indices]), "loads contig names")
+        assert_true(contigNames.dtype.itemsize == max([len(s) for s in self.contigNames[indices]]), "trims string size to longest name")
+        assert_true(equal_arrays(dm.getBins(db, indices), self.bins[indices]), "loads bin assignments")
+        assert_true(equal_arrays(dm.getContigLengths(db, indices), self.lengths[indices]), "loads contig lengths")
+        assert_true(equal_arrays(dm.getContigGCs(db, indices), self.gcs[indices]), "loads contig gcs")
+        assert_true(equal_arrays(dm.getConditionalIndices(db, condition="length >= 5000"), np.flatnonzero(self.lengths >= 5000)),
+                    "finds indices of rows meeting condition")
+
+        (order, dists) = dm.getReachabilityOrder(db)
+        assert_true(equal_arrays(order, self.reachOrder) and equal_arrays(dists, self.reachDists), "loads reachability order")
+
+        assert_true(equal_arrays(dm.getMarkerNames(db), self.markerNames), "loads marker names")
+        assert_true(equal_arrays(dm.getMappingMarkers(db), self.mappingMarkers), "loads mapping markers")
+        assert_true(equal_arrays(dm.getMappingContigs(db), self.mappingContigs), "loads mapping contigs")
+        assert_true(equal_arrays(dm.getMappingTaxstrings(db), self.mappingTaxstrings), "loads mapping taxstrings")
+        assert_true(equal_arrays(dm.getClassification(db), self.classification), "loads classification table")
+
+    def testLoaders(self):
+        self._testLoaders()
+        
+        # scattered rows spanning several chunks
+        indices = np.r_[np_random.randint(0, self.numCons, 100), 0, self.numCons-1]
+        assert_true(equal_arrays(self.dataManager.getKmerSigs(self.dbFileName, indices), self.kmerSigs[indices]),
+                    "loads kmer signatures for scattered indices")
+        
+    def testUpgradeDB_6_to_7(self):
+        dm = self.dataManager
+        dbFileName = os.path.join(self.workingDir, "test_data3.v6.gm")
+        self.createDB(dbFileName, 6)
+        dm.checkAndUpgradeDB(dbFileName, TimeKeeper(), silent=True)
+        
+        assert_true(dm.getGMDBFormat(dbFileName) == 7, "updates format version")
+        with tables.open_file(dbFileName, "r") as h5file:
+            assert_true(isinstance(h5file.root.profile.kms, tables.EArray) and
+                        isinstance(h5file.root.profile.coverage, tables.EArray),
+                        "stores profiles as arrays")
+        assert_true(equal_arrays(dm.getKmerSigs(dbFileName), self.kmerSigs), "preserves kmer signatures")
+        assert_true(equal_arrays(dm.getCoverages(dbFileName), self.covProfiles), "preserves coverage profiles")
+        assert_true(equal_arrays(dm.getContigNames(dbFileName), self.contigNames), "preserves other tables")
+
+    def testOpenDB(self):
+        dm = self.dataManager
+        with dm.openDB(self.dbFileName) as h5file:
+            with dm.openDB(self.dbFileName) as h5file2:
+                assert_true(h5file is h5file2, "reuses open handle")
+            assert_true(h5file.isopen, "handle stays open until outermost block exits")
+            self._testLoaders()
+        assert_true(not h5file.isopen, "handle is closed when block exits")
+        assert_true(not dm.isOpen(self.dbFileName), "handle is released when block exits")
+
+    def testSetInSession(self):
+        dm = self.dataManager
+        db = self.dbFileName
+        new_order = np_random.permutation(self.numCons)
+        new_dists = np_random.rand(self.numCons)
+        new_bins = np_random.randint(1, 4, self.numCons)
+        with dm.openDB(db, mode='a'):
+            assert_true(not dm.isClustered(db), "reads metadata in session")
+            dm.setReachability(db, new_order, new_dists)
+            dm.setBinAssignments(db, dict(zip(range(self.numCons), new_bins)), nuke=True)
+            (order, dists) = dm.getReachabilityOrder(db)
+            assert_true(equal_arrays(order, new_order) and equal_arrays(dists, new_dists),
+                        "reads updated reachability order in session")
+            assert_true(equal_arrays(dm.getBins(db), new_bins), "reads updated bins in session")
+            assert_true(dm.isClustered(db), "reads updated metadata in session")
+        assert_true(equal_arrays(dm.getBins(db), new_bins), "updates persist after session")
+        
+        with dm.openDB(db) as h5file:
+            assert_raises(DBReadOnlyException, dm.setBinAssignments, db, {0: 1})
+            assert_true(h5file.isopen, "keeps read-only handle open after refusing a write")
+        assert_true(equal_arrays(dm.getBins(db), new_bins), "refused write leaves bins unchanged")
+        
+        # restore original table data
+        dm.setReachabilityOrder(db, zip(self.reachOrder, self.reachDists))
+        dm.setBinAssignments(db, dict(zip(range(self.numCons), self.bins)), nuke=True)
+
+    def testSetBinIds(self):
+        dm = self.dataManager
+        db = os.path.join(self.workingDir, "test_data3.bins.gm")
+        self.createDB(db, __current_GMDB_version__)
+        indices = np_random.permutation(self.numCons)[:100]
+        new_bins = np_random.randint(1, 10, 100)
+        dm.setBinIds(db, indices, new_bins)
+        
+        bins = self.bins.copy()
+        bins[indices] = new_bins
+        assert_true(equal_arrays(dm.getBins(db), bins), "updates bin assignments")
+        (bids, counts) = np.unique(bins[bins != 0], return_counts=True)
+        with tables.open_file(db, "r") as h5file:
+            bins_data = h5file.root.meta.bins.read()
+            assert_true(equal_arrays(bins_data['bid'][bins_data['bid'] != 0], bids) and
+                        equal_arrays(bins_data['numMembers'][bins_data['bid'] != 0], counts),
+                        "updates bin member counts")
+            assert_true('tmp_bids' not in h5file.root.meta, "removes pending bin assignments")
+        assert_true(dm.getNumBins(db) == len(bids), "updates number of bins")
+        
+        dm.setBinIds(db, indices[:10], new_bins[:10], nuke=True)
+        bins = np.zeros(self.numCons, dtype=int)
+        bins[indices[:10]] = new_bins[:10]
+        assert_true(equal_arrays(dm.getBins(db), bins), "clears other bins when nuking")
+        
+    def testRecoverBinAssignments(self):
+        dm = self.dataManager
+        db = os.path.join(self.workingDir, "test_data3.recover.gm")
+        self.createDB(db, __current_GMDB_version__)
+        new_bins = np_random.randint(1, 4, self.numCons)
+        with tables.open_file(db, "a") as h5file:
+            h5file.create_array(h5file.root.meta, "tmp_bids", new_bins)
+        
+        dm.checkAndUpgradeDB(db, TimeKeeper(), silent=True)
+        assert_true(equal_arrays(dm.getBins(db), new_bins), "completes interrupted bin assignment update")
+        assert_true(dm.isClustered(db), "completes interrupted metadata update")
+
+        
+        
+class TestKmerSigEngine:
+    
+    def _getKSig(self, kse, seq):
+        """Reference kmer signature, counting mers one at a time"""
+        sig = dict(zip(kse.kmerCols, [0.0] * kse.numMers))
+        num_mers = len(seq)-kse.kLen+1
+        for i in range(0,num_mers):
+            try:
+                sig[kse.llDict[seq[i:i+kse.kLen]]] += 1.0
+            except KeyError:
+                num_mers -= 1
+        return tuple([sig[x] / num_mers for x in kse.kmerCols])
+        
+    def testGetKSig(self):
+        
+        def _test_one(kLen):
+            kse = KmerSigEngine(kLen)
+            seq = "".join(np_random.choice(list("ACGTN"), size=np_random.randint(kLen+20, 2000), p=[0.24]*4+[0.04]))
+            assert_true(equal_arrays(kse.getKSig(seq), self._getKSig(kse, seq)),
+                        "computes same signature as counting each mer for kLen=%d" % kLen)
+        
+        for kLen in range(1, 7):
+            for _ in range(5):
+                _test_one(kLen)
+                
+        kse = KmerSigEngine(4)
+        assert_true(kse.numMers == 136, "folds tetramers to 136 columns")
+        assert_true(equal_arrays(kse.getKSig("NNNNNNNN"), np.zeros(136)), "returns zeros when no mers are valid")
+        assert_true(equal_arrays(kse.getKSig("ACGTAC"), kse.getKSig("GTACGT")), "counts reverse complements together")
+
+        
+        
+class TestContigParser:
+    
+    def testParse(self):
+        lines = []
+        for i in np_random.permutation(200):
+            lines.append(">contig_%d description" % i)
+            seq = "".join(np_random.choice(list("ACGTN"), size=np_random.randint(100, 3000), p=[0.24]*4+[0.04]))
+            lines.extend([seq[j:j+80] for j in range(0, len(seq), 80)])
+        fasta = "\n".join(lines)+"\n"
+        
+        kse = KmerSigEngine(4)
+        cp = ContigParser()
+        res1 = cp.parse(StringIO(fasta), 500, kse)
+        res2 = cp.parse(StringIO(fasta), 500, kse, threads=3, batchSize=17)
+        assert_true(all([equal_arrays(a, b) for (a, b) in zip(res1, res2)]),
+                    "parses same contigs using multiple threads")
+        assert_true(np.all(res1[2] >= 500), "removes contigs shorter than cutoff")
+        assert_true(equal_arrays(res1[0], np.sort(res1[0])), "sorts contigs by name")
+
+        # repeat some contigs
+        fasta += "\n".join(lines[:100])+"\n"
+        res1 = cp.parse(StringIO(fasta), 500, kse)
+        out = StringIO()
+        (con_names, con_gcs, con_lengths, con_rows) = cp.parseToFile(StringIO(fasta), 500, kse, out, threads=2, batchSize=23)
+        ksigs = np.frombuffer(out.getvalue(), dtype=np.float64).reshape(-1, kse.numMers)
+        assert_true(all([equal_arrays(a, b) for (a, b) in zip(res1, (con_names, con_gcs, con_lengths, ksigs[con_rows]))]),
+                    "streams same contigs to file using last of repeated names")
+
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
@@ -42,7 +42,9 @@ from groopm.distance import (mediod,
                              pairs,
                              condensed_index,
                              squareform_coords,
+                             taxonomic_distance,
                              logratio)
+from groopm.data3 import ClassificationEngine
 
 ###############################################################################
 ###############################################################################
@@ -365,6 +367,22 @@ def test_squareform_coords():
                 "returns upper triangular coordinates")
 
 
+def test_taxonomic_distance():
+    ce = ClassificationEngine()
+    
+    # random taxonomies with untagged ranks and empty tags
+    n = random.randint(2, 60)
+    table = np_random.choice([0, 1, 2, 3, 4], size=(n, 7), p=[.25, .1, .3, .2, .15])
+    assert_true(equal_arrays(taxonomic_distance(table),
+                             sp_distance.pdist(table, ce.getDistance)),
+                "computes taxonomic distances between rows")
+    assert_true(equal_arrays(taxonomic_distance(table, threads=2),
+                             taxonomic_distance(table)),
+                "computes identical distances using multiple threads")
+    assert_true(equal_arrays(taxonomic_distance(table[:1]), []),
+                "returns empty array for a single row")
+    
+    
 def test_logratio():
     
     m = np_random.rand(20)*random.randint(20, 2000)
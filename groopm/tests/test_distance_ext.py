@@ -0,0 +1,254 @@
+###############################################################################
+#                                                                             #
+#    This library is free software; you can redistribute it and/or            #
+#    modify it under the terms of the GNU Lesser General Public               #
+#    License as published by the Free Software Foundation; either             #
+#    version 3.0 of the License, or (at your option) any later version.       #
+#                                                                             #
+#    This library is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU        #
+#    Lesser General Public License for more details.                          #
+#                                                                             #
+#    You should have received a copy of the GNU Lesser General Public         #
+#    License along with this library.                                         #
+#                                                                             #
+###############################################################################
+
+__author__ = "Tim Lamberton"
+__copyright__ = "Copyright 2015"
+__credits__ = ["Tim Lamberton"]
+__license__ = "GPL3"
+__maintainer__ = "Tim Lamberton"
+__email__ = "tim.lamberton@gmail.com"
+
+###############################################################################
+
+from nose.tools import assert_true
+import numpy as np
+import numpy.random as np_random
+import scipy.spatial.distance as sp_distance
+import scipy.sparse as sp_sparse
+
+# local imports
+from tools import equal_arrays
+from groopm.distance import condensed_index
+from groopm.distance_ext import (core_distance,
+                                 row_core_distance,
+                                 reachability_order,
+                                 sparse_core_distance,
+                                 sparse_reachability_order)
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+def _core_distance_by_sorting(Y, w, minWt, minPts):
+    n = sp_distance.num_obs_y(Y)
+    out = np.empty(n)
+    for i in range(n):
+        others = np.flatnonzero(np.arange(n)!=i)
+        m = np.zeros(n)
+        m[others] = Y[condensed_index(n, i, others)]
+        k = np.minimum(n-1, minPts[i])
+        if w is None:
+            out[i] = np.sort(m)[k]
+        else:
+            v = np.zeros(n)
+            v[others] = w[i]*w[others]
+            sorting_indices = m.argsort()
+            k = np.minimum(int(np.sum(v[sorting_indices].cumsum() < minWt[i])), k)
+            out[i] = m[sorting_indices[k]]
+    return out
+
+    
+def test_core_distance():
+    
+    def _test_one(threads):
+        n = np_random.random_integers(2, 200)
+        # round distances to generate plenty of ties
+        Y = np.around(np_random.rand(n*(n-1)//2)*10)
+        w = np_random.random_integers(1, 20, size=n).astype(np.double)
+        minPts = np_random.random_integers(1, n+1, size=n).astype(np.intp)
+        minWt = np_random.random_integers(0, 4000, size=n).astype(np.double)
+        assert_true(equal_arrays(core_distance(Y, n, minPts, num_threads=threads),
+                                 _core_distance_by_sorting(Y, None, minWt, minPts)),
+                    "computes distance to minPts-th nearest neighbour")
+        assert_true(equal_arrays(core_distance(Y, n, minPts, weights=w, minWt=minWt, num_threads=threads),
+                                 _core_distance_by_sorting(Y, w, minWt, minPts)),
+                    "computes distance to neighbour with cumulative weight less than minWt")
+    
+    for threads in [1, 4]:
+        for _ in range(50):
+            _test_one(threads)
+            
+    def _test_float(threads):
+        n = np_random.random_integers(2, 200)
+        Y = np.around(np_random.rand(n*(n-1)//2)*10)
+        # contig length scale weights, with pairwise products above 2**53 in sum
+        w = np_random.rand(n)*1e7
+        minPts = np_random.random_integers(1, n+1, size=n).astype(np.intp)
+        minWt = np_random.rand(n)*w.sum()*w.mean()
+        assert_true(equal_arrays(core_distance(Y, n, minPts, weights=w, minWt=minWt, num_threads=threads),
+                                 _core_distance_by_sorting(Y, w, minWt, minPts)),
+                    "computes distance to neighbour with cumulative float weight less than minWt")
+            
+    for threads in [1, 4]:
+        for _ in range(20):
+            _test_float(threads)
+            
+            
+def test_row_core_distance():
+    
+    def _test_one():
+        size = np_random.random_integers(2, 40)
+        m = np.around(np_random.rand(size)*5)
+        w = np_random.rand(size)*1e5
+        s = np.sort(m)
+        # cumulative weights in a shuffled order fall on rounding boundaries
+        minWt = w[np_random.permutation(size)].cumsum()[np_random.randint(size)]
+        d = row_core_distance(m.copy(), w.copy(), size-1, minWt)
+        assert_true(s[0] <= d <= s[-1] and d in s,
+                    "selects a distance when float weight limit falls on a cumulative weight")
+        
+    for _ in range(2000):
+        _test_one()
+        
+    # rounding of partition weight sums previously looped forever on this row
+    m = np.array([3., 2., 2., 0., 0., 2., 3., 1., 0., 4., 2., 3., 0., 3., 0., 1., 1., 4., 2., 1., 3., 1.])
+    w = np.array([1865293.2657802813, 2169285.331015222, 3756559.724659986, 3600675.8094772813,
+                  3029901.676132469, 1628773.8964671022, 3928197.897697063, 1942063.2282959141,
+                  2554202.5067531927, 1852370.347089598, 2821550.5277917543, 4092416.6701035188,
+                  1576697.2356669365, 88477.84169106085, 1356009.2241147899, 3955585.9636796922,
+                  3380454.629900986, 4074109.9944067085, 621703.3651609343, 796840.6963294272,
+                  3057955.38495158, 3945495.4632805693])
+    assert_true(row_core_distance(m, w, 21, 37135799.27872626) in [2., 3.],
+                "stops when float weight limit falls on a partition boundary")
+
+            
+def _reachability_order_by_scanning(Y, core_dist=None):
+    n = sp_distance.num_obs_y(Y)
+    o = np.empty(n, dtype=np.intp)
+    to_visit = np.ones(n, dtype=bool)
+    o[0] = 0
+    to_visit[0] = False
+    d = np.empty(n, dtype=Y.dtype)
+    d[0] = 0
+    d[1:] = Y[condensed_index(n, 0, np.arange(1, n))]
+    if core_dist is not None:
+        d = np.maximum(d, core_dist[0])
+    for i in range(1, n):
+        closest = np.flatnonzero(to_visit)[d[to_visit].argmin()]
+        o[i] = closest
+        to_visit[closest] = False
+        m = Y[condensed_index(n, closest, np.flatnonzero(to_visit))]
+        if core_dist is not None:
+            m = np.maximum(m, core_dist[closest])
+        d[to_visit] = np.minimum(d[to_visit], m)
+    return (o, d[o])
+    
+    
+def test_reachability_order():
+    
+    def _test_one(n, threads):
+        # round distances to generate plenty of ties
+        Y = np.around(np_random.rand(n*(n-1)//2)*20)
+        core_dist = np.around(np_random.rand(n)*10)
+        (o1, d1) = _reachability_order_by_scanning(Y)
+        (o2, d2) = reachability_order(Y, n, num_threads=threads)
+        assert_true(equal_arrays(o1, o2) and equal_arrays(d1, d2),
+                    "returns same traversal order and distances as scanning all unvisited points")
+        (o1, d1) = _reachability_order_by_scanning(Y, core_dist)
+        (o2, d2) = reachability_order(Y, n, core_dist, num_threads=threads)
+        assert_true(equal_arrays(o1, o2) and equal_arrays(d1, d2),
+                    "returns same traversal order and distances using core distances")
+    
+    for threads in [1, 4]:
+        for _ in range(20):
+            _test_one(np_random.random_integers(2, 200), threads)
+    
+    # large enough to split sweeps across threads
+    _test_one(20000, 4)
+
+
+def _csr_arrays(Y, keep=None):
+    n = sp_distance.num_obs_y(Y)
+    G = sp_distance.squareform(Y)
+    (i, j) = np.nonzero(~np.eye(n, dtype=bool))
+    if keep is not None:
+        S = sp_distance.squareform(keep)
+        mask = S[i, j]
+        (i, j) = (i[mask], j[mask])
+    G = sp_sparse.csr_matrix((G[i, j], (i, j)), shape=(n, n))
+    G.sort_indices()
+    return (G.indptr.astype(np.intp), G.indices.astype(np.intp), G.data.astype(np.double))
+    
+    
+def test_sparse_core_distance():
+    
+    def _test_one(threads):
+        n = np_random.random_integers(2, 100)
+        Y = np.around(np_random.rand(n*(n-1)//2)*10)
+        w = np_random.random_integers(1, 20, size=n).astype(np.double)
+        minPts = np_random.random_integers(1, n+1, size=n).astype(np.intp)
+        minWt = np_random.random_integers(0, 4000, size=n).astype(np.double)
+        (indptr, indices, data) = _csr_arrays(Y)
+        assert_true(equal_arrays(sparse_core_distance(indptr, indices, data, minPts, num_threads=threads),
+                                 core_distance(Y, n, minPts)),
+                    "computes same core distances as for condensed matrix when all pairs are stored")
+        assert_true(equal_arrays(sparse_core_distance(indptr, indices, data, minPts, weights=w, minWt=minWt, num_threads=threads),
+                                 core_distance(Y, n, minPts, weights=w, minWt=minWt)),
+                    "computes same weighted core distances as for condensed matrix when all pairs are stored")
+        
+        # contig length scale float weights
+        w = np_random.rand(n)*1e7
+        minWt = np_random.rand(n)*w.sum()*w.mean()
+        assert_true(equal_arrays(sparse_core_distance(indptr, indices, data, minPts, weights=w, minWt=minWt, num_threads=threads),
+                                 _core_distance_by_sorting(Y, w, minWt, minPts)),
+                    "computes weighted core distances using float weights")
+        
+    for threads in [1, 4]:
+        for _ in range(20):
+            _test_one(threads)
+    
+    # observation 0 has neighbours 1 and 2, observation 3 has no neighbours
+    Y = np.array([1., 2., 0., 3., 0., 0.])
+    (indptr, indices, data) = _csr_arrays(Y, keep=np.array([1, 1, 0, 1, 0, 0], dtype=bool))
+    assert_true(equal_arrays(sparse_core_distance(indptr, indices, data, np.full(4, 3, dtype=np.intp)),
+                             [2., 3., 3., 0.]),
+                "uses furthest stored neighbour when neighbours are exhausted")
+    
+    
+def test_sparse_reachability_order():
+    
+    def _test_one(n):
+        Y = np.around(np_random.rand(n*(n-1)//2)*20)
+        core_dist = np.around(np_random.rand(n)*10)
+        (indptr, indices, data) = _csr_arrays(Y)
+        (o1, d1) = reachability_order(Y, n)
+        (o2, d2) = sparse_reachability_order(indptr, indices, data)
+        assert_true(equal_arrays(o1, o2) and equal_arrays(d1, d2),
+                    "returns same traversal order and distances as for condensed matrix when all pairs are stored")
+        (o1, d1) = reachability_order(Y, n, core_dist)
+        (o2, d2) = sparse_reachability_order(indptr, indices, data, core_dist)
+        assert_true(equal_arrays(o1, o2) and equal_arrays(d1, d2),
+                    "returns same traversal order and distances using core distances")
+        
+        # missing pairs are equivalent to infinite distances
+        keep = np_random.rand(n*(n-1)//2) < 0.1
+        (indptr, indices, data) = _csr_arrays(Y, keep=keep)
+        Y[~keep] = np.inf
+        (o1, d1) = reachability_order(Y, n, core_dist)
+        d1[np.isinf(d1)] = -1
+        (o2, d2) = sparse_reachability_order(indptr, indices, data, core_dist, fill=-1)
+        assert_true(equal_arrays(o1, o2) and equal_arrays(d1, d2),
+                    "jumps to lowest indexed unvisited observation between disconnected components")
+        
+    for _ in range(20):
+        _test_one(np_random.random_integers(2, 100))
+                        
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
@@ -0,0 +1,137 @@
+###############################################################################
+#                                                                             #
+#    This library is free software; you can redistribute it and/or            #
+#    modify it under the terms of the GNU Lesser General Public               #
+#    License as published by the Free Software Foundation; either             #
+#    version 3.0 of the License, or (at your option) any later version.       #
+#                                                                             #
+#    This library is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU        #
+#    Lesser General Public License for more details.                          #
+#                                                                             #
+#    You should have received a copy of the GNU Lesser General Public         #
+#    License along with this library.                                         #
+#                                                                             #
+###############################################################################
+
+__author__ = "Tim Lamberton"
+__copyright__ = "Copyright 2016"
+__credits__ = ["Tim Lamberton"]
+__license__ = "GPL3"
+__maintainer__ = "Tim Lamberton"
+__email__ = "tim.lamberton@gmail.com"
+
+###############################################################################
+
+from nose.tools import assert_true
+import numpy as np
+import numpy.random as np_random
+import os
+import gzip
+import shutil
+import tempfile
+
+# local imports
+from groopm.extract import BinExtractor
+from groopm.utils import FastaReader
+from groopm.groopmTimekeeper import TimeKeeper
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+class _StubProfile:
+    pass
+
+
+class _StubBinExtractor(BinExtractor):
+    """Bin extractor using a fixed profile instead of a DB"""
+    def __init__(self, profile, folder):
+        BinExtractor.__init__(self, "test_extract.gm", folder=folder)
+        self._profile = profile
+
+    def loadProfile(self, timer, bids=[], cutoff=0):
+        return self._profile
+
+
+class TestBinExtractor:
+
+    @classmethod
+    def setup_class(self):
+        self.workingDir = tempfile.mkdtemp(prefix="test_extract", dir=os.path.join(os.path.split(__file__)[0]))
+
+        # two fasta files which share contigs 20 to 29
+        self.indexedFasta = os.path.join(self.workingDir, "indexed.fa")
+        self.indexedRecords = self.writeFasta(self.indexedFasta, range(0, 30), 60)
+        FastaReader().loadIndex(self.indexedFasta, create=True)
+        self.plainFasta = os.path.join(self.workingDir, "plain.fa")
+        self.plainRecords = self.writeFasta(self.plainFasta, range(20, 50), 70)
+
+        self.profile = _StubProfile()
+        self.profile.contigNames = np.array(["contig_%d" % i for i in range(55)])
+        self.profile.binIds = np_random.randint(0, 4, 55)
+        self.profile.binIds[:4] = [1, 2, 3, 0]
+
+    @classmethod
+    def writeFasta(self, fileName, ids, width):
+        records = {}
+        with open(fileName, "w") as f:
+            for i in ids:
+                name = "contig_%d" % i
+                seq = "".join(np_random.choice(list("ACGT"), size=np_random.randint(1, 300)))
+                records[name] = seq
+                f.write(">%s\n" % name)
+                f.write("".join([seq[j:j+width]+"\n" for j in range(0, len(seq), width)]))
+        return records
+
+    @classmethod
+    def teardown_class(self):
+        shutil.rmtree(self.workingDir)
+
+    def _extract(self, name, fasta, threads, gzipOutput):
+        """Extract bin contigs into a new folder and read back the bin files"""
+        folder = os.path.join(self.workingDir, name)
+        be = _StubBinExtractor(self.profile, folder)
+        be.extractContigs(TimeKeeper(),
+                          fasta=fasta,
+                          prefix="test",
+                          gzipOutput=gzipOutput,
+                          threads=threads)
+        reader = FastaReader()
+        bins = {}
+        for file_name in os.listdir(folder):
+            out_open = gzip.open if gzipOutput else open
+            with out_open(os.path.join(folder, file_name)) as f:
+                bins[file_name.replace(".gz", "")] = list(reader.readFasta(f))
+        return bins
+
+    def _expectedBins(self, records):
+        bins = {}
+        for bid in range(1, 4):
+            rows = np.flatnonzero(self.profile.binIds == bid)
+            bins["test_bin_%d.fna" % bid] = [(cid, records[cid]) for cid in self.profile.contigNames[rows] if cid in records]
+        return bins
+
+    def testExtractContigs(self):
+        plain_last = dict(self.indexedRecords)
+        plain_last.update(self.plainRecords)
+        indexed_last = dict(self.plainRecords)
+        indexed_last.update(self.indexedRecords)
+
+        for (fasta, records, desc) in [([self.indexedFasta, self.plainFasta], plain_last, "unindexed"),
+                                       ([self.plainFasta, self.indexedFasta], indexed_last, "indexed")]:
+            expected = self._expectedBins(records)
+            for threads in [1, 3]:
+                for gzipOutput in [False, True]:
+                    name = "%s_%d_%s" % (desc, threads, gzipOutput)
+                    assert_true(self._extract(name, fasta, threads, gzipOutput) == expected,
+                                "writes bin contigs using %d threads%s with later %s file taking precedence" %
+                                (threads, " and gzip output" if gzipOutput else "", desc))
+
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
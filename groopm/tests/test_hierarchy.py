@@ -37,8 +37,8 @@ from groopm.hierarchy import (maxscoresbelow,
                               flatten_nodes,
                               embed_nodes,
                               linkage_from_reachability,
-                              permute_obs,
                               ancestors,
+                              descendents,
                              )
 
 ###############################################################################
@@ -306,6 +306,42 @@ def test_ancestors():
                              [5, 6, 8]),
                 "returns union of path nodes including nodes themselves when "
                 "`inclusive` flag is set")
+    
+    
+def test_descendents():
+    #
+    """Z describes tree
+        0
+        |---7---+
+        1       |
+                |
+        2---+   |-8
+            |   |
+        3   |-6-+
+        |-5-+
+        4
+    """
+    Z = np.array([[3., 4., 1., 2.],
+                  [2., 5., 1., 3.],
+                  [0., 1., 3., 2.],
+                  [6., 7., 4., 5.]])
+                  
+    assert_true(equal_arrays(descendents(Z, [8]),
+                             range(8)),
+                "returns descendents of root cluster")
+    
+    assert_true(equal_arrays(descendents(Z, [6]),
+                             [2, 3, 4, 5]),
+                "returns descendents of a single cluster")
+    
+    assert_true(equal_arrays(descendents(Z, [5, 7]),
+                             [0, 1, 3, 4]),
+                "returns union of descendents of clusters")
+                        
+    assert_true(equal_arrays(descendents(Z, [5, 7], inclusive=True),
+                             [0, 1, 3, 4, 5, 7]),
+                "returns union of descendents including clusters themselves "
+                "when `inclusive` flag is set")
              
                      
 def test_flatten_nodes():
@@ -384,7 +420,7 @@ def test_linkage_from_reachability():
                   [2., 7., 70.0, 5.]])
     
     (o, d) = distance.reachability_order(Y)
-    assert_true(equal_arrays(linkage_from_reachability(d), permute_obs(Z, o)),
+    assert_true(equal_arrays(linkage_from_reachability(o, d), Z),
                 "returns linkage corresponding to reachability ordering")
                         
     
@@ -435,7 +471,7 @@ def test_linkage_from_reachability():
                   [10., 11., 3., 7.]])
                   
     (o, d) = distance.reachability_order(Y)
-    assert_true(equal_arrays(linkage_from_reachability(d)[:, 2],
+    assert_true(equal_arrays(linkage_from_reachability(o, d)[:, 2],
                              Z[:, 2]),
                 "returns linkage with correct heights for a moderately complex "
                 "hierarchy")
@@ -0,0 +1,240 @@
+###############################################################################
+#                                                                             #
+#    This library is free software; you can redistribute it and/or            #
+#    modify it under the terms of the GNU Lesser General Public               #
+#    License as published by the Free Software Foundation; either             #
+#    version 3.0 of the License, or (at your option) any later version.       #
+#                                                                             #
+#    This library is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU        #
+#    Lesser General Public License for more details.                          #
+#                                                                             #
+#    You should have received a copy of the GNU Lesser General Public         #
+#    License along with this library.                                         #
+#                                                                             #
+###############################################################################
+
+__author__ = "Tim Lamberton"
+__copyright__ = "Copyright 2016"
+__credits__ = ["Tim Lamberton"]
+__license__ = "GPL3"
+__maintainer__ = "Tim Lamberton"
+__email__ = "tim.lamberton@gmail.com"
+
+###############################################################################
+
+from nose.tools import assert_true
+import numpy as np
+import numpy.random as np_random
+import scipy.cluster.hierarchy as sp_hierarchy
+
+# local imports
+from tools import equal_arrays
+from groopm.hierarchy import reachability_splits
+from groopm.hierarchy_ext import (linkage_from_splits,
+                                  leaf_ranges,
+                                  maxscoresbelow,
+                                  descendents_mask,
+                                  ancestors_mask,
+                                  merge_leaders,
+                                  flatten_nodes)
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+def _linkage_by_scanning(o, d):
+    n = len(o)
+    Z = np.empty((n - 1, 4))
+    splits = reachability_splits(d)
+    ranges = {2*n-2: (0, n)}
+    for i in range(n-2, -1, -1):
+        (low, high) = ranges.pop(n+i)
+        split = splits[i]
+        if split == low + 1:
+            left_node = o[low]
+        else:
+            left_node = np.flatnonzero(np.logical_and(low <= splits[:i], splits[:i] < split))[-1]+n
+            ranges[left_node] = (low, split)
+        if split == high - 1:
+            right_node = o[split]
+        else:
+            right_node = np.flatnonzero(np.logical_and(split <= splits[:i], splits[:i] < high))[-1]+n
+            ranges[right_node] = (split, high)
+        Z[i] = [min(left_node, right_node), max(left_node, right_node), d[split], high - low]
+    return Z
+    
+    
+def test_linkage_from_splits():
+    
+    def _test_one():
+        n = np_random.random_integers(2, 200)
+        o = np_random.permutation(n)
+        # round distances to generate plenty of ties
+        d = np.around(np_random.rand(n)*10)
+        splits = reachability_splits(d)
+        assert_true(equal_arrays(linkage_from_splits(o, d, splits),
+                                 _linkage_by_scanning(o, d)),
+                    "computes linkage matching cluster splitting order")
+                    
+    for _ in range(20):
+        _test_one()
+        
+    assert_true(linkage_from_splits(np.zeros(1, dtype=np.intp), np.zeros(1), np.zeros(1, dtype=np.intp)).shape == (0, 4),
+                "returns empty linkage for a single observation")
+
+        
+def _random_linkage():
+    n = np_random.random_integers(2, 200)
+    # round coordinates to generate plenty of ties
+    Z = sp_hierarchy.linkage(np.around(np_random.rand(n, 2)*10), method="single")
+    return (Z, np.ascontiguousarray(Z[:, :2], dtype=np.intp))
+    
+    
+def test_leaf_ranges():
+    
+    def _test_one():
+        (Z, children) = _random_linkage()
+        n = Z.shape[0] + 1
+        (leaves, start, end) = leaf_ranges(children)
+        assert_true(equal_arrays(leaves, sp_hierarchy.leaves_list(Z)),
+                    "orders leaves as in dendrogram")
+        assert_true(equal_arrays(end[n:] - start[n:], Z[:, 3]),
+                    "computes leaf ranges with cluster sizes")
+        (_, nodes) = sp_hierarchy.to_tree(Z, rd=True)
+        for i in np_random.randint(0, n-1, 5):
+            assert_true(equal_arrays(np.sort(leaves[start[n+i]:end[n+i]]),
+                                     np.sort(nodes[n+i].pre_order())),
+                        "computes leaf ranges containing cluster leaves")
+        
+    for _ in range(20):
+        _test_one()
+        
+        
+def test_maxscoresbelow():
+    
+    def _maxscoresbelow_by_looping(Z, scores, fun):
+        n = Z.shape[0] + 1
+        max_scores = scores.copy()
+        out = np.empty(n-1, dtype=scores.dtype)
+        for i in range(n-1):
+            out[i] = fun(max_scores[int(Z[i, 0])], max_scores[int(Z[i, 1])])
+            max_scores[n+i] = max(max_scores[n+i], out[i])
+        return out
+        
+    def _test_one():
+        (Z, children) = _random_linkage()
+        n = Z.shape[0] + 1
+        scores = np_random.randint(-5, 5, 2*n-1).astype(np.int64)
+        assert_true(equal_arrays(maxscoresbelow(children, scores, True),
+                                 _maxscoresbelow_by_looping(Z, scores, np.add)),
+                    "computes maximum sums of scores below nodes")
+        scores = np_random.rand(2*n-1)
+        assert_true(equal_arrays(maxscoresbelow(children, scores, False),
+                                 _maxscoresbelow_by_looping(Z, scores, max)),
+                    "computes maximum scores below nodes")
+        
+    for _ in range(20):
+        _test_one()
+        
+        
+def _random_indices(n):
+    is_index = np.zeros(2*n-1, dtype=bool)
+    is_index[np_random.randint(0, 2*n-1, np_random.random_integers(1, 5))] = True
+    return is_index
+    
+    
+def test_descendents_mask():
+    
+    def _descendents_by_looping(Z, is_index):
+        n = Z.shape[0] + 1
+        is_descendent = np.zeros(2*n-1, dtype=bool)
+        is_descendent_or_index = is_index.copy()
+        for i in range(n-2, -1, -1):
+            for c in Z[i, :2].astype(int):
+                is_descendent[c] = is_descendent[c] or is_descendent_or_index[n+i]
+                is_descendent_or_index[c] = is_descendent_or_index[c] or is_descendent[c]
+        return is_descendent
+        
+    def _test_one():
+        (Z, children) = _random_linkage()
+        is_index = _random_indices(Z.shape[0] + 1)
+        assert_true(equal_arrays(descendents_mask(children, is_index.view(np.uint8)),
+                                 _descendents_by_looping(Z, is_index)),
+                    "flags descendents of indices")
+        
+    for _ in range(20):
+        _test_one()
+        
+        
+def test_ancestors_mask():
+    
+    def _ancestors_by_looping(Z, is_index):
+        n = Z.shape[0] + 1
+        is_ancestor = np.zeros(2*n-1, dtype=bool)
+        is_ancestor_or_index = is_index.copy()
+        for i in range(n-1):
+            is_ancestor[n+i] = is_ancestor[n+i] or is_ancestor_or_index[Z[i, :2].astype(int)].any()
+            is_ancestor_or_index[n+i] = is_ancestor_or_index[n+i] or is_ancestor[n+i]
+        return is_ancestor
+        
+    def _test_one():
+        (Z, children) = _random_linkage()
+        is_index = _random_indices(Z.shape[0] + 1)
+        assert_true(equal_arrays(ancestors_mask(children, is_index.view(np.uint8)),
+                                 _ancestors_by_looping(Z, is_index)),
+                    "flags ancestors of indices")
+        
+    for _ in range(20):
+        _test_one()
+        
+        
+def test_merge_leaders():
+    
+    def _merge_leaders_by_looping(Z, merge):
+        n = Z.shape[0] + 1
+        leaders = np.arange(n)
+        (_, nodes) = sp_hierarchy.to_tree(Z, rd=True)
+        for i in range(n-1):
+            if merge[i]:
+                leaders[nodes[n+i].pre_order()] = n+i
+        return leaders
+        
+    def _test_one():
+        (Z, children) = _random_linkage()
+        merge = np_random.rand(Z.shape[0]) < 0.2
+        assert_true(equal_arrays(merge_leaders(children, merge.view(np.uint8)),
+                                 _merge_leaders_by_looping(Z, merge)),
+                    "assigns leaves to highest merged ancestor")
+        
+    for _ in range(20):
+        _test_one()
+        
+        
+def test_flatten_nodes():
+    
+    def _flatten_by_looping(Z):
+        n = Z.shape[0] + 1
+        node_ids = np.arange(n-1)
+        for i in range(n-2, -1, -1):
+            for c in Z[i, :2].astype(int):
+                if c >= n and Z[i, 2] == Z[c - n, 2]:
+                    node_ids[c - n] = node_ids[i]
+        return node_ids
+        
+    def _test_one():
+        (Z, children) = _random_linkage()
+        assert_true(equal_arrays(flatten_nodes(children, np.ascontiguousarray(Z[:, 2])),
+                                 _flatten_by_looping(Z)),
+                    "assigns nodes the indices of earliest equal height ancestors")
+        
+    for _ in range(20):
+        _test_one()
+        
+        
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
@@ -0,0 +1,195 @@
+###############################################################################
+#                                                                             #
+#    This library is free software; you can redistribute it and/or            #
+#    modify it under the terms of the GNU Lesser General Public               #
+#    License as published by the Free Software Foundation; either             #
+#    version 3.0 of the License, or (at your option) any later version.       #
+#                                                                             #
+#    This library is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU        #
+#    Lesser General Public License for more details.                          #
+#                                                                             #
+#    You should have received a copy of the GNU Lesser General Public         #
+#    License along with this library.                                         #
+#                                                                             #
+###############################################################################
+
+__author__ = "Tim Lamberton"
+__copyright__ = "Copyright 2016"
+__credits__ = ["Tim Lamberton"]
+__license__ = "GPL3"
+__maintainer__ = "Tim Lamberton"
+__email__ = "tim.lamberton@gmail.com"
+
+###############################################################################
+
+from nose.tools import assert_true
+import numpy as np
+import numpy.random as np_random
+import tables
+import os
+import shutil
+import tempfile
+
+# local imports
+from tools import equal_arrays
+from groopm.data3 import DataManager, __current_GMDB_version__
+from groopm.profileManager import ProfileManager
+from groopm.groopmTimekeeper import TimeKeeper
+from groopm.cluster import CoreCreator
+from groopm.extract import BinExtractor, MarkerExtractor, BinStatsDumper
+from groopm.plot import ExplorePlotManager, ReachabilityPlotManager
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+class TestProfileManager:
+
+    @classmethod
+    def setup_class(self):
+        self.workingDir = tempfile.mkdtemp(prefix="test_profileManager", dir=os.path.join(os.path.split(__file__)[0]))
+        self.dbFileName = os.path.join(self.workingDir, "test_profileManager.gm")
+
+        self.numCons = 300
+        self.numMappings = 200
+        self.mers = ["AAAA", "AAAC", "AAAG"]
+        self.stoits = ["s1", "s2"]
+        self.kmerSigs = np_random.rand(self.numCons, len(self.mers))
+        self.covProfiles = np_random.rand(self.numCons, len(self.stoits))
+        self.normCoverages = np_random.rand(self.numCons, 1)
+        self.contigNames = np.array(["contig_%d" % i for i in range(self.numCons)])
+        self.bins = np_random.randint(0, 4, self.numCons)
+        self.lengths = np_random.randint(1000, 10000, self.numCons)
+        self.gcs = np_random.rand(self.numCons)
+        self.markerNames = np.array(["PF0000%d" % i for i in range(5)])
+        self.taxonNames = np.array([""] + ["taxon_%d" % i for i in range(9)])
+        self.mappingMarkers = np_random.randint(0, 5, self.numMappings)
+        self.mappingContigs = np_random.randint(0, self.numCons, self.numMappings)
+        self.mappingTaxstrings = np.array(["d__Bacteria;p__P%d" % i for i in range(self.numMappings)])
+        self.classification = np_random.randint(0, 10, (self.numMappings, 7))
+
+        dm = DataManager()
+        with tables.open_file(self.dbFileName, "w") as h5file:
+            profile_group = h5file.create_group("/", "profile")
+            dm._createProfileArray(h5file, profile_group, "kms", self.kmerSigs, len(self.mers))
+            dm._createProfileArray(h5file, profile_group, "coverage", self.covProfiles, len(self.stoits))
+            h5file.create_table(profile_group, "normCoverage",
+                                np.array([tuple(r) for r in self.normCoverages], dtype=dm.normCoverage_desc))
+
+            meta_group = h5file.create_group("/", "meta")
+            h5file.create_table(meta_group, "contigs",
+                                np.array(zip(self.contigNames, self.bins, self.lengths, self.gcs), dtype=dm.contigs_desc))
+            h5file.create_table(meta_group, "reachability",
+                                np.array(zip(np_random.permutation(self.numCons), np_random.rand(self.numCons)), dtype=dm.reachability_desc))
+            h5file.create_table(meta_group, "meta",
+                                np.array([(",".join(self.stoits), len(self.stoits), ",".join(self.mers), 4, len(self.mers),
+                                           self.numCons, 3, 5, False, False, __current_GMDB_version__)], dtype=dm.meta_desc))
+            h5file.create_table(meta_group, "markers",
+                                np.array(zip(self.markerNames, range(5)), dtype=dm.markers_desc))
+            h5file.create_table(meta_group, "taxons",
+                                np.array([(t,) for t in self.taxonNames], dtype=dm.taxons_desc))
+
+            mappings_group = h5file.create_group("/", "mappings")
+            h5file.create_table(mappings_group, "mappings",
+                                np.array(zip(self.mappingMarkers, self.mappingContigs, self.mappingTaxstrings), dtype=dm.mappings_desc))
+            h5file.create_table(mappings_group, "classification",
+                                np.array([tuple(r) for r in self.classification], dtype=dm.classification_desc))
+
+    @classmethod
+    def teardown_class(self):
+        shutil.rmtree(self.workingDir)
+
+    def testLoadMappings(self):
+        pm = ProfileManager(self.dbFileName)
+        prof = pm.loadData(TimeKeeper(), silent=True, loadMarkers=True, loadTaxstrings=True, minLength=4000, bids=[1, 2])
+        assert_true(prof.numContigs < self.numCons, "loads a subset of contigs")
+
+        # per-mapping dictionary lookup
+        indices_2_rows = dict(zip(prof.indices, range(prof.numContigs)))
+        rows = []
+        keep = []
+        for (i, index) in enumerate(self.mappingContigs):
+            if index in indices_2_rows:
+                rows.append(indices_2_rows[index])
+                keep.append(i)
+        assert_true(0 < len(keep) < self.numMappings, "some mappings are to contigs that were not loaded")
+
+        mapping = prof.mapping
+        assert_true(mapping.numMappings == len(keep), "keeps mappings to loaded contigs")
+        assert_true(equal_arrays(mapping.rowIndices, rows), "finds profile rows of mapped contigs")
+        assert_true(equal_arrays(mapping.indices, keep), "finds indices of kept mappings")
+        assert_true(equal_arrays(mapping.markerNames, self.markerNames[self.mappingMarkers][keep]), "loads marker names of kept mappings")
+        assert_true(equal_arrays(mapping.taxstrings, self.mappingTaxstrings[keep]), "loads taxstrings of kept mappings")
+        assert_true(equal_arrays(mapping.classification._table, self.classification[keep]), "loads classification of kept mappings")
+
+    def testLazyLoad(self):
+        timer = TimeKeeper()
+        pm = ProfileManager(self.dbFileName)
+        eager = pm.loadData(timer, silent=True, loadBins=True, loadTaxstrings=True, minLength=4000)
+
+        # record getter calls and whether they share an open handle
+        calls = []
+        dm = pm._dm
+        def record(name, getter):
+            def get(*args, **kwargs):
+                calls.append((name, dm.isOpen(self.dbFileName)))
+                return getter(*args, **kwargs)
+            return get
+        getters = ["getCoverages", "getNormCoverages", "getKmerSigs", "getContigNames", "getContigLengths",
+                   "getContigGCs", "getCovColNames", "getMappingTaxstrings"]
+        for name in getters:
+            setattr(dm, name, record(name, getattr(dm, name)))
+
+        lazy = pm.loadData(timer, silent=True, loadCovProfiles=False, loadKmerSigs=False, loadStoitNames=False,
+                           loadContigNames=False, loadContigLengths=False, loadContigGCs=False, loadBins=True,
+                           loadMarkers=False, minLength=4000)
+        assert_true(calls == [], "reads no deferred fields when loading")
+        assert_true(not hasattr(lazy, "mapping"), "does not load mappings unless requested")
+
+        assert_true(equal_arrays(lazy.contigLengths, eager.contigLengths), "loads contig lengths on first access")
+        assert_true([name for (name, _) in calls] == ["getContigLengths"], "reads only the accessed field")
+        assert_true(equal_arrays(lazy.contigLengths, eager.contigLengths) and len(calls) == 1, "reads a field only once")
+
+        with pm.session(timer, silent=True):
+            for field in ["indices", "binIds", "covProfiles", "normCoverages", "kmerSigs", "contigNames",
+                          "contigGCs", "stoitNames"]:
+                assert_true(equal_arrays(getattr(lazy, field), getattr(eager, field)),
+                            "loads same %s lazily as eagerly" % field)
+        assert_true(lazy.numContigs == eager.numContigs and lazy.numStoits == eager.numStoits,
+                    "loads same metadata lazily as eagerly")
+        assert_true(all([is_open for (_, is_open) in calls]), "reads deferred fields within a session")
+
+        mapping = pm.loadData(timer, silent=True, minLength=4000).mapping
+        del calls[:]
+        assert_true(equal_arrays(mapping.taxstrings, eager.mapping.taxstrings), "loads taxstrings on first access")
+        assert_true(calls == [("getMappingTaxstrings", True)], "reads taxstrings within a session")
+
+    def testLoaderFields(self):
+        timer = TimeKeeper()
+        deferred = set(["covProfiles", "normCoverages", "kmerSigs", "contigNames", "contigLengths",
+                        "contigGCs", "stoitNames"])
+        for (name, loadProfile, fields) in [
+                ("CoreCreator", lambda: CoreCreator(self.dbFileName).loadProfile(timer, minLength=0),
+                 ["covProfiles", "normCoverages", "kmerSigs", "contigLengths"]),
+                ("ExplorePlotManager", lambda: ExplorePlotManager(self.dbFileName).loadProfile(timer),
+                 ["covProfiles", "normCoverages", "kmerSigs", "contigLengths", "contigGCs"]),
+                ("ReachabilityPlotManager", lambda: ReachabilityPlotManager(self.dbFileName).loadProfile(timer),
+                 []),
+                ("BinExtractor", lambda: BinExtractor(self.dbFileName, folder=self.workingDir).loadProfile(timer),
+                 ["contigNames"]),
+                ("MarkerExtractor", lambda: MarkerExtractor(self.dbFileName, folder=self.workingDir).loadProfile(timer),
+                 ["contigNames", "contigLengths"]),
+                ("BinStatsDumper", lambda: BinStatsDumper(self.dbFileName).loadProfile(timer),
+                 ["covProfiles", "normCoverages", "contigLengths", "contigGCs"])]:
+            prof = loadProfile()
+            loaded = deferred.difference(prof.__dict__.get("_loaders", {}))
+            assert_true(loaded == set(fields), "%s loads only the fields it reads" % name)
+
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
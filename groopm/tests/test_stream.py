@@ -36,7 +36,8 @@ import operator
 # local imports
 from tools import (equal_arrays, almost_equal_arrays)
 from groopm.distance import argrank
-from groopm.stream import (pdist_chunk,
+from groopm.stream import (index_dtype,
+                           pdist_chunk,
                            argsort_chunk_mergesort,
                            argrank_chunk,
                            iapply_func_chunk
@@ -101,6 +102,19 @@ class TestStream:
         
         for _ in range(5):
             _test_one_big()
+            
+        # parallel
+        def _test_one_threaded():
+            f3 = np_random.rand(np_random.random_integers(2, 200), 50)
+            d3 = sp_distance.pdist(f3, metric="euclidean")
+            pdist_chunk(f3, filename, chunk_size=np_random.random_integers(1, 5000), threads=4, block_size=np_random.random_integers(1, 500), metric="euclidean")
+            assert_true(equal_arrays(np.fromfile(filename, dtype=np.double),
+                                     d3),
+                        "computes same distances as unchunked function when split into blocks across threads")
+            os.remove(filename)
+            
+        for _ in range(20):
+            _test_one_threaded()
     
     def testArgsortChunkMergesort(self):
         #
@@ -136,6 +150,24 @@ class TestStream:
         
         for _ in range(5):
             _test_one_big()
+            
+        # parallel
+        def _test_one_threaded():
+            # round values to generate plenty of ties
+            d3 = np.around(np_random.rand(np_random.random_integers(1, 1000))*20)
+            d3.tofile(infile)
+            argsort_chunk_mergesort(infile, outfile, chunk_size=np_random.random_integers(1, 200), threads=4)
+            arr = np.fromfile(infile, dtype=np.double)
+            assert_true(equal_arrays(arr, np.sort(d3)),
+                        "input file values are in sorted order when runs are sorted across threads")
+            inds = np.fromfile(outfile, dtype=np.int)
+            assert_true(equal_arrays(np.sort(inds), np.arange(d3.size)) and equal_arrays(d3[inds], arr),
+                        "output file contains sorting indices when runs are sorted across threads")
+            os.remove(infile)
+            os.remove(outfile)
+            
+        for _ in range(20):
+            _test_one_threaded()
         
     def testArgrankChunk(self):
         #
@@ -173,6 +205,23 @@ class TestStream:
         
         for _ in range(5):
             _test_one_big()
+            
+        # single precision storage
+        def _test_one_single():
+            f3 = np_random.rand(np_random.random_integers(2, 100), 10)
+            d3 = sp_distance.pdist(f3, metric="euclidean")
+            w3 = np_random.random_integers(1, 20, size=d3.size).astype(np.double)
+            pdist_chunk(f3, dist_file, chunk_size=200, dtype=np.float32, metric="euclidean")
+            assert_true(equal_arrays(np.fromfile(dist_file, dtype=np.float32), d3.astype(np.float32)),
+                        "stores single precision distances")
+            x3 = argrank_chunk(dist_file, indices_file, weight_fun=lambda i: w3[i], chunk_size=40, dtype=np.float32, itype=index_dtype(d3.size))
+            assert_true(almost_equal_arrays(x3, argrank(d3.astype(np.float32), weight_fun=lambda i: w3[i], axis=None)),
+                        "computes ranks of single precision distances using 32-bit indices")
+            os.remove(dist_file)
+            os.remove(indices_file)
+            
+        for _ in range(20):
+            _test_one_single()
     
     def testIapplyFuncChunk(self):
         #
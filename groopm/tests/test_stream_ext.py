@@ -30,7 +30,8 @@ import numpy.random as np_random
 
 # local imports
 from tools import (equal_arrays, almost_equal_arrays)
-from groopm.stream_ext import (merge,)
+from groopm.stream_ext import (merge,
+                               merge_runs)
 
 ###############################################################################
 ###############################################################################
@@ -66,6 +67,35 @@ def test_merge():
     
     for _ in range(50):
         _test_one()
+        
+        
+def test_merge_runs():
+    
+    def _test_one():
+        k = np_random.random_integers(1, 20)
+        # round values to generate ties between runs
+        runs = [np.sort(np.around(np_random.rand(np_random.random_integers(0, 100))*50)) for _ in range(k)]
+        starts = np.cumsum([0] + [len(r) for r in runs])
+        values = np.concatenate(runs)
+        indices = values.argsort(kind="mergesort")
+        
+        n = np_random.random_integers(0, values.size)
+        merged = np.zeros(n, dtype=values.dtype)
+        merged_indices = np.zeros(n, dtype=np.int)
+        pos = merge_runs(runs,
+                         [np.arange(starts[i], starts[i+1]) for i in range(k)],
+                         merged,
+                         merged_indices,
+                         )
+        assert_true(equal_arrays(values[indices[:n]], merged),
+                    "sorts values in output array")
+        assert_true(equal_arrays(indices[:n], merged_indices),
+                    "writes stable sorting indices into output indices array")
+        assert_true(equal_arrays(pos, [np.sum((merged_indices >= starts[i]) & (merged_indices < starts[i+1])) for i in range(k)]),
+                    "returns number of values merged from each run")
+    
+    for _ in range(50):
+        _test_one()
                         
 ###############################################################################
 ###############################################################################
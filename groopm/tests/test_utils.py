@@ -27,9 +27,13 @@ __email__ = "tim.lamberton@gmail.com"
 from nose.tools import assert_true
 import numpy as np
 import numpy.random as np_random
+from StringIO import StringIO
 
 # local imports
-from groopm.utils import (group_iterator,)
+from tools import equal_arrays
+from groopm.utils import (group_iterator,
+                          lookup_indices,
+                          FastaReader)
 
 ###############################################################################
 ###############################################################################
@@ -43,6 +47,68 @@ def test_group_iterator():
     assert_true(all([t==p for (t, p) in zip(group_iterator(grouping),  pairs)]),
                 "`group_iterator` returns grouping variable names and indices pairs")
 
+    
+def test_lookup_indices():
+    keys = np.array(["c", "a", "d", "a", "b"])
+    values = np.array(["a", "b", "e", "c", "d", "0"])
+    assert_true(equal_arrays(lookup_indices(keys, values), [3, 4, -1, 0, 2, -1]),
+                "finds last index of each value and -1 for missing values")
+    assert_true(equal_arrays(lookup_indices([], values), [-1]*6), "finds no values in empty keys")
+    
+    keys = np_random.permutation(1000)
+    values = np_random.randint(-100, 1100, 500)
+    lookup = dict(zip(keys, range(len(keys))))
+    assert_true(equal_arrays(lookup_indices(keys, values), [lookup.get(v, -1) for v in values]),
+                "finds same indices as a dictionary lookup")
+    
+    
+def _make_fasta(n, width):
+    lines = []
+    records = []
+    for i in range(n):
+        name = "contig_%d" % i
+        seq = "".join(np_random.choice(list("ACGTN"), size=np_random.randint(1, 500)))
+        records.append((name, seq))
+        lines.append(">%s some description" % name)
+        lines.extend([seq[j:j+width] for j in range(0, len(seq), width)])
+    return ("\n".join(lines)+"\n", records)
+    
+    
+def test_FastaReader_readFasta():
+    (fasta, records) = _make_fasta(100, 60)
+    for blockSize in [1, 7, 100, 1<<22]:
+        reader = FastaReader(blockSize=blockSize)
+        assert_true(list(reader.readFasta(StringIO(fasta))) == records,
+                    "reads same records for block size %d" % blockSize)
+    assert_true(list(FastaReader().readFasta(StringIO(fasta.replace("\n", "\r\n")))) == records,
+                "strips carriage returns")
+    assert_true(list(FastaReader().readFasta(StringIO(""))) == [], "reads nothing from an empty file")
+    
+    
+def test_FastaReader_index():
+    (fasta, records) = _make_fasta(100, 60)
+    reader = FastaReader()
+    index = reader.makeIndex(StringIO(fasta))
+    assert_true([(name, length) for (name, length, _, _, _) in index] == [(name, len(seq)) for (name, seq) in records],
+                "indexes name and length of each record")
+    
+    out = StringIO()
+    reader.writeIndex(index, out)
+    assert_true(reader.readIndex(StringIO(out.getvalue())) == index, "reads index that was written")
+    
+    wanted = [records[i][0] for i in np_random.permutation(len(records))[:20]]
+    assert_true(list(reader.readIndexedFasta(StringIO(fasta), index, wanted)) == [(name, seq) for (name, seq) in records if name in wanted],
+                "reads wanted records in file order using index")
+    assert_true(list(reader.readIndexedFasta(StringIO(fasta), index)) == records,
+                "reads all records using index")
+    
+    bad_fasta = ">contig_0\nACGT\nAC\nACGT\n"
+    try:
+        reader.makeIndex(StringIO(bad_fasta))
+        assert_true(False, "raises error for sequence with uneven line lengths")
+    except ValueError:
+        pass
+
                         
 ###############################################################################
 ###############################################################################
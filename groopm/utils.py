@@ -66,23 +66,131 @@ class CSVReader:
             yield l.rstrip().split(separator)
             
             
+# characters removed from sequence lines
+_whitespace = " \t\r\n\x0b\x0c"
+
 class FastaReader:
-    """Read in fasta files"""
+    """Read in fasta files
+    
+    Files are read in large blocks which are split into records, rather than
+    line by line. An uncompressed file with a samtools style `.fai` index can
+    be read selectively by seeking to wanted records.
+    """
+    def __init__(self, blockSize=1<<22):
+        self.blockSize = blockSize
+        
     def readFasta(self, fp): # this is a generator function
-        header = None
-        seq = None
+        buf = ""
+        while True:
+            block = fp.read(self.blockSize)
+            if not block:
+                break
+            buf += block
+            # records are complete up to the start of the last header seen
+            end = buf.rfind("\n>", max(0, len(buf)-len(block)-1))
+            if end < 0:
+                continue
+            for record in self._splitRecords(buf[:end+1]):
+                yield record
+            buf = buf[end+1:]
+        # anything left in the barrel?
+        for record in self._splitRecords(buf):
+            yield record
+            
+    def _splitRecords(self, text):
+        """Split text holding whole records into (header, seq) pairs"""
+        if text == "":
+            return
+        if text[0] != ">":
+            raise ValueError("Expected fasta header at start of record")
+        for record in text[1:].split("\n>"):
+            (header, _, seq) = record.partition("\n")
+            yield (header.rstrip().partition(" ")[0], seq.translate(None, _whitespace))
+            
+    def makeIndex(self, fp):
+        """Build a samtools style fasta index
+        
+        Returns a list of tuples (name, length, offset, lineBases, lineWidth)
+        in file order. Raises ValueError if the lines of a record have
+        differing lengths.
+        """
+        index = []
+        offset = 0
+        name = None
         for l in fp:
-            if l[0] == '>': # fasta header line
-                if header is not None:
-                    # we have reached a new sequence
-                    yield header, "".join(seq)
-                header = l.rstrip()[1:].partition(" ")[0] # save the header we just saw
-                seq = []
+            if l[0] == '>':
+                if name is not None:
+                    index.append((name, length, seq_offset, line_bases, line_width))
+                name = l.rstrip()[1:].partition(" ")[0]
+                seq_offset = offset + len(l)
+                (length, line_bases, line_width, short_line) = (0, 0, 0, False)
             else:
-                seq.append(l.rstrip())
-        # anything left in the barrel?
-        if header is not None:
-            yield header, "".join(seq)
+                bases = len(l.rstrip())
+                if bases > 0:
+                    # only the last line of a sequence may be shorter
+                    if short_line or bases > line_bases > 0:
+                        raise ValueError("Different line length in sequence '%s'" % name)
+                    if line_bases == 0:
+                        (line_bases, line_width) = (bases, len(l))
+                    length += bases
+                short_line = bases < line_bases or bases == 0
+            offset += len(l)
+        if name is not None:
+            index.append((name, length, seq_offset, line_bases, line_width))
+        return index
+        
+    def writeIndex(self, index, fp):
+        """Write a fasta index in samtools `.fai` format"""
+        for entry in index:
+            fp.write("%s\t%d\t%d\t%d\t%d\n" % entry)
+            
+    def readIndex(self, fp):
+        """Read a fasta index in samtools `.fai` format"""
+        index = []
+        for l in fp:
+            fields = l.rstrip("\n").split("\t")
+            index.append((fields[0],) + tuple(int(x) for x in fields[1:5]))
+        return index
+        
+    def loadIndex(self, fileName, create=False):
+        """Load the `.fai` index of a fasta file, optionally creating it
+        
+        Returns None if there is no index and one is not created.
+        """
+        indexFileName = fileName + ".fai"
+        if os.path.exists(indexFileName):
+            with open(indexFileName) as f:
+                return self.readIndex(f)
+        if not create:
+            return None
+        with open(fileName) as f:
+            index = self.makeIndex(f)
+        with open(indexFileName, "w") as f:
+            self.writeIndex(index, f)
+        return index
+            
+    def readIndexedFasta(self, fp, index, wanted=None):
+        """Read wanted records from a seekable fasta file using its index
+        
+        Yields (header, seq) for indexed records in `wanted`, or all indexed
+        records if `wanted` is None, in file order.
+        """
+        if wanted is not None:
+            wanted = set(wanted)
+        for entry in index:
+            if wanted is not None and entry[0] not in wanted:
+                continue
+            yield (entry[0], self.readIndexedRecord(fp, entry))
+            
+    def readIndexedRecord(self, fp, entry):
+        """Read the sequence of an indexed record from a seekable fasta file"""
+        (_, length, offset, line_bases, line_width) = entry
+        fp.seek(offset)
+        if line_bases > 0:
+            num_bytes = (length // line_bases) * line_width + length % line_bases
+        else:
+            num_bytes = 0
+        return fp.read(num_bytes).translate(None, _whitespace)
 
             
 def makeSurePathExists(path):
@@ -153,6 +261,23 @@ def split_contiguous(grouping, filter_groups=[]):
     return (first_indices[keep[first_indices]], last_indices[keep[first_indices]])
     
     
+def lookup_indices(keys, values):
+    """Find the index of each value in an array of keys
+    
+    Returns an array of indices into `keys`, with -1 for values that are not
+    found. For repeated keys the last index is used.
+    """
+    keys = np.asarray(keys)
+    values = np.asarray(values)
+    if len(keys) == 0:
+        return np.full(len(values), -1, dtype=np.intp)
+    order = np.argsort(keys, kind="mergesort")
+    sorted_keys = keys[order]
+    pos = np.searchsorted(sorted_keys, values, side="right") - 1
+    found = sorted_keys[np.maximum(pos, 0)] == values
+    return np.where(found & (pos >= 0), order[pos], -1)
+    
+    
 ###############################################################################
 ###############################################################################
 ###############################################################################
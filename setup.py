@@ -1,4 +1,5 @@
 from distutils.core import setup
+from distutils.extension import Extension
 from Cython.Build import cythonize
 import numpy as np
 
@@ -20,5 +21,11 @@ setup(
         "tables >= 3.2.0"
     ],
     include_dirs = [np.get_include()],
-    ext_modules = cythonize("groopm/stream_ext.pyx"), 
+    ext_modules = cythonize([
+        Extension("groopm.stream_ext", ["groopm/stream_ext.pyx"]),
+        Extension("groopm.hierarchy_ext", ["groopm/hierarchy_ext.pyx"]),
+        Extension("groopm.distance_ext", ["groopm/distance_ext.pyx"],
+                  extra_compile_args=["-fopenmp"],
+                  extra_link_args=["-fopenmp"]),
+        ]),
 )